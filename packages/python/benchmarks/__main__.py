@@ -0,0 +1,110 @@
+"""
+Run the benchmark suite (see `suite.py`), from `packages/python`:
+
+    $ python -m benchmarks                                  # everything
+    $ python -m benchmarks rpc stream --quick               # cases whose names contain `rpc` or `stream`, fewer iterations
+    $ python -m benchmarks --output before.json             # save the results...
+    $ python -m benchmarks --compare before.json --fail-over 0.15   # ...and compare a later run against them
+    $ python -m benchmarks --repeat 5                       # best of 5, for less noisy numbers
+
+Results are JSON: `{"meta": {...}, "results": {case: {metric: value}}}`. With `--fail-over`, the
+exit status is 1 if any metric got worse by more than that fraction.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+from .suite import CASES, better, run
+
+def _version() -> Optional[str]:
+    try:
+        from importlib.metadata import version
+        return version('ephaptic')
+    except Exception:
+        return None
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def meta(scale: float) -> dict:
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'ephaptic': _version(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': scale,
+    }
+
+def compare(baseline: dict, results: dict) -> List[tuple]:
+    """(case, metric, before, after, how much worse it got as a fraction, negative if it improved)"""
+    rows = []
+    for name, metrics in results.items():
+        for metric, after in metrics.items():
+            before = baseline.get('results', {}).get(name, {}).get(metric)
+            direction = better(metric)
+            if before is None or not direction or not before: continue
+            rows.append((name, metric, before, after, direction * (before - after) / abs(before)))
+    return rows
+
+def _print(results: Dict[str, dict], comparison: Optional[List[tuple]]):
+    before = {(name, metric): value for name, metric, value, _, _ in comparison or []}
+    for name, metrics in results.items():
+        print(name, file=sys.stderr)
+        for metric, value in metrics.items():
+            change = before.get((name, metric))
+            change = f'  ({(value - change) / change:+.1%})' if change else ''
+            print(f'    {metric:<28} {value:>14,.2f}{change}', file=sys.stderr)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('filters', nargs='*', help='only run cases whose names contain one of these')
+    parser.add_argument('--quick', action='store_true', help='a tenth of the iterations, e.g. for CI smoke runs')
+    parser.add_argument('--repeat', type=int, default=1, help='run each case this many times, and keep the best of each metric')
+    parser.add_argument('--output', '-o', help='write the results to this JSON file (default: stdout)')
+    parser.add_argument('--compare', help='a previous JSON output to compare against')
+    parser.add_argument('--fail-over', type=float, help='exit with 1 if a metric is worse than --compare by more than this fraction')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    args = parser.parse_args(argv)
+
+    names = [name for name in CASES if not args.filters or any(f in name for f in args.filters)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    if not names: parser.error(f'no cases match {args.filters}')
+
+    scale = 0.1 if args.quick else 1.0
+    output = {'meta': {**meta(scale), 'repeat': args.repeat}, 'results': asyncio.run(run(names, scale, args.repeat))}
+
+    comparison = None
+    if args.compare:
+        with open(args.compare) as f: comparison = compare(json.load(f), output['results'])
+    _print(output['results'], comparison)
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(text + '\n')
+    else:
+        print(text)
+
+    if comparison and args.fail_over is not None:
+        worse = [row for row in comparison if row[4] > args.fail_over]
+        for name, metric, before, after, regression in worse:
+            print(f'REGRESSION {name} {metric}: {before:,.2f} -> {after:,.2f} ({regression:.1%} worse)', file=sys.stderr)
+        if worse: return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+CPU vs bytes trade-off of message compression, per codec and level.
+
+The payload is what a typical exposed function returns: a list of pydantic models, dumped to
+JSON-compatible dicts and msgpack-encoded, at a few sizes around the default threshold.
+
+    $ python benchmarks/compression.py
+"""
+
+import time
+import zlib
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def payload(rows: int) -> bytes:
+    return msgpack.dumps({'id': 1, 'result': [
+        {'id': i, 'name': f'Product {i}', 'price': 9.99 + i, 'tags': ['new', 'sale'][: i % 3], 'in_stock': i % 2 == 0}
+        for i in range(rows)
+    ]})
+
+
+def codecs():
+    for level in (1, 6):
+        yield f'zlib-{level}', (lambda level: lambda data: zlib.compress(data, level))(level), zlib.decompress
+    if zstandard:
+        for level in (1, 3, 9):
+            c, d = zstandard.ZstdCompressor(level=level), zstandard.ZstdDecompressor()
+            yield f'zstd-{level}', c.compress, d.decompress
+
+
+def measure(func, data, min_time=0.2):
+    runs, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time:
+        func(data)
+        runs += 1
+    return elapsed / runs
+
+
+def main():
+    if not zstandard: print('(zstandard is not installed, only zlib is measured)\n')
+    print(f"{'codec':<8} {'rows':>6} {'raw B':>9} {'out B':>9} {'ratio':>6} {'comp us':>9} {'decomp us':>10} {'MB/s':>7}")
+    for rows in (10, 100, 1000, 10000):
+        data = payload(rows)
+        for name, compress, decompress in codecs():
+            compressed = compress(data)
+            c, d = measure(compress, data), measure(decompress, compressed)
+            print(f'{name:<8} {rows:>6} {len(data):>9,} {len(compressed):>9,} {len(data) / len(compressed):>6.1f} {c * 1e6:>9.1f} {d * 1e6:>10.1f} {len(data) / c / 1e6:>7.0f}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
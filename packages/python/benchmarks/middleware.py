@@ -0,0 +1,95 @@
+"""
+Per-request overhead of the HTTP context middleware, measured in-process (no sockets).
+
+Compares the old `BaseHTTPMiddleware`-based `CtxMiddleware` against the plain ASGI one, on a
+route it applies to, and on one it skips (`http_paths`).
+
+    $ python benchmarks/middleware.py [--requests 20000]
+"""
+
+import argparse
+import asyncio
+import time
+
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from ephaptic import Ephaptic, active_user
+from ephaptic.ctx import _scope_ctx, _active_user_ctx
+from ephaptic.ext.fastapi.middleware import CtxMiddleware
+
+
+class BaseHTTPCtxMiddleware(BaseHTTPMiddleware):
+    # What `CtxMiddleware` used to be.
+    def __init__(self, app, ephaptic: Ephaptic):
+        super().__init__(app)
+        self.ephaptic = ephaptic
+
+    async def dispatch(self, request, call_next):
+        token = _scope_ctx.set('http')
+        user_token = None
+
+        if self.ephaptic._http_identity_loader:
+            user = await self.ephaptic._async(self.ephaptic._http_identity_loader)(request)
+            if user:
+                user_token = _active_user_ctx.set(user)
+
+        try:
+            return await call_next(request)
+        finally:
+            _scope_ctx.reset(token)
+            if user_token: _active_user_ctx.reset(user_token)
+
+
+def make_app(middleware):
+    app = FastAPI()
+    ephaptic = Ephaptic() # not `from_app`, which would install the current middleware
+    ephaptic.http_paths = ('/api',)
+
+    async def load(request): return request.headers.get('authorization')
+    ephaptic._http_identity_loader = load
+
+    app.add_middleware(middleware, ephaptic=ephaptic)
+
+    @app.get('/api/ping')
+    @app.get('/static/ping')
+    async def ping(): return {'user': active_user()}
+
+    return app
+
+
+async def request(app, path: str):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+        'headers': [(b'host', b'test'), (b'authorization', b'alice')],
+        'client': ('127.0.0.1', 1234), 'server': ('test', 80),
+    }
+    messages = []
+
+    async def receive(): return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message): messages.append(message)
+
+    await app(scope, receive, send)
+    assert messages[0]['status'] == 200
+
+
+async def measure(app, path: str, requests: int) -> float:
+    for _ in range(200): await request(app, path) # warm up
+    start = time.perf_counter()
+    for _ in range(requests): await request(app, path)
+    return time.perf_counter() - start
+
+
+async def main(requests: int):
+    for label, middleware in (('BaseHTTPMiddleware', BaseHTTPCtxMiddleware), ('ASGI CtxMiddleware', CtxMiddleware)):
+        app = make_app(middleware)
+        for path in ('/api/ping', '/static/ping'):
+            elapsed = await measure(app, path, requests)
+            print(f'{label:<20} {path:<14} {elapsed / requests * 1e6:>7.1f} us/request  {requests / elapsed:>9,.0f} requests/sec')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20_000)
+    asyncio.run(main(parser.parse_args().requests))
@@ -0,0 +1,73 @@
+"""
+The in-memory rate limit store under a client spraying distinct keys (e.g. cycling through IPs).
+
+Compares the old approach (a plain dict, fully scanned for expired keys once a minute, by
+whichever call happened to cross the mark) against `ExpiringStore`. Time is simulated: each
+operation is `--interval` seconds after the last, and every key lives for `--ttl` seconds.
+
+    $ python benchmarks/store.py [--keys 1000000] [--max-size 100000]
+"""
+
+import argparse
+import gc
+import time
+
+from ephaptic.store import ExpiringStore
+
+
+class ScannedDict:
+    def __init__(self):
+        self.data = {}
+        self.last_cleanup = 0.0
+
+    def get(self, key, now):
+        if now - self.last_cleanup > 60:
+            for k in [k for k, (_, expires_at) in self.data.items() if expires_at < now]: del self.data[k]
+            self.last_cleanup = now
+        entry = self.data.get(key)
+        return entry[0] if entry and entry[1] > now else None
+
+    def set(self, key, value, expires_at, now):
+        self.data[key] = (value, expires_at)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def measure(store, keys: int, ttl: float, interval: float):
+    worst, peak = 0.0, 0
+    now = 0.0
+    gc.disable() # otherwise `worst` is mostly whichever op the collector happened to run in
+    start = time.perf_counter()
+    for n in range(keys):
+        now += interval
+        key = f'ephaptic:rl:f:ip:{n}'
+
+        op = time.perf_counter()
+        if store.get(key, now) is None: store.set(key, 1, now + ttl, now)
+        worst = max(worst, time.perf_counter() - op)
+
+        if n % 1000 == 0: peak = max(peak, len(store))
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    return elapsed, worst, peak
+
+
+def main(keys: int, ttl: float, interval: float, max_size: int):
+    print(f'{keys:,} distinct keys, ttl {ttl:g}s, one every {interval * 1e6:g}us ({keys * interval:g}s simulated)')
+    for label, store in (
+        ('dict + scan every 60s', ScannedDict()),
+        ('ExpiringStore', ExpiringStore(max_size)),
+    ):
+        elapsed, worst, peak = measure(store, keys, ttl, interval)
+        print(f'{label:<22} {elapsed / keys * 1e6:>6.2f} us/op  worst {worst * 1e3:>8.2f} ms  peak {peak:>9,} keys  final {len(store):>9,} keys')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=1_000_000)
+    parser.add_argument('--ttl', type=float, default=60)
+    parser.add_argument('--interval', type=float, default=1e-4)
+    parser.add_argument('--max-size', type=int, default=100_000)
+    args = parser.parse_args()
+    main(args.keys, args.ttl, args.interval, args.max_size)
@@ -0,0 +1,319 @@
+"""
+The benchmark suite run by `python -m benchmarks`. Everything runs in-process, without sockets.
+
+Each case returns a flat dict of numbers. Names say which way is better: `*_per_sec` is
+higher-is-better, `*_us` and `*_ms` are lower-is-better (see `better`).
+"""
+
+import asyncio
+import gc
+import itertools
+import time
+import typing
+from typing import Awaitable, Callable, Dict, List
+
+import msgpack
+import pydantic
+from fastapi import FastAPI
+
+from ephaptic import Ephaptic, ratelimit
+from ephaptic.ephaptic import manager
+from ephaptic.ext.fastapi import Router
+from ephaptic.session import Session
+from ephaptic.transports import Transport, memory
+from ephaptic.utils import parse_limits
+
+Result = Dict[str, float]
+CASES: Dict[str, Callable[[float], Awaitable[Result]]] = {}
+
+def case(name: str):
+    """Register a benchmark. It's called with a `scale` (1 normally, less with `--quick`) to multiply its iterations by."""
+    def register(func):
+        CASES[name] = func
+        return func
+    return register
+
+def better(metric: str) -> int:
+    # +1 if higher is better, -1 if lower is, 0 if we can't tell.
+    if metric.endswith('_per_sec'): return 1
+    if metric.endswith(('_us', '_ms')): return -1
+    return 0
+
+def _n(count: int, scale: float) -> int:
+    return max(1, int(count * scale))
+
+def percentiles(samples_ns: List[int], prefix: str = 'latency') -> Result:
+    ordered = sorted(samples_ns)
+    at = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))] / 1e3
+    return {f'{prefix}_p50_us': at(0.50), f'{prefix}_p90_us': at(0.90), f'{prefix}_p99_us': at(0.99)}
+
+
+class CountingTransport(Transport):
+    """Throws everything away, calling `done` for each message."""
+
+    def __init__(self, done: Callable[[], None]):
+        self.done = done
+        self.remote_addr = '127.0.0.1'
+
+    async def send(self, data: bytes): self.done()
+    async def receive(self) -> bytes: await asyncio.Event().wait()
+
+
+class Item(pydantic.BaseModel):
+    name: str
+    price: float
+    tags: list[str] = []
+
+class Tick(pydantic.BaseModel):
+    n: int
+
+ITEM = {'name': 'widget', 'price': 9.99, 'tags': ['a', 'b']}
+
+ephaptic = Ephaptic.from_app(FastAPI())
+WINDOW = ephaptic.max_inflight + ephaptic.max_queued # calls a connection takes at once
+
+@ephaptic.expose
+async def add(a: int, b: int) -> int:
+    return a + b
+
+@ephaptic.expose
+def add_sync(a: int, b: int) -> int:
+    return a + b
+
+@ephaptic.expose
+async def save(item: Item) -> Item:
+    return item
+
+@ephaptic.expose(rate_limit='1000000/s')
+async def add_limited(a: int, b: int) -> int:
+    return a + b
+
+@ephaptic.expose
+async def count_async(n: int) -> typing.AsyncGenerator[int, None]:
+    for i in range(n): yield i
+
+@ephaptic.expose
+def count_sync(n: int) -> typing.Generator[int, None, None]:
+    for i in range(n): yield i
+
+
+async def _connect() -> typing.Tuple[memory.MemoryTransport, asyncio.Task]:
+    # The raw client end of a pipe, to send frames ourselves. The buffer is big enough that
+    # sending a whole burst of calls never waits on the server.
+    transport, server_end = memory.pipe(buffer=1 << 30)
+    server = asyncio.create_task(ephaptic.handle_transport(server_end))
+    await transport.send(msgpack.dumps({'type': 'init'}))
+    return transport, server
+
+async def _unary(name: str, args: list, calls: int) -> Result:
+    transport, server = await _connect()
+    frames = [msgpack.dumps({'type': 'rpc', 'id': i, 'name': name, 'args': args}) for i in range(calls)]
+
+    for frame in frames[:min(500, calls)]: # warm up
+        await transport.send(frame)
+        await transport.receive()
+
+    # One at a time, for latency...
+    samples = []
+    for frame in frames:
+        start = time.perf_counter_ns()
+        await transport.send(frame)
+        reply = msgpack.loads(await transport.receive())
+        samples.append(time.perf_counter_ns() - start)
+        assert 'result' in reply, reply
+
+    # ...and all at once, for throughput. As many as the connection takes at a time, that is:
+    # beyond that, it answers OVERLOADED (see `max_queued`), and we'd be timing the errors.
+    pending = iter(frames)
+    start = time.perf_counter()
+    for frame in itertools.islice(pending, WINDOW): await transport.send(frame)
+    for _ in frames:
+        assert b'error' not in await transport.receive()
+        frame = next(pending, None)
+        if frame: await transport.send(frame)
+    elapsed = time.perf_counter() - start
+
+    server.cancel()
+    return {'calls_per_sec': calls / elapsed, 'sequential_calls_per_sec': calls / (sum(samples) / 1e9), **percentiles(samples)}
+
+@case('rpc.async_primitive')
+async def rpc_async_primitive(scale: float) -> Result:
+    return await _unary('add', [1, 2], _n(20_000, scale))
+
+@case('rpc.sync_primitive')
+async def rpc_sync_primitive(scale: float) -> Result:
+    return await _unary('add_sync', [1, 2], _n(10_000, scale))
+
+@case('rpc.async_pydantic')
+async def rpc_async_pydantic(scale: float) -> Result:
+    return await _unary('save', [ITEM], _n(20_000, scale))
+
+@case('rpc.rate_limited')
+async def rpc_rate_limited(scale: float) -> Result:
+    ephaptic._limiter = None # a fresh in-memory limiter
+    return await _unary('add_limited', [1, 2], _n(20_000, scale))
+
+@case('rpc.client')
+async def rpc_client(scale: float) -> Result:
+    # The same call as `rpc.async_primitive`, through the Python client over an in-memory pipe.
+    client = await memory.connect(ephaptic)
+    calls = _n(10_000, scale)
+    for _ in range(min(500, calls)): await client.add(1, 2) # warm up
+
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter_ns()
+        await client.add(1, 2)
+        samples.append(time.perf_counter_ns() - start)
+
+    window = asyncio.Semaphore(WINDOW)
+    async def add():
+        async with window: await client.add(1, 2)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(add() for _ in range(calls)))
+    elapsed = time.perf_counter() - start
+
+    await client.close()
+    return {'calls_per_sec': calls / elapsed, 'sequential_calls_per_sec': calls / (sum(samples) / 1e9), **percentiles(samples)}
+
+@case('validation.pydantic')
+async def validation_pydantic(scale: float) -> Result:
+    plan = ephaptic._plan('save')
+    calls = _n(100_000, scale)
+    start = time.perf_counter()
+    for _ in range(calls): plan.dump_result(plan.bind([ITEM], {})['item'])
+    return {'calls_per_sec': calls / (time.perf_counter() - start)}
+
+
+async def _stream(name: str, chunks: int) -> Result:
+    transport, server = await _connect()
+    for call_id, n in ((0, min(1000, chunks)), (1, chunks)): # warm up, then the real one
+        start = time.perf_counter()
+        await transport.send(msgpack.dumps({'type': 'rpc', 'id': call_id, 'name': name, 'args': [n]}))
+        while 'done' not in msgpack.loads(await transport.receive()): ...
+        elapsed = time.perf_counter() - start
+    server.cancel()
+    return {'chunks_per_sec': chunks / elapsed}
+
+@case('stream.async_generator')
+async def stream_async_generator(scale: float) -> Result:
+    return await _stream('count_async', _n(100_000, scale))
+
+@case('stream.sync_generator')
+async def stream_sync_generator(scale: float) -> Result:
+    return await _stream('count_sync', _n(100_000, scale))
+
+
+@case('broadcast.fanout_10k')
+async def broadcast_fanout(scale: float) -> Result:
+    # 10k connections, one user each, all on this node.
+    users = [f'user-{i}' for i in range(10_000)]
+    rounds = _n(20, scale)
+    remaining = 0
+    delivered = asyncio.Event()
+
+    def done():
+        nonlocal remaining
+        remaining -= 1
+        if not remaining: delivered.set()
+
+    sessions = []
+    for user in users:
+        transport = CountingTransport(done)
+        session = Session(transport)
+        session.start()
+        sessions.append(session)
+        await manager.add(user, transport)
+
+    samples = []
+    try:
+        for _ in range(rounds + 1):
+            remaining = len(users)
+            delivered.clear()
+            start = time.perf_counter_ns()
+            await ephaptic.to(users).emit(Tick(n=1)) # encoded once, queued on every connection
+            await delivered.wait() # ...and written out by each one's writer
+            samples.append(time.perf_counter_ns() - start)
+    finally:
+        for user, session in zip(users, sessions):
+            await manager.remove(user, session.transport)
+            await session.close()
+
+    samples = samples[1:] # the first one warmed up
+    median_ms = sorted(samples)[len(samples) // 2] / 1e6
+    return {'broadcast_ms': median_ms, 'deliveries_per_sec': len(users) / (median_ms / 1e3)}
+
+
+async def _limiter(algorithm: str, checks: int) -> Result:
+    limiter = ratelimit.LocalLimiter(algorithm)
+    limit = parse_limits('1000000/s')
+    keys = [ratelimit.checks_for('f', limit, uid=f'user-{i}') for i in range(1000)]
+    start = time.perf_counter()
+    for i in range(checks): await limiter.hit(keys[i % 1000])
+    elapsed = time.perf_counter() - start
+    return {'checks_per_sec': checks / elapsed, 'check_us': elapsed / checks * 1e6}
+
+@case('ratelimit.gcra')
+async def ratelimit_gcra(scale: float) -> Result:
+    return await _limiter(ratelimit.GCRA, _n(200_000, scale))
+
+@case('ratelimit.sliding_window')
+async def ratelimit_sliding_window(scale: float) -> Result:
+    return await _limiter(ratelimit.SLIDING_WINDOW, _n(200_000, scale))
+
+
+def _http_app():
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    router = Router(eph)
+
+    @router.get('/router/add')
+    async def add_router(a: int, b: int) -> int: return a + b
+
+    @app.get('/plain/add')
+    async def add_plain(a: int, b: int) -> int: return a + b
+
+    app.include_router(router)
+    return app
+
+async def _request(app, path: str):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'a=1&b=2',
+        'headers': [(b'host', b'test')], 'client': ('127.0.0.1', 1234), 'server': ('test', 80),
+    }
+    messages = []
+
+    async def receive(): return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message): messages.append(message)
+
+    await app(scope, receive, send)
+    assert messages[0]['status'] == 200, messages
+
+@case('http.router')
+async def http_router(scale: float) -> Result:
+    # A Router endpoint, against the same endpoint as a plain FastAPI route, in the same app.
+    app = _http_app()
+    requests = _n(5_000, scale)
+    result = {}
+    for label, path in (('router', '/router/add'), ('plain', '/plain/add')):
+        for _ in range(200): await _request(app, path) # warm up
+        start = time.perf_counter()
+        for _ in range(requests): await _request(app, path)
+        result[f'{label}_request_us'] = (time.perf_counter() - start) / requests * 1e6
+    result['overhead_us'] = result['router_request_us'] - result['plain_request_us']
+    return result
+
+
+async def run(names: List[str], scale: float = 1.0, repeat: int = 1) -> Dict[str, Result]:
+    """With `repeat`, each metric is the best of that many runs, which filters out most of the noise from whatever else the machine was doing."""
+    results = {}
+    for name in names:
+        for _ in range(repeat):
+            gc.collect() # so one case's garbage isn't collected on the next one's time
+            result = await CASES[name](scale)
+            best = results.setdefault(name, result)
+            for metric, value in result.items():
+                if better(metric) * (value - best[metric]) > 0: best[metric] = value
+    return results
@@ -0,0 +1,58 @@
+"""
+Per-chunk overhead of streaming a sync generator from the event loop.
+
+Compares the old approach (one `asyncio.to_thread` hop per item) against `SyncStream`
+(the generator pinned to one thread, handing items over through a bounded buffer).
+
+    $ python benchmarks/sync_stream.py [--items 100000]
+"""
+
+import argparse
+import asyncio
+import time
+
+from ephaptic.streams import SyncStream
+
+
+def numbers(n: int):
+    for i in range(n): yield i
+
+
+async def per_item_to_thread(gen):
+    def next_(gen):
+        try:
+            return next(gen), False
+        except StopIteration:
+            return None, True
+
+    while True:
+        chunk, done = await asyncio.to_thread(next_, gen)
+        if done: return
+        yield chunk
+
+
+async def pinned_thread(gen):
+    async for chunk in SyncStream(gen):
+        yield chunk
+
+
+async def measure(strategy, items: int) -> float:
+    count = 0
+    start = time.perf_counter()
+    async for _ in strategy(numbers(items)): count += 1
+    elapsed = time.perf_counter() - start
+    assert count == items
+    return elapsed
+
+
+async def main(items: int):
+    for label, strategy in (('to_thread per item', per_item_to_thread), ('SyncStream', pinned_thread)):
+        await measure(strategy, 1000) # warm up
+        elapsed = await measure(strategy, items)
+        print(f'{label:<20} {elapsed:>7.2f}s  {elapsed / items * 1e6:>7.2f} us/chunk  {items / elapsed:>12,.0f} chunks/sec')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100_000)
+    asyncio.run(main(parser.parse_args().items))
@@ -0,0 +1,63 @@
+import time
+import typing
+from typing import Any, Dict, Hashable, Optional, Tuple, Union
+
+import msgpack
+import pydantic_core
+
+from .store import ExpiringStore
+
+CacheSpec = Union[int, float, Dict[str, Any]]
+
+_ID = msgpack.dumps('id')
+_RESULT = msgpack.dumps('result')
+
+def call_key(arguments: Dict[str, Any], uid: Optional[str] = None) -> Tuple[Hashable, bytes]:
+    """Equal for calls with equal validated arguments (and by the same user, if `uid` is given)."""
+    return (uid, pydantic_core.to_json(arguments, fallback=repr))
+
+def response_frame(call_id, encoded_result: bytes) -> bytes:
+    """`msgpack.dumps({'id': call_id, 'result': result})`, around a result that's already encoded."""
+    return b'\x82' + _ID + msgpack.dumps(call_id) + _RESULT + encoded_result
+
+class ResponseCache:
+    """
+    Results of one exposed function, by its (validated) arguments.
+
+    Entries are the encoded result, so a hit is spliced straight into the response frame
+    without calling the function, validating its return value, or serializing anything.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1024, per_user: bool = False):
+        self.ttl = ttl
+        self.per_user = per_user
+        self._store: ExpiringStore[bytes] = ExpiringStore(max_size)
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def of(cls, spec: CacheSpec) -> 'ResponseCache':
+        # `cache=60`, or `cache={'ttl': 60, 'max_size': 1024, 'per_user': True}`
+        if isinstance(spec, dict): return cls(**spec)
+        return cls(ttl=spec)
+
+    def key(self, arguments: Dict[str, Any], uid: Optional[str] = None) -> Tuple[Hashable, bytes]:
+        return call_key(arguments, uid if self.per_user else None)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        encoded = self._store.get(key)
+        if encoded is None: self.misses += 1
+        else: self.hits += 1
+        return encoded
+
+    def set(self, key: Hashable, encoded: bytes):
+        now = time.monotonic()
+        self._store.set(key, encoded, now + self.ttl, now)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        if key is None: self._store.clear()
+        else: self._store.pop(key)
+
+    def stats(self) -> Dict[str, typing.Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._store)}
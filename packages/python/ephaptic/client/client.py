@@ -3,21 +3,49 @@ import msgpack
 import websockets
 import logging
 
-from typing import Callable, Any, Optional
+from typing import Callable, Any, Dict, Optional
 import inspect
+import weakref
 
 from .queue import AsyncQueue
+from .. import compression
+from ..transports import Transport
+from ..transports.stream import SCHEMES, open_connection
+
+class WebSocketTransport(Transport):
+    def __init__(self, ws):
+        self.ws = ws
+
+    async def send(self, data: bytes):
+        try:
+            await self.ws.send(data)
+        except websockets.ConnectionClosed:
+            raise Transport.ConnectionClosed from None
+
+    async def receive(self) -> bytes:
+        try:
+            return await self.ws.recv()
+        except websockets.ConnectionClosedOK:
+            raise Transport.ConnectionClosed from None
+
+    async def close(self, code: int = 1000):
+        await self.ws.close(code)
 
 class EphapticClient:
-    def __init__(self, url: str, auth = None):
+    def __init__(self, url: Optional[str] = None, auth = None, window: Optional[int] = None, transport: Optional[Transport] = None):
         self.url = url
         self.auth = auth
-        self.ws = None
+        self._window = window # default stream window; `None` lets the server decide (64, unless set otherwise), 0 turns flow control off
+        self._given_transport = transport # already connected, e.g. `transports.memory.pipe()`; otherwise opened from `url`
+        self.transport: Optional[Transport] = None
         self._call_id = 0
         self._pending_calls: dict[int, asyncio.Future] = {}
-        self._pending_streams: dict[int, AsyncQueue] = {}
+        self._pending_streams: weakref.WeakValueDictionary[int, AsyncQueue] = weakref.WeakValueDictionary() # a stream nobody holds anymore is cancelled
+        self._stream_finalizers: dict[int, weakref.finalize] = {}
         self._event_handlers: dict[str, set[callable]] = {}
         self._listen_task = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._background: set[asyncio.Task] = set()
 
     def _async(self, func: Callable):
         async def wrapper(*args, **kwargs) -> Any:
@@ -28,66 +56,131 @@ class EphapticClient:
         return wrapper
 
     async def connect(self):
-        if self.ws: return
+        if self.transport: return
 
-        self.ws = await websockets.connect(self.url)
+        self.transport = self._given_transport or await self._open()
+        self._loop = asyncio.get_running_loop()
 
-        payload = {"type": "init"}
+        payload = {"type": "init", "flow": True, "multi": True, "compression": compression.available()}
         if self.auth: payload["auth"] = self.auth
 
-        await self.ws.send(msgpack.dumps(payload))
+        await self.transport.send(msgpack.dumps(payload))
 
         self._listen_task = asyncio.create_task(self._listener())
 
+    async def _open(self) -> Transport:
+        if self.url.split('://', 1)[0] in SCHEMES:
+            return await open_connection(self.url) # length-prefixed frames, no HTTP (see `from_app(listen=...)`)
+        return WebSocketTransport(await websockets.connect(self.url))
+
+    async def close(self):
+        if not self.transport: return
+        await self.transport.close()
+        if self._listen_task: self._listen_task.cancel()
+        self.transport = None
+
     async def _listener(self):
+        unpacker = msgpack.Unpacker(ext_hook=compression.ext_hook)
         try:
-            async for message in self.ws:
-                data = msgpack.loads(message)
-
-                if data.get('id') is not None:
-                    call_id = data['id']
-
-                    if data.get('stream'):
-                        stream = AsyncQueue()
-                        self._pending_streams[call_id] = stream
-
-                        if call_id in self._pending_calls:
-                            self._pending_calls[call_id].set_result(stream)
-                            del self._pending_calls[call_id]
-
-                    elif data.get('chunk'):
-                        if call_id in self._pending_streams:
-                            self._pending_streams[call_id].push(data['chunk'])
-
-                    elif data.get('done'):
-                        if call_id in self._pending_streams:
-                            self._pending_streams[call_id].close()
-                            del self._pending_streams[call_id]
-
-                    elif call_id in self._pending_calls:
-                        future = self._pending_calls.pop(call_id)
-                        if 'error' in data:
-                            future.set_exception(Exception(data['error']))
-                        else:
-                            future.set_result(data.get('result'))
-                
-                elif data.get('type') == 'event':
-                    name = data['name']
-                    payload = data.get('payload', {})
-                    args = payload.get('args', [])
-                    kwargs = payload.get('kwargs', {})
-
-                    if name in self._event_handlers:
-                        for handler in self._event_handlers[name]:
-                            try:
-                                asyncio.create_task(self._async(handler)(*args, **kwargs))
-                                # We don't await it, we want to execute all handlers in parallel.
-                            except Exception as e:
-                                logging.error(f"Error in event handler {name}: {e}")
-        
+            while True:
+                message = await self.transport.receive()
+                # A frame can hold several messages back to back, if the server coalesced them (we said `multi` in init).
+                unpacker.feed(message)
+                for data in unpacker:
+                    self._handle(data)
+
+        except Transport.ConnectionClosed:
+            ...
         except Exception as e:
             logging.error(f"Connection error: {e}")
 
+    def _handle(self, data: dict):
+        if data.get('id') is not None:
+            call_id = data['id']
+
+            if data.get('stream'):
+                if call_id in self._pending_calls:
+                    self._open_stream(call_id, data.get('window'))
+
+            elif 'chunk' in data:
+                if call_id in self._pending_streams:
+                    self._pending_streams[call_id].push(data['chunk'])
+
+            elif data.get('done'):
+                stream = self._end_stream(call_id)
+                if stream: stream.close()
+
+            elif call_id in self._pending_streams:
+                stream = self._end_stream(call_id)
+                stream.throw(Exception(data.get('error')))
+
+            elif call_id in self._pending_calls:
+                future = self._pending_calls.pop(call_id)
+                if 'error' in data:
+                    future.set_exception(Exception(data['error']))
+                else:
+                    future.set_result(data.get('result'))
+        
+        elif data.get('type') == 'batch':
+            for response in data.get('responses', []): self._handle(response)
+
+        elif data.get('type') == 'event':
+            name = data['name']
+            payload = data.get('payload', {})
+            args = payload.get('args', [])
+            kwargs = payload.get('kwargs', {})
+
+            if name in self._event_handlers:
+                for handler in self._event_handlers[name]:
+                    try:
+                        asyncio.create_task(self._async(handler)(*args, **kwargs))
+                        # We don't await it, we want to execute all handlers in parallel.
+                    except Exception as e:
+                        logging.error(f"Error in event handler {name}: {e}")
+
+    def _open_stream(self, call_id: int, window: Optional[int] = None):
+        # Done in its own frame so the listener never holds a reference to the stream:
+        # once the caller drops it, it's garbage collected and the finalizer cancels the call.
+        stream = AsyncQueue(
+            on_close=lambda: self._cancel(call_id),
+            window=window,
+            on_credit=lambda n: self._send_background({"type": "credit", "id": call_id, "n": n}),
+        )
+        self._pending_streams[call_id] = stream
+
+        finalizer = weakref.finalize(stream, self._cancel_threadsafe, call_id)
+        finalizer.atexit = False
+        self._stream_finalizers[call_id] = finalizer
+
+        self._pending_calls.pop(call_id).set_result(stream)
+
+    def _end_stream(self, call_id: int) -> Optional[AsyncQueue]:
+        finalizer = self._stream_finalizers.pop(call_id, None)
+        if finalizer: finalizer.detach()
+        return self._pending_streams.pop(call_id, None)
+
+    def _send_background(self, payload: dict):
+        # For control frames sent from sync code (or from a task that is being cancelled).
+        async def send():
+            try:
+                await self.transport.send(msgpack.dumps(payload))
+            except Exception: ... # if the connection is gone, so is the call
+
+        if self.transport:
+            task = asyncio.create_task(send())
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    def _cancel(self, call_id: int):
+        self._pending_calls.pop(call_id, None)
+        self._end_stream(call_id)
+        self._send_background({"type": "cancel", "id": call_id})
+
+    def _cancel_threadsafe(self, call_id: int):
+        # weakref finalizers run wherever the garbage collector happens to run.
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._cancel, call_id)
+
     def on(self, event_name, func: Optional[Callable] = None):
         def decorator(f):
             if event_name not in self._event_handlers: self._event_handlers[event_name] = set()
@@ -112,32 +205,133 @@ class EphapticClient:
         
         return decorator(func) if func else decorator
 
-    def __getattr__(self, name):
-        async def remote_call(*args, **kwargs):
-            if not self.ws: await self.connect()
+    def _prepare(self, name: str, args: tuple, kwargs: dict, options: Optional[dict] = None) -> tuple[int, asyncio.Future, dict]:
+        self._call_id += 1
+        call_id = self._call_id
+
+        future = asyncio.Future()
+        self._pending_calls[call_id] = future
 
-            self._call_id += 1
-            call_id = self._call_id
+        payload = {
+            "type": "rpc",
+            "id": call_id,
+            "name": name,
+            "args": args,
+            "kwargs": kwargs,
+        }
 
-            future = asyncio.Future()
-            self._pending_calls[call_id] = future
+        window = (options or {}).get('window')
+        if window is None: window = self._window
+        if window is not None: payload["window"] = window
 
-            payload = {
-                "type": "rpc",
-                "id": call_id,
-                "name": name,
-                "args": args,
-                "kwargs": kwargs,
-            }
+        trace = (options or {}).get('trace')
+        if trace: payload["trace"] = trace
 
-            await self.ws.send(msgpack.dumps(payload))
+        return call_id, future, payload
+
+    async def call(self, name: str, /, *args, _options: Optional[dict] = None, **kwargs):
+        if not self.transport: await self.connect()
+
+        call_id, future, payload = self._prepare(name, args, kwargs, _options)
+        await self.transport.send(msgpack.dumps(payload))
+
+        try:
             return await future
+        except asyncio.CancelledError:
+            # The caller gave up on this call, so tell the server to stop working on it.
+            self._cancel(call_id)
+            raise
+
+    def options(self, *, window: Optional[int] = None, trace: Optional[Dict[str, str]] = None) -> 'CallOptions':
+        """
+        Per-call settings, e.g. `await client.options(window=16).numbers()`.
+
+        `window` is how many stream chunks may be buffered client-side before the server pauses
+        (0 for no limit).
+        `trace` is a trace context for the server's tracing hooks to continue, e.g. W3C
+        `{'traceparent': ...}` (with OpenTelemetry, what `propagate.inject` fills in).
+        """
+        return CallOptions(self, {'window': window, 'trace': trace})
+
+    def batch(self, mode: str = 'single') -> 'Batch':
+        """
+        Collect calls and send them to the server together, in one frame:
+
+            async with client.batch() as batch:
+                user = batch.get_user(1)
+                posts = batch.get_posts(1)
+            print(user.result(), posts.result())
+
+        Calls made on the batch return futures, which are resolved by the time the block exits.
+        With `mode='single'` the server answers them all in one frame, once the last one finishes.
+        With `mode='stream'` each response is sent as soon as it's ready.
+        """
+        return Batch(self, mode)
+
+    def __getattr__(self, name):
+        async def remote_call(*args, **kwargs):
+            return await self.call(name, *args, **kwargs)
         
         return remote_call
 
 
+class Batch:
+    def __init__(self, client: EphapticClient, mode: str = 'single'):
+        self._client = client
+        self._mode = mode
+        self._calls: list[tuple[asyncio.Future, dict]] = []
+
+    async def __aenter__(self):
+        if not self._client.transport: await self._client.connect()
+        return self
+
+    async def __aexit__(self, exc_type, *exc):
+        if exc_type: # don't send half a batch
+            for future, payload in self._calls:
+                self._client._pending_calls.pop(payload["id"], None)
+                future.cancel()
+            return
+        await self.flush()
+
+    async def flush(self):
+        calls, self._calls = self._calls, []
+        if not calls: return
+
+        await self._client.transport.send(msgpack.dumps({
+            "type": "batch",
+            "mode": self._mode,
+            "calls": [payload for _, payload in calls],
+        }))
+
+        try:
+            await asyncio.gather(*(future for future, _ in calls), return_exceptions=True)
+        except asyncio.CancelledError:
+            for future, payload in calls:
+                if not future.done(): self._client._cancel(payload["id"])
+            raise
+
+    def __getattr__(self, name):
+        def queue_call(*args, **kwargs) -> asyncio.Future:
+            _, future, payload = self._client._prepare(name, args, kwargs)
+            self._calls.append((future, payload))
+            return future
+
+        return queue_call
+
+
+class CallOptions:
+    def __init__(self, client: EphapticClient, options: dict):
+        self._client = client
+        self._options = options
+
+    def __getattr__(self, name):
+        async def remote_call(*args, **kwargs):
+            return await self._client.call(name, *args, _options=self._options, **kwargs)
+
+        return remote_call
+
 
-async def connect(url: str = "ws://localhost:8000/_ephaptic", auth = None):
-    client = EphapticClient(url, auth)
+async def connect(url: str = "ws://localhost:8000/_ephaptic", auth = None, window: Optional[int] = None):
+    client = EphapticClient(url, auth, window=window)
     await client.connect()
-    return client
\ No newline at end of file
+    return client
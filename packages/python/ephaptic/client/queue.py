@@ -1,28 +1,71 @@
 import asyncio
+from typing import Callable, Optional
 
 class AsyncQueue:
-    def __init__(self):
+    def __init__(
+        self,
+        on_close: Optional[Callable[[], None]] = None,
+        window: Optional[int] = None,
+        on_credit: Optional[Callable[[int], None]] = None,
+    ):
         self._queue = asyncio.Queue()
+        self._on_close = on_close
+
+        # With a window, the server only sends as many chunks as we've granted, so this queue
+        # never holds more than `window` of them. Credits go back in batches of half a window.
+        self._window = window
+        self._on_credit = on_credit
+        self._consumed = 0
+        self._done = False # the server has finished the stream
+        self._closed = False # the consumer has stopped reading
 
     def __aiter__(self):
         return self
     
     async def __anext__(self):
-        chunk = await self._queue.get()
+        if self._closed:
+            raise StopAsyncIteration
+
+        try:
+            chunk = await self._queue.get()
+        except asyncio.CancelledError:
+            # The consumer's task was cancelled, nobody is going to read the rest.
+            await self.aclose()
+            raise
         
         if chunk is StopAsyncIteration:
             raise StopAsyncIteration
         
         if isinstance(chunk, Exception):
             raise chunk
+
+        if self._window and self._on_credit:
+            self._consumed += 1
+            if self._consumed >= max(1, self._window // 2):
+                self._on_credit(self._consumed)
+                self._consumed = 0
         
         return chunk
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        """Stop the stream early. The server is told to cancel the call and close its generator."""
+        if self._closed: return
+        self._closed = True
+        if not self._done and self._on_close: self._on_close()
     
     def push(self, data):
         self._queue.put_nowait(data)
 
     def close(self):
+        self._done = True
         self._queue.put_nowait(StopAsyncIteration)
 
     def throw(self, error: Exception):
-        self._queue.put_nowait(error)
\ No newline at end of file
+        self._done = True
+        self._queue.put_nowait(error)
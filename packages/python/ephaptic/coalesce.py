@@ -0,0 +1,129 @@
+import asyncio
+import contextvars
+import hashlib
+import time
+import typing
+import uuid
+from typing import Any, Callable, Dict, Hashable, Optional, Union
+
+import msgpack
+import redis.asyncio as redis
+
+from .cache import call_key
+from .ctx import _active_transport_ctx, _active_user_ctx
+
+CoalesceSpec = Union[bool, Dict[str, Any]]
+
+# Deletes the lock only if it's still ours (it may have expired and been taken by another node).
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class Coalescer:
+    """
+    Single-flight for one exposed function: concurrent calls with equal (validated) arguments
+    share one execution, and all of them get its result (or its error).
+
+    With `distributed`, nodes also agree through a Redis lock on which one of them runs it.
+    The others poll for the result, which is kept for `result_ttl` seconds once it's ready. If
+    the lock holder doesn't finish within `lock_ttl` seconds (or Redis is down), they run it
+    themselves.
+
+    The shared execution doesn't belong to any one caller: it runs with no connection, and no
+    user unless `per_user` (when everyone sharing it is the same user). Otherwise whoever came
+    first would decide what `active_user()` returns for all of them.
+    """
+
+    poll_interval = 0.02
+
+    def __init__(self, name: str, per_user: bool = False, distributed: bool = False, lock_ttl: float = 10, result_ttl: float = 1):
+        self.name = name
+        self.per_user = per_user
+        self.distributed = distributed
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self._flights: Dict[Hashable, _Flight] = {}
+
+        self.executions = 0
+        self.shared = 0 # calls that got the result of someone else's execution
+
+    @classmethod
+    def of(cls, name: str, spec: CoalesceSpec) -> 'Coalescer':
+        # `coalesce=True`, or `coalesce={'per_user': True, 'distributed': True}`
+        if isinstance(spec, dict): return cls(name, **spec)
+        return cls(name)
+
+    def key(self, arguments: Dict[str, Any], uid: Optional[str] = None) -> Hashable:
+        return call_key(arguments, uid if self.per_user else None)
+
+    async def run(self, key: Hashable, func: Callable[..., typing.Awaitable[Any]], *args, client: Optional[redis.Redis] = None):
+        flight = self._flights.get(key)
+        if flight is None:
+            work = self._across_nodes(key, func, args, client) if self.distributed and client else self._execute(func, args)
+            flight = self._flights[key] = _Flight(self._context().run(asyncio.create_task, work))
+            flight.task.add_done_callback(lambda _: self._flights.pop(key, None) if self._flights.get(key) is flight else None)
+        else:
+            self.shared += 1
+
+        flight.waiters += 1
+        try:
+            # Shielded, so one caller going away (e.g. a `cancel` frame) doesn't cancel it for the rest...
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            # ...unless nobody is left waiting for it.
+            if not flight.waiters and not flight.task.done(): flight.task.cancel()
+
+    def _context(self) -> contextvars.Context:
+        context = contextvars.copy_context()
+        context.run(_active_transport_ctx.set, None)
+        if not self.per_user: context.run(_active_user_ctx.set, None)
+        return context
+
+    async def _execute(self, func, args):
+        self.executions += 1
+        return await func(*args)
+
+    async def _across_nodes(self, key: Hashable, func, args, client: redis.Redis):
+        lock = f'ephaptic:sf:{self.name}:{hashlib.sha256(repr(key).encode()).hexdigest()}'
+        done = lock + ':result'
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_ttl
+
+        while time.monotonic() < deadline:
+            try:
+                encoded = await client.get(done)
+                acquired = encoded is None and await client.set(lock, token, nx=True, px=int(self.lock_ttl * 1000))
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                break
+
+            if encoded is not None:
+                self.shared += 1
+                return msgpack.loads(encoded)
+
+            if acquired:
+                try:
+                    result = await self._execute(func, args)
+                    try:
+                        await client.set(done, msgpack.dumps(result), px=int(self.result_ttl * 1000))
+                    except Exception: ... # the others run it themselves once the lock is released
+                    return result
+                finally:
+                    try:
+                        await client.eval(_RELEASE, 1, lock, token)
+                    except Exception: ... # it expires on its own
+
+            await asyncio.sleep(self.poll_interval)
+
+        return await self._execute(func, args)
+
+    def stats(self) -> Dict[str, typing.Any]:
+        return {'executions': self.executions, 'shared': self.shared, 'in_flight': len(self._flights)}
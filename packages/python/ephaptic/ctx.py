@@ -3,6 +3,7 @@ from contextvars import ContextVar
 _scope_ctx = ContextVar('ephaptic_scope', default='rpc')
 _active_transport_ctx = ContextVar('active_transport', default=None)
 _active_user_ctx = ContextVar('active_user', default=None)
+_emit_lane_ctx = ContextVar('emit_lane', default=0) # outbound lane of the current call (responses, or chunks), so `emit` stays in order with it
 
 def is_http() -> bool: return _scope_ctx.get() == 'http'
 def is_rpc()  -> bool: return _scope_ctx.get() == 'rpc'
@@ -1,7 +1,7 @@
 from typing import *
 import inspect
 import pydantic
-from .utils import parse_limit
+from .utils import parse_limits
 
 F = TypeVar('F', bound=Callable[..., Any])
 M = TypeVar('M', bound=Type[pydantic.BaseModel])
@@ -22,9 +22,14 @@ class Expose:
         *,
         name: Optional[str] = None,
         response_model: Optional[type] = None,
-        rate_limit: Optional[str] = None,
+        rate_limit: Optional[Union[str, Dict[str, str]]] = None,
         hints: Optional[dict[str, Any]] = None,
         sig: Optional[inspect.Signature] = None,
+        ordered: bool = False,
+        window: Optional[int] = None,
+        cache: Optional[Union[int, float, Dict[str, Any]]] = None,
+        coalesce: Union[bool, Dict[str, Any]] = False,
+        executor: Optional[str] = None,
     ):
         ...
 
@@ -32,7 +37,11 @@ class Expose:
         def inject(f: F) -> F:
             self.registry[kwargs.get('name') or f.__name__] = f
 
-            if kwargs.get('rate_limit'): kwargs['rate_limit'] = parse_limit(kwargs['rate_limit'])
+            if kwargs.get('rate_limit'): kwargs['rate_limit'] = parse_limits(kwargs['rate_limit'])
+            if kwargs.get('executor') and (inspect.iscoroutinefunction(f) or inspect.isasyncgenfunction(f) or (inspect.isgeneratorfunction(f) and kwargs['executor'] != 'process')):
+                raise TypeError(f"executor= only applies to sync functions (and sync generators, with executor='process'), and {f.__name__} isn't one.")
+            if kwargs.get('cache') and (inspect.isgeneratorfunction(f) or inspect.isasyncgenfunction(f)):
+                raise TypeError(f"cache= only applies to functions that return a result, and {f.__name__} streams.")
 
             meta = getattr(f, META_KEY, {})
             meta.update(kwargs)
@@ -0,0 +1,48 @@
+import struct
+import msgpack
+import pydantic
+from typing import Dict, List, Tuple
+
+_HEADER_SIZE = struct.Struct('>I')
+
+class PreparedEvent:
+    """
+    An event encoded once, ready to be sent to any number of clients as-is.
+
+    Get one from `ephaptic.prepare(...)` and pass it to `ephaptic.to(...).emit(...)` as many
+    times as you like, e.g. to send the same update to several groups of users.
+    """
+
+    def __init__(self, name: str, frame: bytes):
+        self.name = name
+        self.frame = frame # the client frame, exactly as it goes on the wire
+        self.compressed: Dict[str, bytes] = {} # per codec, see `compression.compress`
+
+    @classmethod
+    def encode(cls, name: str, args: list, kwargs: dict) -> 'PreparedEvent':
+        return cls(name, msgpack.dumps({
+            'type': 'event',
+            'name': name,
+            'payload': {'args': args, 'kwargs': kwargs},
+        }))
+
+    @classmethod
+    def of(cls, event_instance: pydantic.BaseModel) -> 'PreparedEvent':
+        return cls.encode(event_instance.__class__.__name__, [], event_instance.model_dump(mode='json'))
+
+    def __repr__(self):
+        return f'<PreparedEvent {self.name} ({len(self.frame)} bytes)>'
+
+# What goes over Redis: `[u32 header length][msgpack {"targets": [...]}][client frame]`. Nodes
+# only decode the (small) header, and write the frame to their clients without touching it, so
+# clients never see who else an event was sent to.
+
+def pack(targets: List[str], frame: bytes) -> bytes:
+    header = msgpack.dumps({'targets': targets})
+    return _HEADER_SIZE.pack(len(header)) + header + frame
+
+def unpack(envelope: bytes) -> Tuple[List[str], bytes]:
+    (size,) = _HEADER_SIZE.unpack_from(envelope)
+    start = _HEADER_SIZE.size
+    header = msgpack.loads(envelope[start:start + size])
+    return header.get('targets', []), envelope[start + size:]
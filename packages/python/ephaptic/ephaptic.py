@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import warnings
 import msgpack
 import redis.asyncio as redis
@@ -7,12 +8,24 @@ import time
 
 from contextvars import ContextVar
 from .localproxy import LocalProxy
+from . import compression
 
 from .transports import Transport
+from .transports.outbound import RESPONSE, CHUNK, EVENT, POLICIES
+from .transports.stream import Listeners
 
 from .decorators import META_KEY, Expose, Event, IdentityLoader
-
-from .ctx import _scope_ctx, _active_transport_ctx, _active_user_ctx
+from .utils import Limit
+from . import cache, envelope, metrics, ratelimit, tracing
+from .envelope import PreparedEvent
+from .executors import STREAMS, ExecutorOverloaded, Pool, pool_of
+from .plan import CallPlan, ReturnValidationError, invoker
+from .identity import IdentityCache
+from .presence import Presence
+from .session import Session
+from .streams import SyncStream
+
+from .ctx import _scope_ctx, _active_transport_ctx, _active_user_ctx, _emit_lane_ctx
 
 import typing
 from typing import Optional, Callable, Any, List, Set, Dict
@@ -26,63 +39,96 @@ class ConnectionManager:
     def __init__(self):
         self.active: Dict[str, Set[Transport]] = {} # Map[user_id, Set[Transport]]
         self.redis: Optional[redis.Redis] = None
+        self.presence: Optional[Presence] = None
+        self.counters: typing.Counter[str] = collections.Counter() # dropped / delayed / disconnected, across all connections
 
     def init_redis(self, url: str):
         self.redis = redis.from_url(url)
+        self.presence = Presence(self.redis)
 
-    def add(self, user_id: str, transport: Transport):
+    async def add(self, user_id: str, transport: Transport):
         if user_id not in self.active: self.active[user_id] = set()
         self.active[user_id].add(transport)
-
-    def remove(self, user_id: str, transport: Transport):
+        if self.presence and len(self.active[user_id]) == 1:
+            try:
+                await self.presence.join(user_id)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    async def remove(self, user_id: str, transport: Transport):
         if user_id in self.active:
             self.active[user_id].discard(transport)
-            if not self.active[user_id]: del self.active[user_id]
+            if not self.active[user_id]:
+                del self.active[user_id]
+                if self.presence:
+                    try:
+                        await self.presence.leave(user_id)
+                    except Exception: ... # the lease runs out on its own
 
     async def broadcast(self, user_ids: List[str], event_name: str, args: list, kwargs: dict):
-        payload = msgpack.dumps({
-            "target_users": user_ids,
-            "type": "event",
-            "name": event_name,
-            "payload": {"args": args, "kwargs": kwargs}
-        })
+        await self.deliver(user_ids, PreparedEvent.encode(event_name, args, kwargs))
+
+    async def deliver(self, user_ids: List[str], event: PreparedEvent):
+        if self.redis: await self._publish(user_ids, event.frame)
+        else: self._send(user_ids, event.frame, event.compressed)
+
+    async def _publish(self, user_ids: List[str], frame: bytes):
+        # Only to the nodes that actually hold these users, rather than every node in the cluster.
+        try:
+            routes = await self.presence.locate(user_ids)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            routes = {CHANNEL_NAME: user_ids} # presence unknown, let every node check
 
-        if self.redis: await self.redis.publish(CHANNEL_NAME, payload)
-        else: await self._send(user_ids, payload)
+        for channel, targets in routes.items():
+            await self.redis.publish(channel, envelope.pack(targets, frame))
 
-    async def _send(self, user_ids: list[str], payload: bytes):
+    def _send(self, user_ids: List[str], frame: bytes, compressed: Optional[Dict[str, bytes]] = None):
+        if compressed is None: compressed = {} # compressed at most once per codec, however many recipients there are
+        fanout = 0
         for user_id in user_ids:
             if user_id in self.active:
                 for transport in list(self.active[user_id]):
-                    asyncio.create_task(self._safe_send(transport, payload))
-
-    async def _safe_send(self, transport: Transport, payload: bytes):
-        try:
-            await transport.send(payload)
-        except: ...
+                    # Queued on the connection's own writer, behind any RPC responses. If the event
+                    # lane is full the client isn't keeping up, and its `slow_consumer_policy` applies.
+                    if transport.outbound and not transport.outbound.closed:
+                        transport.outbound.post(transport.outbound.encode(frame, compressed), EVENT)
+                        fanout += 1
+        metrics.broadcast_fanout.observe(fanout)
 
     async def start_redis(self):
         if not self.redis: return
-        pubsub = self.redis.pubsub()
-        await pubsub.subscribe(CHANNEL_NAME)
-        async for message in pubsub.listen():
-            if message['type'] == 'message':
-                data = msgpack.loads(message['data'])
-                targets = data.get('target_users', [])
-                await self._send(targets, message['data'])
+        heartbeat = asyncio.create_task(self.presence.heartbeat())
+        try:
+            pubsub = self.redis.pubsub()
+            await pubsub.subscribe(CHANNEL_NAME, self.presence.channel)
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    try:
+                        targets, frame = envelope.unpack(message['data'])
+                    except Exception:
+                        import traceback
+                        traceback.print_exc()
+                        continue
+                    self._send(targets, frame)
+        finally:
+            heartbeat.cancel()
 
 manager = ConnectionManager()
 
+metrics.registry.gauge('ephaptic_users', 'Users with at least one open connection.', collect=lambda: {(): len(manager.active)})
+metrics.registry.counter(
+    'ephaptic_slow_consumer_total', 'Events dropped or delayed, and connections closed, because clients fell behind.', ('what',),
+    collect=lambda: {(what,): n for what, n in manager.counters.items()},
+)
+
 _EXPOSED_FUNCTIONS = {}
 _EXPOSED_EVENTS = {}
 _IDENTITY_LOADER: Optional[Callable] = None
 _HTTP_IDENTITY_LOADER: Optional[Callable] = None
 
-_LOCAL_RATELIMIT_CACHE: Dict[str, List] = {} # [hits, expire_at]
-# if redis isn't set up, assume that this is the only instance [no 'multiple nodes'] so ratelimits can be stored in memory.
-# only used when Redis isn't set.
-_LAST_CACHE_CLEANUP = time.time() # for manual cleaning up of the cache
-
 class RatelimitExceededException(Exception):
     retry_after: int
 
@@ -94,15 +140,9 @@ class EphapticTarget:
     def __init__(self, user_ids: list[str]):
         self.user_ids = user_ids
 
-    async def emit(self, event_instance: pydantic.BaseModel):
-        event_name = event_instance.__class__.__name__
-        payload = event_instance.model_dump(mode='json')
-        await manager.broadcast(
-            self.user_ids,
-            event_name,
-            args=[],
-            kwargs=payload,
-        )
+    async def emit(self, event: typing.Union[pydantic.BaseModel, PreparedEvent]):
+        if not isinstance(event, PreparedEvent): event = PreparedEvent.of(event)
+        await manager.deliver(self.user_ids, event)
 
     def __getattr__(self, name: str):
         async def emitter(*args, **kwargs):
@@ -128,32 +168,74 @@ class Ephaptic:
     _identity_loader: Optional[Callable] = None
     _http_identity_loader: Optional[Callable] = None
 
+    max_inflight: int = 64 # concurrent RPCs per connection
+    max_queued: int = 1024 # RPCs per connection waiting for one of those, before new ones are refused
+    stream_window: int = 64 # stream chunks sent ahead of what the client read, if it does flow control; 0 is no limit
+    compression_threshold: Optional[int] = 1024 # bytes; `None` turns compression off
+    slow_consumer_policy: str = 'drop_oldest' # or 'drop_newest', 'disconnect'
+    event_queue_size: int = 1024 # queued events per connection before the policy kicks in
+    rate_limit_algorithm: str = 'gcra' # or 'sliding_window', see `ratelimit.Limiter`
+    rate_limit_mode: str = 'exact' # or 'hybrid', see `ratelimit.HybridLimiter`. Only matters with Redis.
+    rate_limit_slice: float = 0.1 # hybrid mode: fraction of a limit each node leases at once
+    identity_cache: Optional[IdentityCache] = None
+    http_paths: Optional[typing.Tuple[str, ...]] = None # path prefixes that get the HTTP context (`None` is all of them)
+    metrics_path: Optional[str] = None # where the adapters serve `metrics.registry` in the Prometheus format, if anywhere
+    listeners: Optional[Listeners] = None # raw TCP/Unix socket servers started with the app, see `from_app(listen=...)`
+
     expose: Expose
     event: Event
     identity_loader: IdentityLoader
     http_identity_loader: IdentityLoader
 
     def _async(self, func: Callable):
-        async def wrapper(*args, **kwargs) -> Any:
-            if inspect.iscoroutinefunction(func):
-                return await func(*args, **kwargs)
-            elif inspect.isasyncgenfunction(func) or inspect.isgeneratorfunction(func):
-                return func(*args, **kwargs)
-            else:
-                return await asyncio.to_thread(func, *args, **kwargs)
-        return wrapper
+        return invoker(func)
 
     def __init__(self):
-        ...
+        self._plans: Dict[str, CallPlan] = {}
+        self._limiter: Optional[ratelimit.Limiter] = None
+        self.executors: Dict[str, Pool] = {} # named pools for `@expose(executor=...)`
 
     @classmethod
-    def from_app(cls, app, path="/_ephaptic", redis_url=None):
+    def from_app(
+        cls, app, path="/_ephaptic", redis_url=None, max_inflight=64, compression_threshold=1024,
+        slow_consumer_policy='drop_oldest', event_queue_size=1024,
+        rate_limit_algorithm='gcra', rate_limit_mode='exact', rate_limit_slice=0.1,
+        identity_cache=None, http_paths=None, executors=None, metrics_path=None, listen=None,
+        max_queued=1024, stream_window=64,
+    ):
         # `app` could be ~Flask~, Quart, FastAPI, etc.
+        if slow_consumer_policy not in POLICIES:
+            raise ValueError(f"Unknown slow_consumer_policy: {slow_consumer_policy!r}. Expected one of {POLICIES}.")
+
         instance = cls()
+        instance.max_inflight = max_inflight
+        instance.max_queued = max_queued
+        instance.stream_window = stream_window
+        instance.compression_threshold = compression_threshold
+        instance.slow_consumer_policy = slow_consumer_policy
+        instance.event_queue_size = event_queue_size
+        instance.rate_limit_algorithm = ratelimit.algorithm_of(rate_limit_algorithm)
+        if rate_limit_mode not in ratelimit.MODES:
+            raise ValueError(f"Unknown rate_limit_mode: {rate_limit_mode!r}. Expected one of {ratelimit.MODES}.")
+        instance.rate_limit_mode = rate_limit_mode
+        instance.rate_limit_slice = rate_limit_slice
+
+        if http_paths is not None: instance.http_paths = tuple(http_paths)
+        instance.metrics_path = metrics_path
+
+        if listen: # e.g. 'tcp://127.0.0.1:9000' or 'unix:///run/app.sock', or several
+            instance.listeners = Listeners(instance, [listen] if isinstance(listen, str) else listen)
+
+        for name, spec in (executors or {}).items():
+            instance.executors[name] = pool_of(name, spec)
 
         if redis_url:
             manager.init_redis(redis_url)
 
+        if identity_cache:
+            instance.identity_cache = IdentityCache.of(identity_cache)
+            if instance.identity_cache.use_redis: instance.identity_cache.redis = manager.redis
+
         module = app.__class__.__module__.split(".")[0]
 
         match module:
@@ -178,42 +260,31 @@ class Ephaptic:
 
         return instance
     
-    async def _check_ratelimit(self, func_name: str, limit: tuple[int, int], uid: str = None, ip: str = None):
-        max_reqs, window = limit
-        identifier = f'u:{uid}' if uid else f'ip:{ip}'
-        now = time.time()
-        current_window = int(now // window)
-        reset = (current_window + 1) * window
-        key = f'ephaptic:rl:{func_name}:{identifier}:{current_window}'
-
-        if manager.redis:
-            pipe = manager.redis.pipeline()
-            pipe.incr(key)
-            pipe.expire(key, window + 1)
-            results = await pipe.execute()
-            hits = results[0]
-        else:
-            global _LAST_CACHE_CLEANUP
-            if (now - _LAST_CACHE_CLEANUP) > 60:
-                for k in [
-                    k for k, v in _LOCAL_RATELIMIT_CACHE.items()
-                    if v[1] < now
-                ]: del _LOCAL_RATELIMIT_CACHE[k]
-                _LAST_CACHE_CLEANUP = now
-
-            entry = _LOCAL_RATELIMIT_CACHE.get(key)
-            if not entry:
-                entry = [0, reset]
-                _LOCAL_RATELIMIT_CACHE[key] = entry
-
-            entry[0] += 1
-            hits = entry[0]
-
-        if hits > max_reqs:
-            retry_after = max(1, int(reset - now))
+    async def _load_identity(self, kind: str, payload):
+        # `payload` is the `auth` from `init` for 'ws', and the request for 'http'.
+        loader = self._identity_loader if kind == 'ws' else self._http_identity_loader
+        load = lambda: self._async(loader)(payload)
+        if self.identity_cache is None: return await load()
+        if kind == 'http' and self.identity_cache.http_token is None: return await load() # we don't know what it authenticates with
+
+        token = payload if kind == 'ws' else self.identity_cache.http_token(payload)
+        return await self.identity_cache.resolve(kind, token, load)
+
+    @property
+    def limiter(self) -> ratelimit.Limiter:
+        # If redis isn't set up, assume that this is the only instance [no 'multiple nodes'] so ratelimits can be stored in memory.
+        if self._limiter is None:
+            if not manager.redis: self._limiter = ratelimit.LocalLimiter(self.rate_limit_algorithm)
+            elif self.rate_limit_mode == 'hybrid': self._limiter = ratelimit.HybridLimiter(manager.redis, self.rate_limit_algorithm, slice=self.rate_limit_slice)
+            else: self._limiter = ratelimit.RedisLimiter(manager.redis, self.rate_limit_algorithm)
+        return self._limiter
+
+    async def _check_ratelimit(self, func_name: str, limit: typing.Union[Limit, Dict[str, Limit]], uid: str = None, ip: str = None):
+        retry_after = await self.limiter.hit(ratelimit.checks_for(func_name, limit, uid=uid, ip=ip))
+        if retry_after:
+            retry_after = ratelimit.retry_seconds(retry_after)
             raise RatelimitExceededException(f'Rate Limit exceeded. Try again in {retry_after} seconds.', retry_after=retry_after)
 
-    
     def to(self, *args):
         targets = []
         for arg in args:
@@ -221,38 +292,59 @@ class Ephaptic:
             else: targets.append(arg)
         return EphapticTarget(targets)
        
-    async def emit(self, event_instance: pydantic.BaseModel):
-        event_name = event_instance.__class__.__name__
-        payload = event_instance.model_dump(mode='json')
+    def prepare(self, event_instance: pydantic.BaseModel) -> PreparedEvent:
+        """Encode an event once, to `emit` it to several targets without re-encoding it each time."""
+        return PreparedEvent.of(event_instance)
+
+    async def emit(self, event: typing.Union[pydantic.BaseModel, PreparedEvent]):
+        if not isinstance(event, PreparedEvent): event = PreparedEvent.of(event)
         transport: Transport = _active_transport_ctx.get()
         if not transport:
             raise RuntimeError(
-                f".emit({event_name}) called outside RPC context."
-                f"Use .to(...).emit({event_name}) to broadcast from background tasks, to specific user(s)."
+                f".emit({event.name}) called outside RPC context."
+                f"Use .to(...).emit({event.name}) to broadcast from background tasks, to specific user(s)."
             )
-        
-        # NOTE: There is slight duplication here and in the EphapticTarget. Perhaps make these functions internally route to EphapticTargets but pass the transport to use?
-        
-        await transport.send(msgpack.dumps({
-            'type': 'event',
-            'name': event_name,
-            'payload': {'args': [], 'kwargs': payload}
-        }))
+
+        # If the connection is gone, so is the event, like with broadcasts.
+        outbound = transport.outbound
+        if not outbound: return
+        try:
+            # On the lane of the call that emitted it (responses, or chunks in a stream), not the
+            # event lane like broadcasts, so the caller gets it in order with what that call sends.
+            await outbound.send(outbound.encode(event.frame, event.compressed), _emit_lane_ctx.get())
+        except Transport.ConnectionClosed: ...
     
     async def handle_transport(self, transport: Transport):
-        current_uid = None
+        session = Session(
+            transport,
+            max_inflight=self.max_inflight,
+            max_queued=self.max_queued,
+            max_events=self.event_queue_size,
+            policy=self.slow_consumer_policy,
+            counters=manager.counters,
+        )
+        metrics.connections.inc()
         try:
             raw = await transport.receive()
+            metrics.bytes_received.inc(n=len(raw))
             init = msgpack.loads(raw)
 
-            if init.get('type') == 'init':
+            is_init = init.get('type') == 'init'
+            session.start(
+                multi=is_init and bool(init.get('multi')),
+                codec=compression.negotiate(init.get('compression')) if is_init else None,
+                compress_threshold=self.compression_threshold,
+            )
+
+            if is_init:
+                session.flow = bool(init.get('flow')) # client replenishes stream credits
                 try:
                     if self._identity_loader:
-                        current_uid = await self._async(self._identity_loader)(init.get('auth'))
+                        session.uid = await self._load_identity('ws', init.get('auth'))
                     
-                    if current_uid:
-                        _active_user_ctx.set(current_uid)
-                        manager.add(current_uid, transport)
+                    if session.uid:
+                        _active_user_ctx.set(session.uid)
+                        await manager.add(session.uid, transport)
                     else:
                         pass
                 except Exception:
@@ -261,207 +353,343 @@ class Ephaptic:
 
             while True:
                 raw = await transport.receive()
+                metrics.bytes_received.inc(n=len(raw))
+                decoded_at = time.time_ns() if tracing.hooks else None
                 data = msgpack.loads(raw)
 
-                if data.get('type') == 'rpc':
-                    call_id = data.get('id')
-                    func_name = data.get('name')
-                    args = data.get('args', [])
-                    kwargs = data.get('kwargs', {}) # Note: Only Python client (currently) sends these, JS client does not.
+                match data.get('type'):
+                    case 'rpc':
+                        await self._spawn_rpc(session, data, decoded=(decoded_at, time.time_ns()) if decoded_at else None)
+                    case 'batch':
+                        await self._dispatch_batch(session, data)
+                    case 'cancel':
+                        session.cancel(data.get('id'))
+                    case 'credit':
+                        session.grant(data.get('id'), data.get('n', 0))
+        except (asyncio.CancelledError, Transport.ConnectionClosed):
+            ...
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        finally:
+            metrics.connections.dec()
+            if session.uid: await manager.remove(session.uid, transport)
+            await session.close()
+
+    async def _dispatch_batch(self, session: Session, data: dict):
+        # Each call in the batch is an ordinary rpc: it runs concurrently, and counts towards `max_inflight`.
+        calls = [call for call in data.get('calls', []) if isinstance(call, dict)]
+
+        if data.get('mode') == 'stream':
+            # Answered in completion order, as separate messages (which the outbound queue will coalesce).
+            for call in calls: await self._spawn_rpc(session, call)
+            return
+
+        # Otherwise, collect every response into one `batch` message. Stream frames aren't held back.
+        responses = []
+        async def collect(message: dict, lane: int = RESPONSE):
+            if lane == RESPONSE: responses.append(message)
+            else: await session.send(message, lane)
+
+        tasks = [task for call in calls if (task := await self._spawn_rpc(session, call, collect))]
+
+        async def reply():
+            if tasks: await asyncio.wait(tasks)
+            await session.send({'type': 'batch', 'responses': responses})
+
+        await session.spawn(None, reply, gated=False)
+
+    async def _spawn_rpc(self, session: Session, data: dict, send: Optional[Callable] = None, decoded: Optional[typing.Tuple[int, int]] = None) -> Optional[asyncio.Task]:
+        func = self._exposed_functions.get(data.get('name'))
+        ordered = getattr(func, META_KEY, {}).get('ordered', False)
+        if session.backlogged:
+            # Refused straight from the receive loop, which has to keep going for `cancel` and `credit`.
+            metrics.rpc_calls.inc(data.get('name') if func else '<unknown>', 'overloaded')
+            await (send or session.send)({
+                "id": data.get('id'),
+                "error": {
+                    "code": "OVERLOADED",
+                    "message": "Too many calls in flight on this connection.",
+                    "data": { "max_inflight": self.max_inflight },
+                },
+            })
+            return None
+        return await session.spawn(data.get('id'), self._dispatch, session, data, send, decoded, ordered=ordered)
+
+    def invalidate(self, func: typing.Union[str, Callable], *args, _user: Optional[str] = None, **kwargs):
+        """
+        Drop cached results of a function exposed with `cache=...`.
+
+        With no arguments, everything cached for it goes. Otherwise just the entry for those
+        arguments (and for `_user`, if it's cached per user).
+        """
+        name = func if isinstance(func, str) else next((name for name, f in self._exposed_functions.items() if f is func), None)
+        plan = self._plan(name) if name else None
+        if plan is None or plan.cache is None: raise ValueError(f"{func!r} isn't an exposed function with a cache.")
+
+        if not args and not kwargs and _user is None: plan.cache.invalidate()
+        else: plan.cache.invalidate(plan.cache.key(plan.bind(list(args), kwargs), _user))
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: plan.cache.stats() for name, plan in self._plans.items() if plan.cache}
+
+    def coalesce_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: plan.coalesce.stats() for name, plan in self._plans.items() if plan.coalesce}
+
+    def executor(self, name: str) -> Pool:
+        """The pool called `name`. Ones that weren't configured in `from_app(executors=...)` get the defaults."""
+        if name not in self.executors: self.executors[name] = pool_of(name)
+        return self.executors[name]
+
+    def executor_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: pool.stats() for name, pool in self.executors.items()}
+
+    def shutdown_executors(self):
+        """Stops every pool's workers (see `shutdown`)."""
+        for pool in self.executors.values(): pool.shutdown()
+
+    async def shutdown(self):
+        """Stops the pools, and anything the rate limiter runs in the background. The adapters call this when the app shuts down."""
+        self.shutdown_executors()
+        if self._limiter: await self._limiter.close()
+
+    def _plan(self, func_name: str) -> Optional[CallPlan]:
+        func = self._exposed_functions.get(func_name)
+        if func is None: return None
+
+        plan = self._plans.get(func_name)
+        if plan is None or plan.func is not func: # compiled lazily, and recompiled if the name was re-exposed
+            executor = getattr(func, META_KEY, {}).get('executor')
+            plan = self._plans[func_name] = CallPlan(func_name, func, self.executor(executor) if executor else None)
+        return plan
+
+    async def _dispatch(self, session: Session, data: dict, send: Optional[Callable] = None, decoded: Optional[typing.Tuple[int, int]] = None):
+        func_name = data.get('name')
+        label = func_name if func_name in self._exposed_functions else '<unknown>' # client-chosen names would blow up the label set
+        outcome, error = 'cancelled', None
+        metrics.rpc_inflight.inc(label)
+        start = time.perf_counter()
+
+        span = tracing.start('rpc', call_id=data.get('id'), function=label, user=session.uid, trace=data.get('trace'), start_ns=decoded and decoded[0]) if tracing.hooks else None
+        if span and decoded: tracing.record(span, tracing.DECODE, *decoded)
+        try:
+            outcome = await self._call(session, data, send, span)
+        except Exception as e:
+            outcome, error = 'error', e
+            raise
+        finally:
+            metrics.rpc_duration.observe(time.perf_counter() - start, label)
+            metrics.rpc_inflight.dec(label)
+            metrics.rpc_calls.inc(label, outcome)
+            if span: tracing.end(span, error, outcome=outcome)
+
+    async def _call(self, session: Session, data: dict, send: Optional[Callable] = None, span: Optional[tracing.Span] = None) -> str:
+        # Returns the outcome, for the metrics. `span` is only there if there are tracing hooks.
+        transport, current_uid = session.transport, session.uid
+        splice = send is None # whether we can write pre-encoded responses straight to the connection
+        send = send or session.send
+        call_id = data.get('id')
+        func_name = data.get('name')
+        args = data.get('args', [])
+        kwargs = data.get('kwargs', {}) # Note: Only Python client (currently) sends these, JS client does not.
+
+        try:
+            plan = self._plan(func_name)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            await send({"id": call_id, "error": str(e)}) # TODO: See 391
+            return 'error'
+
+        if plan is None:
+            await send({
+                "id": call_id, 
+                "error": f"Function '{func_name}' not found."
+            }) # TODO: See 391
+            return 'not_found'
+
+        if plan.rate_limit:
+            try:
+                await self._check_ratelimit(
+                    func_name,
+                    plan.rate_limit,
+                    uid=current_uid,
+                    ip=transport.remote_addr,
+                )
+            except RatelimitExceededException as e:
+                await send({
+                    "id": call_id,
+                    "error": {
+                        "code": "RATELIMIT",
+                        "message": str(e),
+                        "data": { "retry_after": e.retry_after },
+                    },
+                })
+                return 'ratelimited'
 
-                    if func_name in self._exposed_functions:
-                        target_func = self._exposed_functions[func_name]
-                        meta = getattr(target_func, META_KEY, {})
+        try:
+            with tracing.phase(span, tracing.VALIDATE):
+                final_arguments = plan.bind(args, kwargs)
+        except TypeError as e:
+            await send({"id": call_id, "error": str(e)})
+            return 'validation_error'
+        except pydantic.ValidationError as e:
+            await send({
+                "id": call_id,
+                "error": {
+                    "code": "VALIDATION_ERROR",
+                    "message": "Input validation failed.",
+                    "data": e.errors(),
+                },
+            })
+            return 'validation_error'
+
+        cache_key = None
+        if plan.cache:
+            cache_key = plan.cache.key(final_arguments, current_uid)
+            encoded = plan.cache.get(cache_key)
+            if encoded is not None:
+                if splice: await session.send_encoded(cache.response_frame(call_id, encoded))
+                else: await send({"id": call_id, "result": msgpack.loads(encoded)})
+                return 'cached'
+
+        token_transport = _active_transport_ctx.set(transport)
+        token_user = _active_user_ctx.set(current_uid)
+        token_scope = _scope_ctx.set('rpc')
+        token_lane = _emit_lane_ctx.set(RESPONSE)
+
+        try:
+            with tracing.phase(span, tracing.HANDLER):
+                if plan.coalesce:
+                    # Equal concurrent calls share one execution (and one return validation).
+                    result = await plan.coalesce.run(plan.coalesce.key(final_arguments, current_uid), plan.call, final_arguments, client=manager.redis)
+                else:
+                    result = await plan.invoke(**final_arguments)
+
+            is_async_gen = inspect.isasyncgen(result)
+            is_sync_gen = inspect.isgenerator(result)
+
+            if is_async_gen or is_sync_gen:
+                _emit_lane_ctx.set(CHUNK) # the generator runs in this context, and its chunks go out on that lane
+                # Flow control only kicks in if the client can do it (it has to send `credit` frames back). The
+                # client's window wins, then the function's, then ours, and 0 at any of those turns it off.
+                window = data.get('window')
+                if window is None and session.flow: window = plan.meta.get('window')
+                if window is None and session.flow: window = self.stream_window
+                window = window or None
+
+                if is_async_gen: stream = result
+                else:
+                    # Produces no further ahead than the client's credits, on a worker from the (bounded) streams pool.
+                    stream = SyncStream(result, buffer=min(window or 64, 64), name=f'ephaptic-stream-{func_name}', pool=self.executor(STREAMS), budget=window)
+                    try:
+                        await stream.start()
+                    except BaseException:
+                        await stream.aclose()
+                        raise
+
+                credits = session.open_credits(call_id, window) if window else None
+                if credits and not is_async_gen: credits.on_grant = stream.allow
+
+                outcome = 'ok'
+                metrics.streams_active.inc(func_name)
+                with tracing.phase(span, tracing.STREAM) as stream_span:
+                    try:
+                        await send({
+                            'id': call_id,
+                            'stream': True,
+                            **({'window': window} if window else {}),
+                        }, CHUNK)
+
+                        while True:
+                            # Out of credits means the client's buffer is full, so we don't even ask the generator for the next item.
+                            if credits: await credits.acquire()
 
-                        if meta.get('rate_limit'):
                             try:
-                                await self._check_ratelimit(
-                                    func_name,
-                                    meta.get('rate_limit'),
-                                    uid=current_uid,
-                                    ip=transport.remote_addr,
-                                )
-                            except RatelimitExceededException as e:
-                                await transport.send(msgpack.dumps({
-                                    "id": call_id,
-                                    "error": {
-                                        "code": "RATELIMIT",
-                                        "message": str(e),
-                                        "data": { "retry_after": e.retry_after },
-                                    },
-                                }))
-                                continue
-
-
-                        hints = meta.get('hints') or typing.get_type_hints(target_func)
-                        sig = meta.get('sig') or inspect.signature(target_func)                      
-                        
-                        try:
-                            bound = sig.bind(*args, **kwargs)
-                            bound.apply_defaults()
-                        except TypeError as e:
-                            await transport.send(msgpack.dumps({"id": call_id, "error": str(e)}))
-                            continue
-
-                        fields = {}
-                        for name, param in sig.parameters.items():
-                            if name in hints:
-                                fields[name] = (hints[name], param.default if param.default is not inspect.Parameter.empty else ...)
-                            else:
-                                fields[name] = (Any, param.default if param.default is not inspect.Parameter.empty else ...)
-
-                        DynamicInputModel = pydantic.create_model(f'DynamicInputModel_{func_name}', **fields)
-
-                        try:
-                            validated_data = DynamicInputModel(**bound.arguments)
-                            final_arguments = {
-                                field_name: getattr(validated_data, field_name)
-                                for field_name in DynamicInputModel.model_fields.keys()
+                                chunk = await anext(stream)
+                            except StopAsyncIteration:
+                                break
+
+                            await send({
+                                'id': call_id,
+                                'chunk': plan.dump_chunk(chunk),
+                            }, CHUNK)
+                            metrics.stream_chunks.inc(func_name)
+                    
+                        await send({
+                            'id': call_id,
+                            'done': True,
+                        }, CHUNK)
+
+                    except Transport.ConnectionClosed:
+                        outcome = 'disconnected'
+
+                    except Exception as e:
+                        import traceback
+                        traceback.print_exc()
+                        outcome = 'error'
+                        if stream_span: stream_span.error = e
+                        await send({
+                            'id': call_id,
+                            'error': { # TODO: Upgrade this once we figure out error handling
+                                'message': f"Error during stream: {e}"
                             }
-                        except pydantic.ValidationError as e:
-                            await transport.send(msgpack.dumps({
-                                "id": call_id,
-                                "error": {
-                                    "code": "VALIDATION_ERROR",
-                                    "message": "Input validation failed.",
-                                    "data": e.errors(),
-                                },
-                            }))
-                            continue
-                        
-                        token_transport = _active_transport_ctx.set(transport)
-                        token_user = _active_user_ctx.set(current_uid)
-                        token_scope = _scope_ctx.set('rpc')
-
-                        def validate(payload, expected, adapter=None):
-                            if expected and expected is not inspect.Signature.empty and expected is not typing.Any:
-                                adapter = adapter or pydantic.TypeAdapter(expected)
-                                validated = adapter.validate_python(payload, from_attributes=True)
-                                return adapter.dump_python(validated, mode='json')
-                            elif isinstance(payload, pydantic.BaseModel):
-                                # incase dev returned basemodel and forgot to set return type
-                                return payload.model_dump(mode='json')
-                            else: return payload
-
-                        try:
-                            result = await self._async(target_func)(**final_arguments)
-
-                            is_async_gen = inspect.isasyncgen(result)
-                            is_sync_gen = inspect.isgenerator(result)
-
-                            return_type = meta.get('response_model') or hints.get("return", typing.Any)
-
-                            if is_async_gen or is_sync_gen:
-                                origin = typing.get_origin(return_type)
-                                origin_name = getattr(origin, '__name__', '')
-                                if origin in (typing.AsyncGenerator, typing.Generator, typing.AsyncIterable, typing.Iterable) or origin_name in ('AsyncGenerator', 'Generator', 'AsyncIterable', 'Iterable'):
-                                    type_ = typing.get_args(return_type)[0] if typing.get_args(return_type) else typing.Any
-                                else: type_ = return_type
-
-                                if type_ and type_ is not inspect.Signature.empty and type_ is not typing.Any:
-                                    adapter = pydantic.TypeAdapter(type_)
-                                else: adapter = None
-
-                                try:
-                                    await transport.send(msgpack.dumps({
-                                        'id': call_id,
-                                        'stream': True,
-                                    }))
-
-                                    if is_async_gen:
-                                        async for chunk in result:
-                                            data = validate(chunk, type_)
-                                            await transport.send(msgpack.dumps({
-                                                'id': call_id,
-                                                'chunk': data,
-                                            }))
-                                    else:
-                                        while True:
-                                            # try:
-                                            #     chunk = await asyncio.to_thread(next, result)
-                                            # except StopIteration:
-                                            #     break
-
-                                            # can't do this becuz coroutines use StopIteration internally to signal completion
-                                            # and python panics, the await escapes the catch block
-
-                                            def next_(gen):
-                                                try:
-                                                    return next(gen), False
-                                                except StopIteration:
-                                                    return None, True
-                                            
-                                            chunk, done = await asyncio.to_thread(next_, result)
-                                            
-                                            if done: break
-
-                                            data = validate(chunk, type_)
-                                            await transport.send(msgpack.dumps({
-                                                'id': call_id,
-                                                'chunk': data,
-                                            }))
-                                    
-                                    await transport.send(msgpack.dumps({
-                                        'id': call_id,
-                                        'done': True,
-                                    }))
-                                    continue
-
-                                except Transport.ConnectionClosed:
-                                    continue
-
-                                except Exception as e:
-                                    import traceback
-                                    traceback.print_exc()
-                                    await transport.send(msgpack.dumps({
-                                        'id': call_id,
-                                        'error': { # TODO: Upgrade this once we figure out error handling
-                                            'message': f"Error during stream: {e}"
-                                        }
-                                    }))
-                                    continue
-
-                            elif return_type and return_type is not inspect.Signature.empty and return_type is not typing.Any:
-                                try:
-                                    adapter = pydantic.TypeAdapter(return_type)
-                                    validated = adapter.validate_python(result, from_attributes=True)
-                                    result = adapter.dump_python(validated, mode='json')
-                                except Exception as e:
-                                    # Should we really treat this separately?
-                                    # For input it's understandable, but for server responses it feels like a server issue.
-                                    # Let's just return a RETURN_VALIDATION_ERROR and print the traceback.
-                                    # TODO: See 391
-                                    import traceback
-                                    traceback.print_exc()
-                                    await transport.send(msgpack.dumps({
-                                        "id": call_id,
-                                        "error": {
-                                            "code": "RETURN_VALIDATION_ERROR",
-                                            "message": f"Server returned invalid type: {e}",
-                                            "data": None,
-                                        },
-                                    }))
-                                    continue
-                            elif isinstance(result, pydantic.BaseModel):
-                                result = result.model_dump(mode='json')
-
-                            await transport.send(msgpack.dumps({"id": call_id, "result": result}))
-                        except Exception as e:
-                            # TODO: See 391
-                            await transport.send(msgpack.dumps({"id": call_id, "error": str(e)}))
-                        finally:
-                            _active_transport_ctx.reset(token_transport)
-                            _active_user_ctx.reset(token_user)
-                            _scope_ctx.reset(token_scope)
-                    else:
-                        await transport.send(msgpack.dumps({
-                            "id": call_id, 
-                            "error": f"Function '{func_name}' not found."
-                        })) # TODO: See 391
-        except (asyncio.CancelledError, Transport.ConnectionClosed):
-            ...
-        except Exception:
+                        }, CHUNK)
+
+                    finally:
+                        # Runs on cancellation (a `cancel` frame, or the client disconnecting) too,
+                        # so the generator's own cleanup runs instead of it being left suspended.
+                        metrics.streams_active.dec(func_name)
+                        if credits: session.close_credits(call_id)
+                        await stream.aclose()
+                return outcome
+
+            if not plan.coalesce: # already dumped, if it was coalesced
+                with tracing.phase(span, tracing.RETURN_VALIDATION):
+                    result = plan.dump_result(result)
+
+            with tracing.phase(span, tracing.SEND):
+                if cache_key is not None:
+                    encoded = msgpack.dumps(result)
+                    plan.cache.set(cache_key, encoded)
+                    if splice:
+                        await session.send_encoded(cache.response_frame(call_id, encoded))
+                        return 'ok'
+
+                await send({"id": call_id, "result": result})
+            return 'ok'
+        except ExecutorOverloaded as e:
+            await send({
+                "id": call_id,
+                "error": {
+                    "code": "OVERLOADED",
+                    "message": str(e),
+                    "data": { "executor": e.executor },
+                },
+            })
+            return 'overloaded'
+        except ReturnValidationError as e:
+            # Should we really treat this separately?
+            # For input it's understandable, but for server responses it feels like a server issue.
+            # Let's just return a RETURN_VALIDATION_ERROR and print the traceback.
+            # TODO: See 391
             import traceback
             traceback.print_exc()
+            await send({
+                "id": call_id,
+                "error": {
+                    "code": "RETURN_VALIDATION_ERROR",
+                    "message": f"Server returned invalid type: {e}",
+                    "data": None,
+                },
+            })
+            return 'return_validation_error'
+        except Exception as e:
+            # TODO: See 391
+            await send({"id": call_id, "error": str(e)})
+            return 'error'
         finally:
-            if current_uid: manager.remove(current_uid, transport)
+            _active_transport_ctx.reset(token_transport)
+            _active_user_ctx.reset(token_user)
+            _scope_ctx.reset(token_scope)
+            _emit_lane_ctx.reset(token_lane)
@@ -0,0 +1,308 @@
+import asyncio
+import contextvars
+import importlib
+import multiprocessing
+import os
+import queue
+import threading
+import typing
+import weakref
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Union
+
+import msgpack
+import pydantic_core
+
+from .ctx import _scope_ctx, _active_user_ctx
+
+ExecutorSpec = Union[int, Dict[str, Any]]
+
+PROCESS = 'process' # the executor name that runs functions in worker processes
+STREAMS = 'streams' # the one sync generator streams are driven on, a worker each for as long as they run
+_DEFAULTS = {STREAMS: {'max_workers': 32}}
+
+class ExecutorOverloaded(Exception):
+    def __init__(self, message: str, executor: str):
+        super().__init__(message)
+        self.executor = executor
+
+class Pool:
+    """
+    A named, size-limited pool for sync functions exposed with `executor=...`.
+
+    At most `max_workers` calls run at once. Up to `max_queue` more wait for a worker, each for
+    at most `queue_timeout` seconds; past either bound, the call fails straight away with
+    `ExecutorOverloaded` instead of piling up behind the slow ones.
+
+    A worker is only given back once its function actually returns, even if the caller went
+    away (a thread can't be interrupted), so a pool never runs more than `max_workers` at once.
+
+    `shutdown()` stops the workers (the adapters call it when the app shuts down, see
+    `Ephaptic.shutdown_executors`). They're started again if the pool is used after that.
+    """
+
+    def __init__(self, name: str, max_workers: int = 4, max_queue: int = 16, queue_timeout: Optional[float] = 1.0):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._workers: Optional[asyncio.Semaphore] = None # created on first use, on the running loop
+
+        self.running = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def _acquire(self):
+        if self._workers is None: self._workers = asyncio.Semaphore(self.max_workers)
+
+        if self._workers.locked():
+            if self.queued >= self.max_queue: self._reject()
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self._workers.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject()
+            finally:
+                self.queued -= 1
+        else:
+            await self._workers.acquire()
+
+        self.running += 1
+
+    @property
+    def saturated(self) -> bool:
+        # Every worker busy, and no room to wait for one: the next call would be rejected.
+        return self._workers is not None and self._workers.locked() and self.queued >= self.max_queue
+
+    def _submit(self, submit: Callable[[], Future]) -> Future:
+        # Takes a worker back once `future` is done, whether or not anyone is still waiting for it.
+        loop = asyncio.get_running_loop()
+        try:
+            future = submit()
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release_threadsafe(loop))
+        return future
+
+    def _reject(self) -> typing.NoReturn:
+        self.rejected += 1
+        raise ExecutorOverloaded(f"Executor '{self.name}' is overloaded. Try again later.", executor=self.name)
+
+    def _release(self):
+        self.running -= 1
+        self.completed += 1
+        self._workers.release()
+
+    def _release_threadsafe(self, loop: asyncio.AbstractEventLoop):
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError: ... # loop is closed, nobody is waiting anymore
+
+    async def run(self, func: Callable, *args, **kwargs):
+        raise NotImplementedError
+
+    def shutdown(self):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, typing.Any]:
+        return {
+            'workers': self.max_workers,
+            'running': self.running,
+            'queued': self.queued,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+class ThreadPool(Pool):
+    def __init__(self, name: str, max_workers: int = 4, **kwargs):
+        super().__init__(name, max_workers, **kwargs)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None: self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=f'ephaptic-{self.name}')
+        return self._executor
+
+    async def run(self, func: Callable, *args, **kwargs):
+        await self._acquire()
+        # Copied like `asyncio.to_thread` does, so `active_user()` etc. still work in there.
+        context = contextvars.copy_context()
+        return await asyncio.wrap_future(self._submit(lambda: self.executor.submit(context.run, func, *args, **kwargs)))
+
+    async def start(self, func: Callable, *args) -> Future:
+        """Like `run`, but returns once `func` has a worker, for things that hold on to it for a while (e.g. streams)."""
+        await self._acquire()
+        return self._submit(lambda: self.executor.submit(func, *args))
+
+    def shutdown(self):
+        executor, self._executor = self._executor, None
+        if executor: executor.shutdown(wait=False, cancel_futures=True)
+
+
+# What runs in the worker processes. Arguments and results cross over as msgpack, so they're
+# already validated (and dumped) in the parent, and validated again there on the way back.
+
+_input_models: Dict[Callable, Any] = {}
+
+def _preload(modules: Iterable[str]):
+    for module in modules: importlib.import_module(module)
+
+def _arguments(func: Callable, payload: bytes):
+    scope, uid, kwargs = msgpack.loads(payload)
+    _scope_ctx.set(scope)
+    _active_user_ctx.set(uid)
+
+    # Back into the types the function was declared with (e.g. models), as they were in the parent.
+    model = _input_models.get(func)
+    if model is None:
+        from .plan import CallPlan
+        model = _input_models[func] = CallPlan(func.__name__, func).input_model
+    validated = model.model_validate(kwargs)
+    return {name: getattr(validated, name) for name in model.model_fields}
+
+def _encode(value) -> bytes:
+    return msgpack.dumps(pydantic_core.to_jsonable_python(value))
+
+def _call(func: Callable, payload: bytes) -> bytes:
+    return _encode(func(**_arguments(func, payload)))
+
+def _stream(func: Callable, payload: bytes, chunks, stop) -> None:
+    gen = func(**_arguments(func, payload))
+    try:
+        for chunk in gen:
+            item = ('chunk', _encode(chunk))
+            while True:
+                if stop.is_set(): return
+                try:
+                    chunks.put(item, timeout=0.1)
+                    break
+                except queue.Full: ... # the consumer is behind, check whether it's still there
+        chunks.put(('done', None))
+    except Exception as e:
+        chunks.put(('error', e))
+    finally:
+        gen.close()
+
+def _set(stop):
+    try:
+        stop.set()
+    except Exception: ... # manager already gone
+
+def _start_manager(future: Future, context):
+    try:
+        future.set_result(context.Manager())
+    except BaseException as e:
+        future.set_exception(e)
+
+def _stop_manager(future: Future):
+    if future.exception() is None: future.result().shutdown()
+
+class ProcessPool(Pool):
+    """
+    Runs CPU-bound functions in worker processes, so they aren't held back by the GIL.
+
+    Workers are spawned (not forked, which doesn't mix with a running event loop) and import
+    `preload` up front. Functions are sent by reference, so they have to be importable, i.e.
+    defined at the top level of a module. Sync generators stream their chunks back through a
+    bounded queue.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, name: str = PROCESS, max_workers: Optional[int] = None, preload: Iterable[str] = (), stream_buffer: int = 64, **kwargs):
+        max_workers = max_workers or os.cpu_count() or 1
+        super().__init__(name, max_workers, **kwargs)
+        self.preload = tuple(preload)
+        self.stream_buffer = stream_buffer
+        self._context = multiprocessing.get_context('spawn')
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._manager: Optional[Future] = None # for streams' queues
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=self._context, initializer=_preload, initargs=(self.preload,))
+            self._start_manager()
+        return self._executor
+
+    def _start_manager(self) -> Future:
+        # Started with the workers, in a thread of its own: it's a process too, and waiting for it
+        # would hold up the loop (or the first stream).
+        if self._manager is None:
+            self._manager = Future()
+            self._manager.set_running_or_notify_cancel() # a stream that's cancelled while waiting can't cancel it for everyone
+            threading.Thread(target=_start_manager, args=(self._manager, self._context), name=f'ephaptic-{self.name}-manager', daemon=True).start()
+        return self._manager
+
+    @staticmethod
+    def _payload(kwargs: Dict[str, Any]) -> bytes:
+        return msgpack.dumps([_scope_ctx.get(), _active_user_ctx.get(), pydantic_core.to_jsonable_python(kwargs)])
+
+    async def run(self, func: Callable, *args, **kwargs):
+        if args: raise TypeError('Functions run in a process pool take keyword arguments only.')
+        await self._acquire()
+        payload = self._payload(kwargs)
+        return msgpack.loads(await asyncio.wrap_future(self._submit(lambda: self.executor.submit(_call, func, payload))))
+
+    async def stream(self, func: Callable, *args, **kwargs) -> typing.Generator:
+        """Starts `func` (a sync generator) in a worker, and returns a sync generator of its chunks."""
+        if args: raise TypeError('Functions run in a process pool take keyword arguments only.')
+        await self._acquire()
+        payload = self._payload(kwargs)
+
+        starting = self._start_manager()
+        try:
+            manager = await asyncio.wrap_future(starting)
+            # Each of these is a round trip to the manager process.
+            loop = asyncio.get_running_loop()
+            chunks = await loop.run_in_executor(None, manager.Queue, self.stream_buffer)
+            stop = await loop.run_in_executor(None, manager.Event)
+        except BaseException:
+            self._release()
+            if starting.done() and starting.exception() and self._manager is starting:
+                self._manager = None # so the next stream tries again
+            raise
+
+        future = self._submit(lambda: self.executor.submit(_stream, func, payload, chunks, stop))
+        gen = self._chunks(future, chunks, stop)
+        weakref.finalize(gen, _set, stop) # if it's dropped without ever being started, its `finally:` never runs
+        return gen
+
+    def _chunks(self, future: Future, chunks, stop) -> typing.Generator:
+        # A plain generator, so it's driven by a `SyncStream` thread like any other sync generator.
+        try:
+            while True:
+                try:
+                    kind, value = chunks.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    if future.done():
+                        future.result() # e.g. the worker died
+                        return
+                    continue
+
+                match kind:
+                    case 'chunk': yield msgpack.loads(value)
+                    case 'done': return
+                    case 'error': raise value
+        finally:
+            _set(stop)
+
+    def shutdown(self):
+        # Workers exit once they finish what they're running. Streams stop too: their queues go
+        # away with the manager, so the next chunk they put fails.
+        executor, self._executor = self._executor, None
+        manager, self._manager = self._manager, None
+        if executor: executor.shutdown(wait=False, cancel_futures=True)
+        if manager: manager.add_done_callback(_stop_manager) # right away, or once it's started
+
+
+def pool_of(name: str, spec: Optional[ExecutorSpec] = None) -> Pool:
+    # `executors={'reports': 2}`, or `executors={'reports': {'max_workers': 2, 'max_queue': 8, 'queue_timeout': 0.5}}`.
+    # The one called 'process' is a `ProcessPool`, e.g. `{'process': {'max_workers': 4, 'preload': ['app.reports']}}`.
+    cls = ProcessPool if name == PROCESS else ThreadPool
+    defaults = _DEFAULTS.get(name, {})
+    if spec is None: return cls(name, **defaults)
+    if isinstance(spec, dict): return cls(name, **{**defaults, **spec})
+    return cls(name, **{**defaults, 'max_workers': spec})
@@ -1,4 +1,5 @@
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, WebSocket, Response
+from ... import metrics
 from ...transports.fastapi_ws import FastAPIWebSocketTransport
 from .middleware import CtxMiddleware
 
@@ -14,20 +15,29 @@ class FastAPIAdapter:
             transport = FastAPIWebSocketTransport(websocket)
             await self.ephaptic.handle_transport(transport)
 
-        if manager.redis:
-            lifespan = app.router.lifespan_context
+        if ephaptic.metrics_path:
+            @app.get(ephaptic.metrics_path, include_in_schema=False)
+            async def ephaptic_metrics():
+                return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
 
-            from contextlib import asynccontextmanager
-            import asyncio
+        lifespan = app.router.lifespan_context
 
-            @asynccontextmanager
-            async def ephaptic_lifespan_wrapper(app):
-                asyncio.create_task(manager.start_redis())
+        from contextlib import asynccontextmanager
+        import asyncio
 
+        @asynccontextmanager
+        async def ephaptic_lifespan_wrapper(app):
+            if manager.redis: asyncio.create_task(manager.start_redis())
+            if ephaptic.listeners: await ephaptic.listeners.start()
+
+            try:
                 if lifespan:
                     async with lifespan(app) as state:
                         yield state
                 else:
                     yield
+            finally:
+                if ephaptic.listeners: await ephaptic.listeners.stop()
+                await ephaptic.shutdown() # threads, worker processes and background tasks, so a reload doesn't leak them
 
-            app.router.lifespan_context = ephaptic_lifespan_wrapper
+        app.router.lifespan_context = ephaptic_lifespan_wrapper
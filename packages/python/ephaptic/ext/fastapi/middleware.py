@@ -1,24 +1,30 @@
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.types import ASGIApp, Receive, Scope, Send
 from ...ctx import _scope_ctx
 from ...ephaptic import Ephaptic, _active_user_ctx
 
-class CtxMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, ephaptic: Ephaptic):
-        super().__init__(app)
+class CtxMiddleware:
+    # Plain ASGI rather than `BaseHTTPMiddleware`: no extra task per request, and the response
+    # body is passed straight through, so streaming responses and background tasks behave.
+    def __init__(self, app: ASGIApp, ephaptic: Ephaptic):
+        self.app = app
         self.ephaptic = ephaptic
 
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        paths = self.ephaptic.http_paths
+        if scope['type'] != 'http' or (paths and not scope['path'].startswith(paths)):
+            return await self.app(scope, receive, send)
 
-    async def dispatch(self, request, call_next):
         token = _scope_ctx.set('http')
         user_token = None
 
-        if self.ephaptic._http_identity_loader:
-            user = await self.ephaptic._async(self.ephaptic._http_identity_loader)(request)
-            if user:
-                user_token = _active_user_ctx.set(user)
-
         try:
-            return await call_next(request)
+            if self.ephaptic._http_identity_loader:
+                user = await self.ephaptic._load_identity('http', Request(scope, receive))
+                if user:
+                    user_token = _active_user_ctx.set(user)
+
+            await self.app(scope, receive, send)
         finally:
             _scope_ctx.reset(token)
-            if user_token: _active_user_ctx.reset(user_token)
\ No newline at end of file
+            if user_token: _active_user_ctx.reset(user_token)
@@ -1,15 +1,45 @@
 from typing import *
 from functools import wraps
+import contextlib
 import inspect
 import asyncio
 import json
+import time
 
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from ...ephaptic import Ephaptic, RatelimitExceededException, expose
+from ...executors import STREAMS, ExecutorOverloaded
+from ... import metrics, tracing
 from ...ctx import is_http, is_rpc, active_user
-from ...utils import parse_limit
+from ...utils import parse_limits
+from ...plan import invoker, kind_of
+from ...streams import SyncStream
+
+@contextlib.contextmanager
+def _observe_http(name: str):
+    if not is_http(): # called as an RPC, which `Ephaptic._dispatch` counts (and traces) already
+        yield
+        return
+
+    start = time.perf_counter()
+    outcome, error = 'error', None
+    span = tracing.start('http', function=name, user=active_user()) if tracing.hooks else None
+    try:
+        with tracing.phase(span, tracing.HANDLER):
+            yield
+        outcome = 'ok'
+    except HTTPException as e:
+        outcome = str(e.status_code)
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        metrics.http_duration.observe(time.perf_counter() - start, name)
+        metrics.http_requests.inc(name, outcome)
+        if span: tracing.end(span, error, outcome=outcome)
 
 class Router(APIRouter):
     ephaptic: Optional[Ephaptic]
@@ -26,11 +56,12 @@ class Router(APIRouter):
         func: Callable,
         methods: List[str],
         path: str,
-        limit: Optional[str] = None,
+        limit: Optional[Union[str, Dict[str, str]]] = None,
         auth: bool = False,
+        executor: Optional[str] = None,
         **kwargs,
     ):
-        limit_config = parse_limit(limit) if limit else None
+        limit_config = parse_limits(limit) if limit else None
 
         async def http_rl_dep(req: Request):
             if limit_config:
@@ -40,10 +71,11 @@ class Router(APIRouter):
                     await self.ephaptic._check_ratelimit(
                         func.__name__,
                         limit_config,
-                        ip=req.client.host
+                        uid=active_user(),
+                        ip=req.client.host if req.client else None,
                     )
                 except RatelimitExceededException as e:
-                    raise HTTPException(status_code=429, detail=str(e), headers={'X-Retry-After': e.retry_after})
+                    raise HTTPException(status_code=429, detail=str(e), headers={'X-Retry-After': str(e.retry_after)})
 
         def _pre():
             if auth and active_user() is None:
@@ -53,24 +85,57 @@ class Router(APIRouter):
             if not self.ephaptic:
                 raise RuntimeError(f"Router for {path} is not bound to an Ephaptic instance. You must either call `.bind(ephaptic)`, or pass the `ephaptic` instance when constructing the Router.")
 
-        if (inspect.isasyncgenfunction(func) or inspect.isgeneratorfunction(func)):
+        kind = kind_of(func)
+
+        if executor:
+            if kind != 'sync': raise TypeError(f"executor= only applies to plain sync functions, and {func.__name__} isn't one.")
+
+            async def invoke(*args, **kwargs):
+                # The pool is looked up per request, since the router may only be bound later.
+                try:
+                    return await self.ephaptic.executor(executor).run(func, *args, **kwargs)
+                except ExecutorOverloaded as e:
+                    if is_http(): raise HTTPException(status_code=503, detail=str(e))
+                    raise
+        else:
+            invoke = invoker(func) # resolved once here, rather than on every request
+
+        if kind in ('async_gen', 'sync_gen'):
             @wraps(func)
             async def wrapper(*args, **kwargs):
-                _pre()
-                if inspect.isasyncgenfunction(func):
-                    async for chunk in await self.ephaptic._async(func)(*args, **kwargs):
-                        yield chunk
-                elif inspect.isgeneratorfunction(func):
-                    for chunk in await self.ephaptic._async(func)(*args, **kwargs):
-                        yield chunk
+                with _observe_http(func.__name__):
+                    _pre()
+                    if kind == 'async_gen':
+                        async for chunk in await invoke(*args, **kwargs):
+                            yield chunk
+                    else:
+                        # on its own thread (from the bounded streams pool), so a blocking generator doesn't block the event loop
+                        stream = SyncStream(await invoke(*args, **kwargs), name=f'ephaptic-stream-{func.__name__}', pool=self.ephaptic.executor(STREAMS))
+                        try:
+                            await stream.start() # over HTTP, the response has started by now, see `http_stream_dep`
+                        except BaseException:
+                            await stream.aclose()
+                            raise
+                        try:
+                            async for chunk in stream:
+                                yield chunk
+                        finally:
+                            await stream.aclose()
         else:
             @wraps(func)
             async def wrapper(*args, **kwargs):
-                _pre()
-                return await self.ephaptic._async(func)(*args, **kwargs)
+                with _observe_http(func.__name__):
+                    _pre()
+                    return await invoke(*args, **kwargs)
+
+        async def http_stream_dep():
+            # Checked before the response starts, so a saturated streams pool is a proper 503.
+            if self.ephaptic and self.ephaptic.executor(STREAMS).saturated:
+                raise HTTPException(status_code=503, detail=f"Executor '{STREAMS}' is overloaded. Try again later.")
 
         deps = kwargs.pop('dependencies', [])
         if limit: deps.append(Depends(http_rl_dep))
+        if kind == 'sync_gen': deps.append(Depends(http_stream_dep))
 
         self.add_api_route(
             path,
@@ -87,22 +152,22 @@ class Router(APIRouter):
             sig=inspect.signature(func), # for bypassing the @wraps
         )(wrapper)
 
-    def get    (self, path, limit=None, requires_login=False):
-        def decorator(func): return self._register(func=func, methods=["GET"],    path=path, limit=limit, auth=requires_login)
+    def get    (self, path, limit=None, requires_login=False, executor=None):
+        def decorator(func): return self._register(func=func, methods=["GET"],    path=path, limit=limit, auth=requires_login, executor=executor)
         return decorator
     
-    def post   (self, path, limit=None, requires_login=False):
-        def decorator(func): return self._register(func=func, methods=["POST"],   path=path, limit=limit, auth=requires_login)
+    def post   (self, path, limit=None, requires_login=False, executor=None):
+        def decorator(func): return self._register(func=func, methods=["POST"],   path=path, limit=limit, auth=requires_login, executor=executor)
         return decorator
 
-    def put    (self, path, limit=None, requires_login=False):
-        def decorator(func): return self._register(func=func, methods=["PUT"],    path=path, limit=limit, auth=requires_login)
+    def put    (self, path, limit=None, requires_login=False, executor=None):
+        def decorator(func): return self._register(func=func, methods=["PUT"],    path=path, limit=limit, auth=requires_login, executor=executor)
         return decorator
 
-    def delete (self, path, limit=None, requires_login=False):
-        def decorator(func): return self._register(func=func, methods=["DELETE"], path=path, limit=limit, auth=requires_login)
+    def delete (self, path, limit=None, requires_login=False, executor=None):
+        def decorator(func): return self._register(func=func, methods=["DELETE"], path=path, limit=limit, auth=requires_login, executor=executor)
         return decorator
     
-    def patch  (self, path, limit=None, requires_login=False):
-        def decorator(func): return self._register(func=func, methods=["PATCH"],  path=path, limit=limit, auth=requires_login)
+    def patch  (self, path, limit=None, requires_login=False, executor=None):
+        def decorator(func): return self._register(func=func, methods=["PATCH"],  path=path, limit=limit, auth=requires_login, executor=executor)
         return decorator
\ No newline at end of file
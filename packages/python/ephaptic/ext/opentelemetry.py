@@ -0,0 +1,49 @@
+from typing import Optional
+
+from opentelemetry import context, propagate, trace # `pip install ephaptic[opentelemetry]`
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+from .. import tracing
+
+class OpenTelemetryHook(tracing.Hook):
+    """
+    Reports calls and their phases as OpenTelemetry spans.
+
+        tracing.add_hook(OpenTelemetryHook())
+
+    A call's span continues the trace the client sent in its `rpc` frame, if any. Spans the
+    function starts itself end up under its `handler` phase.
+    """
+
+    def __init__(self, tracer: Optional[trace.Tracer] = None):
+        self.tracer = tracer or trace.get_tracer('ephaptic')
+
+    def on_start(self, span: tracing.Span):
+        if span.parent is None:
+            parent_context = propagate.extract(span.trace) if span.trace else None
+            name, kind = f'{span.name} {span.function}', SpanKind.SERVER
+        else:
+            parent = span.parent.state.get(self) # missing if the hook was added halfway through the call
+            parent_context = trace.set_span_in_context(parent) if parent else None
+            name, kind = span.name, SpanKind.INTERNAL
+
+        attributes = {'rpc.system': 'ephaptic', 'rpc.method': str(span.function)}
+        if span.call_id is not None: attributes['ephaptic.call_id'] = str(span.call_id)
+        if span.user is not None: attributes['enduser.id'] = str(span.user)
+
+        otel_span = span.state[self] = self.tracer.start_span(name, context=parent_context, kind=kind, start_time=span.start_ns, attributes=attributes)
+        if span.name == tracing.HANDLER:
+            span.state[(self, 'token')] = context.attach(trace.set_span_in_context(otel_span))
+
+    def on_end(self, span: tracing.Span):
+        otel_span = span.state.get(self)
+        if otel_span is None: return
+
+        token = span.state.pop((self, 'token'), None)
+        if token is not None: context.detach(token)
+
+        for key, value in span.attributes.items(): otel_span.set_attribute(f'ephaptic.{key}', str(value))
+        if span.error is not None:
+            otel_span.record_exception(span.error)
+            otel_span.set_status(Status(StatusCode.ERROR, str(span.error)))
+        otel_span.end(end_time=span.end_ns)
@@ -1,5 +1,6 @@
 from quart import websocket, Quart
 from ...transports.websocket import WebSocketTransport
+from ... import metrics
 
 class QuartAdapter:
     def __init__(self, ephaptic, app: Quart, path, manager):
@@ -10,7 +11,18 @@ class QuartAdapter:
             transport = WebSocketTransport(websocket)
             await self.ephaptic.handle_transport(transport)
 
+        if ephaptic.metrics_path:
+            @app.route(ephaptic.metrics_path)
+            async def ephaptic_metrics():
+                return metrics.registry.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
         if manager.redis:
             @app.before_serving
             async def start_redis():
-                app.add_background_task(manager.start_redis)
\ No newline at end of file
+                app.add_background_task(manager.start_redis)
+
+        if ephaptic.listeners:
+            app.before_serving(ephaptic.listeners.start)
+            app.after_serving(ephaptic.listeners.stop)
+
+        app.after_serving(ephaptic.shutdown)
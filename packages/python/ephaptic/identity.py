@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import time
+import typing
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Union
+
+import msgpack
+import redis.asyncio as redis
+
+from .store import ExpiringStore
+
+IdentityCacheSpec = Union[int, float, Dict[str, Any]]
+
+_NOBODY = object() # a cached "this token doesn't belong to anyone"
+
+def bearer_token(request) -> Optional[str]:
+    """The token from an `Authorization: Bearer <token>` header, for `http_token`."""
+    scheme, _, token = (request.headers.get('authorization') or '').partition(' ')
+    if scheme.lower() != 'bearer': return None
+    return token.strip() or None
+
+class IdentityCache:
+    """
+    Identities resolved by the identity loaders, by auth token.
+
+    Used for the WebSocket `init` payload, and for HTTP requests if `http_token` says what the
+    token is (e.g. `bearer_token`). It has to be whatever the HTTP identity loader authenticates
+    with, which we can't know, so requests aren't cached without it.
+
+    Tokens are only ever stored hashed. Tokens that didn't resolve to anyone are remembered too,
+    for `negative_ttl` seconds, so a flood of bad tokens doesn't reach the loader either.
+    Concurrent misses for the same token share one load.
+
+    With Redis, entries are shared between nodes, so a client reconnecting to another node
+    still hits the cache. Each node keeps its own copy for at most `local_ttl` seconds, which
+    bounds how long a revocation takes to reach every node.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60,
+        negative_ttl: float = 5,
+        max_size: int = 10_000,
+        local_ttl: float = 5,
+        http_token: Optional[Callable[[Any], Optional[str]]] = None,
+        use_redis: bool = True,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local_ttl = local_ttl
+        self.http_token = http_token
+        self.use_redis = use_redis
+        self.redis: Optional[redis.Redis] = None # set by `Ephaptic`, if it has Redis and `use_redis`
+
+        self._local: ExpiringStore = ExpiringStore(max_size)
+        self._by_user: ExpiringStore[Set[str]] = ExpiringStore(max_size) # Map[uid, digests], for `revoke_user`
+        self._loading: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def of(cls, spec: IdentityCacheSpec) -> 'IdentityCache':
+        # `identity_cache=60`, or `identity_cache={'ttl': 60, 'negative_ttl': 5, 'max_size': 10_000}`
+        if isinstance(spec, dict): return cls(**spec)
+        return cls(ttl=spec)
+
+    @staticmethod
+    def digest(kind: str, token) -> str:
+        # `revoke('abc')` has to find a request that was cached by its whole `Bearer abc` header.
+        if isinstance(token, str) and token[:7].lower() == 'bearer ': token = token[7:].strip()
+        return hashlib.sha256(kind.encode() + b':' + msgpack.dumps(token, default=repr)).hexdigest()
+
+    @staticmethod
+    def _key(digest: str) -> str:
+        return f'ephaptic:identity:{digest}'
+
+    async def resolve(self, kind: str, token, load: Callable[[], Awaitable[Any]]):
+        if not token: return await load() # nothing to key it by, and no one token to share it with
+
+        digest = self.digest(kind, token)
+        value = self._local.get(digest)
+        if value is not None:
+            self.hits += 1
+            return None if value is _NOBODY else value
+
+        loading = self._loading.get(digest)
+        if loading:
+            try:
+                return await asyncio.shield(loading)
+            except asyncio.CancelledError:
+                if not loading.cancelled(): raise # we were cancelled, not the load
+            return await load() # whoever was loading it went away halfway, so do it ourselves
+
+        loading = self._loading[digest] = asyncio.get_running_loop().create_future()
+        try:
+            uid = await self._resolve(digest, load)
+            loading.set_result(uid)
+            return uid
+        except asyncio.CancelledError:
+            loading.cancel()
+            raise
+        except Exception as e:
+            loading.set_exception(e)
+            loading.exception() # retrieved, even if nobody else was waiting
+            raise
+        finally:
+            del self._loading[digest]
+
+    async def _resolve(self, digest: str, load: Callable[[], Awaitable[Any]]):
+        if self.redis:
+            try:
+                cached = await self.redis.get(self._key(digest))
+                if cached is not None:
+                    self.hits += 1
+                    uid = msgpack.loads(cached)
+                    self._remember(digest, uid, self.local_ttl)
+                    return uid
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+        self.misses += 1
+        uid = await load()
+        ttl = self.ttl if uid is not None else self.negative_ttl
+        self._remember(digest, uid, min(ttl, self.local_ttl) if self.redis else ttl)
+
+        if self.redis:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.set(self._key(digest), msgpack.dumps(uid), px=int(ttl * 1000))
+                    if uid is not None:
+                        pipe.sadd(self._key(f'user:{uid}'), digest)
+                        pipe.expire(self._key(f'user:{uid}'), int(self.ttl) + 1)
+                    await pipe.execute()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+        return uid
+
+    def _remember(self, digest: str, uid, ttl: float):
+        now = time.monotonic()
+        self._local.set(digest, _NOBODY if uid is None else uid, now + ttl, now)
+        if uid is not None and isinstance(uid, typing.Hashable):
+            digests = self._by_user.get(uid, now) or set()
+            digests.add(digest)
+            self._by_user.set(uid, digests, now + ttl, now)
+
+    async def revoke(self, token):
+        """Forget a token (e.g. on logout), whichever loader resolved it."""
+        digests = [self.digest(kind, token) for kind in ('ws', 'http')]
+        for digest in digests: self._local.pop(digest)
+        if self.redis: await self.redis.delete(*[self._key(digest) for digest in digests])
+
+    async def revoke_user(self, uid):
+        """Forget every token that resolved to `uid` (e.g. they were banned, or changed their password)."""
+        digests = set(self._by_user.pop(uid) or ())
+        if self.redis:
+            index = self._key(f'user:{uid}')
+            digests.update(digest.decode() if isinstance(digest, bytes) else digest for digest in await self.redis.smembers(index))
+            await self.redis.delete(index, *[self._key(digest) for digest in digests])
+        for digest in digests: self._local.pop(digest)
+
+    def stats(self) -> Dict[str, typing.Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._local)}
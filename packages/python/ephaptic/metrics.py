@@ -0,0 +1,143 @@
+import bisect
+import math
+import typing
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value: float) -> str:
+    if value == math.inf: return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _labels(self, values: Labels, extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, values)]
+        if extra: pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join((f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}', *self.samples()))
+
+class Counter(Metric):
+    """
+    Only ever goes up. Recording is a dict update, no locks: everything records from the event
+    loop, and the odd increment from another thread can at worst be lost.
+
+    With `collect`, the values are read from somewhere else when the metrics are rendered.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), collect: Optional[Callable[[], Dict[Labels, float]]] = None):
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+        self.collect = collect
+
+    def inc(self, *labels: str, n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        if self.collect: self.values = dict(self.collect())
+        for labels, value in sorted(self.values.items()):
+            yield f'{self.name}{self._labels(labels)} {_number(value)}'
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels: str, n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - n
+
+    def set(self, *labels: str, value: float):
+        self.values[labels] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Labels, List[float]] = {} # Map[labels, [*per bucket counts, +Inf count, sum]]
+
+    def observe(self, value: float, *labels: str):
+        counts = self.values.get(labels)
+        if counts is None: counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, *labels: str) -> int:
+        counts = self.values.get(labels)
+        return int(sum(counts[:-1])) if counts else 0
+
+    def samples(self):
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip((*self.buckets, math.inf), counts):
+                cumulative += n
+                le = 'le="' + _number(bound) + '"'
+                yield f'{self.name}_bucket{self._labels(labels, le)} {_number(cumulative)}'
+            yield f'{self.name}_sum{self._labels(labels)} {_number(counts[-1])}'
+            yield f'{self.name}_count{self._labels(labels)} {_number(cumulative)}'
+
+M = typing.TypeVar('M', bound=Metric)
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self.metrics: raise ValueError(f"A metric called {metric.name!r} is already registered.")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Counter:
+        return self.register(Counter(name, help, labels, collect))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Everything, in the Prometheus text exposition format."""
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = Registry()
+
+rpc_calls = registry.counter('ephaptic_rpc_calls_total', 'RPCs handled, by function and outcome.', ('function', 'outcome'))
+rpc_duration = registry.histogram('ephaptic_rpc_duration_seconds', 'Time from an RPC being dispatched to its response (or the end of its stream).', ('function',))
+rpc_inflight = registry.gauge('ephaptic_rpc_inflight', 'RPCs currently running.', ('function',))
+streams_active = registry.gauge('ephaptic_streams_active', 'Streams currently open.', ('function',))
+stream_chunks = registry.counter('ephaptic_stream_chunks_total', 'Stream chunks sent.', ('function',))
+
+http_requests = registry.counter('ephaptic_http_requests_total', 'Router endpoints called over HTTP, by function and outcome.', ('function', 'outcome'))
+http_duration = registry.histogram('ephaptic_http_request_duration_seconds', 'Time spent in Router endpoints called over HTTP.', ('function',))
+
+connections = registry.gauge('ephaptic_connections', 'Open connections.')
+bytes_received = registry.counter('ephaptic_received_bytes_total', 'Bytes received from clients.')
+bytes_sent = registry.counter('ephaptic_sent_bytes_total', 'Bytes sent to clients.')
+outbound_messages = registry.counter('ephaptic_outbound_messages_total', 'Messages written to clients.')
+outbound_frames = registry.counter('ephaptic_outbound_frames_total', 'Frames written to clients. Messages per frame is how well the outbound queue coalesces.')
+
+broadcast_fanout = registry.histogram('ephaptic_broadcast_fanout', 'Connections each broadcast was delivered to, on this node.', buckets=FANOUT_BUCKETS)
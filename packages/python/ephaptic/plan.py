@@ -0,0 +1,122 @@
+import asyncio
+import inspect
+import typing
+from typing import Any, Callable, Dict, Optional
+
+import pydantic
+
+from .cache import ResponseCache
+from .coalesce import Coalescer
+from .decorators import META_KEY
+from .executors import Pool
+
+_STREAM_ORIGINS = ('AsyncGenerator', 'Generator', 'AsyncIterable', 'Iterable', 'AsyncIterator', 'Iterator')
+
+def _is_typed(tp) -> bool:
+    return bool(tp) and tp is not inspect.Signature.empty and tp is not typing.Any
+
+def _adapter(tp) -> Optional[pydantic.TypeAdapter]:
+    return pydantic.TypeAdapter(tp) if _is_typed(tp) else None
+
+def _is_stream_type(tp) -> bool:
+    return getattr(typing.get_origin(tp), '__name__', '') in _STREAM_ORIGINS
+
+def _chunk_type(return_type):
+    if _is_stream_type(return_type):
+        args = typing.get_args(return_type)
+        return args[0] if args else typing.Any
+    return return_type
+
+def _dump(payload, adapter: Optional[pydantic.TypeAdapter]):
+    if adapter:
+        validated = adapter.validate_python(payload, from_attributes=True)
+        return adapter.dump_python(validated, mode='json')
+    elif isinstance(payload, pydantic.BaseModel):
+        # incase dev returned basemodel and forgot to set return type
+        return payload.model_dump(mode='json')
+    else: return payload
+
+
+class ReturnValidationError(Exception):
+    """The function returned something that doesn't match its return type."""
+
+def kind_of(func: Callable) -> str:
+    if inspect.isasyncgenfunction(func): return 'async_gen'
+    if inspect.isgeneratorfunction(func): return 'sync_gen'
+    if inspect.iscoroutinefunction(func): return 'async'
+    return 'sync'
+
+def invoker(func: Callable, executor: Optional[Pool] = None) -> Callable[..., typing.Awaitable[Any]]:
+    # Same semantics as `Ephaptic._async`, but the branch is picked once instead of on every call.
+    match kind_of(func):
+        case 'async':
+            return func
+        case 'sync_gen' if executor:
+            # only a `ProcessPool` can run a generator
+            async def call_streamed(*args, **kwargs): return await executor.stream(func, *args, **kwargs)
+            return call_streamed
+        case 'async_gen' | 'sync_gen':
+            async def call_gen(*args, **kwargs): return func(*args, **kwargs)
+            return call_gen
+        case _ if executor:
+            async def call_pooled(*args, **kwargs): return await executor.run(func, *args, **kwargs)
+            return call_pooled
+        case _:
+            async def call_sync(*args, **kwargs): return await asyncio.to_thread(func, *args, **kwargs)
+            return call_sync
+
+
+class CallPlan:
+    """
+    Everything needed to dispatch a call to an exposed function, worked out once.
+
+    Resolving type hints, building the input model and the return/chunk `TypeAdapter`s is
+    far more expensive than the validation itself, so it happens here instead of per RPC.
+    """
+
+    def __init__(self, name: str, func: Callable, executor: Optional[Pool] = None):
+        self.name = name
+        self.func = func
+        self.meta: Dict[str, Any] = getattr(func, META_KEY, {})
+
+        self.hints = self.meta.get('hints') or typing.get_type_hints(func)
+        self.sig: inspect.Signature = self.meta.get('sig') or inspect.signature(func)
+        self.rate_limit = self.meta.get('rate_limit')
+        self.cache = ResponseCache.of(self.meta['cache']) if self.meta.get('cache') else None
+
+        self.kind = kind_of(func)
+        self.is_stream = self.kind in ('async_gen', 'sync_gen')
+        self.executor = executor
+        self.invoke = invoker(func, executor)
+        self.coalesce = Coalescer.of(name, self.meta['coalesce']) if self.meta.get('coalesce') and not self.is_stream else None
+
+        fields = {}
+        for param_name, param in self.sig.parameters.items():
+            default = param.default if param.default is not inspect.Parameter.empty else ...
+            fields[param_name] = (self.hints.get(param_name, Any), default)
+
+        self.input_model = pydantic.create_model(f'DynamicInputModel_{name}', **fields)
+        self.field_names = tuple(self.input_model.model_fields.keys())
+
+        self.return_type = self.meta.get('response_model') or self.hints.get('return', typing.Any)
+        self.return_adapter = None if _is_stream_type(self.return_type) else _adapter(self.return_type)
+        self.chunk_adapter = _adapter(_chunk_type(self.return_type))
+
+    def bind(self, args: list, kwargs: dict) -> Dict[str, Any]:
+        """Raises `TypeError` for bad arity/names, `pydantic.ValidationError` for bad values."""
+        bound = self.sig.bind(*args, **kwargs)
+        validated = self.input_model(**bound.arguments)
+        return {field_name: getattr(validated, field_name) for field_name in self.field_names}
+
+    def dump_result(self, result):
+        try:
+            return _dump(result, self.return_adapter)
+        except Exception as e:
+            raise ReturnValidationError(e) from e
+
+    async def call(self, arguments: Dict[str, Any]):
+        """Run it and dump its result, for callers that don't stream (see `coalesce`)."""
+        return self.dump_result(await self.invoke(**arguments))
+
+    def dump_chunk(self, chunk):
+        return _dump(chunk, self.chunk_adapter)
@@ -0,0 +1,71 @@
+import asyncio
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Set
+
+import redis.asyncio as redis
+
+PRESENCE_PREFIX = "ephaptic:presence:"
+NODE_CHANNEL_PREFIX = "ephaptic:node:"
+
+class Presence:
+    """
+    Which nodes hold connections for which users, kept in Redis.
+
+    Each user has a sorted set of node ids, scored by when that node's lease on the user runs
+    out. A node adds itself when a user's first connection arrives, removes itself when the last
+    one goes, and renews the leases of everyone it holds every `lease / 3` seconds, so a node
+    that dies without cleaning up stops receiving that user's events once its leases expire.
+    """
+
+    def __init__(self, client: redis.Redis, node_id: Optional[str] = None, lease: float = 30):
+        self.redis = client
+        self.node_id = node_id or uuid.uuid4().hex
+        self.channel = NODE_CHANNEL_PREFIX + self.node_id
+        self.lease = lease
+        self.users: Set[str] = set() # users with at least one connection on this node
+
+    @staticmethod
+    def key(user_id: str) -> str:
+        return PRESENCE_PREFIX + str(user_id)
+
+    async def join(self, user_id: str):
+        self.users.add(user_id)
+        await self._renew([user_id])
+
+    async def leave(self, user_id: str):
+        self.users.discard(user_id)
+        await self.redis.zrem(self.key(user_id), self.node_id)
+
+    async def _renew(self, user_ids: Iterable[str]):
+        expires = time.time() + self.lease
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                key = self.key(user_id)
+                pipe.zadd(key, {self.node_id: expires})
+                pipe.zremrangebyscore(key, '-inf', time.time()) # leases of nodes that died
+                pipe.expire(key, int(self.lease) + 1)
+            await pipe.execute()
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if self.users: await self._renew(list(self.users))
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    async def locate(self, user_ids: List[str]) -> Dict[str, List[str]]:
+        """Group `user_ids` by the node channels they're connected to. Offline users are left out."""
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids: pipe.zrangebyscore(self.key(user_id), now, '+inf')
+            results = await pipe.execute()
+
+        routes: Dict[str, List[str]] = {}
+        for user_id, nodes in zip(user_ids, results):
+            for node in nodes:
+                if isinstance(node, bytes): node = node.decode()
+                routes.setdefault(NODE_CHANNEL_PREFIX + node, []).append(user_id)
+        return routes
@@ -0,0 +1,351 @@
+import asyncio
+import collections
+import contextlib
+import math
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple, Union
+
+import redis.asyncio as redis
+
+from .store import ExpiringStore
+from .utils import Limit
+
+GCRA = 'gcra'
+SLIDING_WINDOW = 'sliding_window'
+ALGORITHMS = (GCRA, SLIDING_WINDOW)
+_ALIASES = {'token_bucket': GCRA}
+
+MODES = ('exact', 'hybrid')
+
+Check = Tuple[str, Limit] # (key, limit)
+
+_EPSILON = 1e-6 # so float error in `tat` doesn't refuse the last call of a burst
+
+def algorithm_of(name: str) -> str:
+    name = _ALIASES.get(name, name)
+    if name not in ALGORITHMS: raise ValueError(f"Unknown rate limit algorithm: {name!r}. Expected one of {ALGORITHMS}.")
+    return name
+
+def checks_for(func_name: str, limit: Union[Limit, Dict[str, Limit]], uid: Optional[str] = None, ip: Optional[str] = None) -> List[Check]:
+    """The keys a call is counted against. All of them have to allow it, or it's refused."""
+    prefix = f'ephaptic:rl:{func_name}'
+    if not isinstance(limit, dict):
+        return [(f'{prefix}:u:{uid}' if uid else f'{prefix}:ip:{ip}', limit)]
+
+    checks = []
+    if 'user' in limit and uid: checks.append((f'{prefix}:u:{uid}', limit['user']))
+    if 'ip' in limit and ip: checks.append((f'{prefix}:ip:{ip}', limit['ip']))
+    if 'function' in limit: checks.append((f'{prefix}:all', limit['function']))
+    return checks
+
+class Limiter:
+    """
+    Decides whether a call may go through.
+
+    - `gcra` (a token bucket): calls refill at `count / period`, and up to `burst` can go
+      through at once. No window boundaries, so no 2x bursts across them.
+    - `sliding_window`: at most `count` calls in any `period` seconds, exactly. Costs memory
+      per call, so it's for small limits (login attempts and the like).
+    """
+
+    def __init__(self, algorithm: str = GCRA):
+        self.algorithm = algorithm_of(algorithm)
+
+    async def hit(self, checks: List[Check]) -> float:
+        """Count one call against all of `checks`, if all of them allow it. Returns 0, or how many seconds until it would be allowed."""
+        raise NotImplementedError
+
+    async def close(self):
+        """Stop anything running in the background (see `Ephaptic.shutdown`)."""
+
+class LocalLimiter(Limiter):
+    """
+    In this process only. Used when there's no Redis, i.e. a single node.
+
+    State is kept for at most `max_keys` callers. Past that, the ones seen least recently are
+    forgotten (and get a fresh budget), so a client cycling through IPs can't grow it forever.
+    """
+
+    def __init__(self, algorithm: str = GCRA, max_keys: int = 100_000):
+        super().__init__(algorithm)
+        self._state: ExpiringStore = ExpiringStore(max_keys)
+
+    async def hit(self, checks: List[Check]) -> float:
+        now = time.monotonic()
+        decide = self._gcra if self.algorithm == GCRA else self._sliding_window
+        decisions = [decide(key, limit, now) for key, limit in checks]
+
+        retry_after = max((retry for retry, _ in decisions), default=0)
+        if retry_after: return retry_after
+
+        for (key, limit), (_, commit) in zip(checks, decisions): commit()
+        return 0
+
+    def _gcra(self, key: str, limit: Limit, now: float):
+        interval = limit.period / limit.count
+        tat = max(self._state.get(key, now) or now, now) # theoretical arrival time
+        new_tat = tat + interval
+        over = new_tat - now - interval * limit.burst
+        if over > _EPSILON: return over, None
+
+        def commit(): self._state.set(key, new_tat, new_tat, now)
+        return 0, commit
+
+    def _sliding_window(self, key: str, limit: Limit, now: float):
+        log: collections.deque = self._state.get(key, now) or collections.deque()
+        while log and log[0] <= now - limit.period: log.popleft()
+        if len(log) >= limit.count: return log[0] + limit.period - now, None
+
+        def commit():
+            log.append(now)
+            self._state.set(key, log, now + limit.period, now)
+        return 0, commit
+
+# KEYS: one per limit. ARGV: algorithm, a nonce, then count, period, burst for each key.
+# Every limit is checked first, and only if they all allow the call is it counted against them,
+# so a call refused by one limit doesn't use up the others.
+_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local algorithm = ARGV[1]
+local nonce = ARGV[2]
+local retry = 0
+local updates = {}
+
+for i, key in ipairs(KEYS) do
+    local count = tonumber(ARGV[i * 3])
+    local period = tonumber(ARGV[i * 3 + 1])
+    local burst = tonumber(ARGV[i * 3 + 2])
+
+    if algorithm == 'gcra' then
+        local interval = period / count
+        local tat = tonumber(redis.call('GET', key)) or now
+        if tat < now then tat = now end
+        local new_tat = tat + interval
+        local over = new_tat - now - interval * burst
+        if over > 0.000001 then
+            if over > retry then retry = over end
+        else
+            updates[i] = new_tat
+        end
+    else
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', now - period)
+        if redis.call('ZCARD', key) >= count then
+            local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+            local over = tonumber(oldest[2]) + period - now
+            if over > retry then retry = over end
+        else
+            updates[i] = period
+        end
+    end
+end
+
+if retry > 0 then return tostring(retry) end
+
+for i, key in ipairs(KEYS) do
+    if algorithm == 'gcra' then
+        redis.call('SET', key, tostring(updates[i]), 'PX', math.ceil((updates[i] - now) * 1000) + 1)
+    else
+        redis.call('ZADD', key, now, nonce)
+        redis.call('PEXPIRE', key, math.ceil(updates[i] * 1000))
+    end
+end
+return '0'
+"""
+
+class RedisLimiter(Limiter):
+    """Shared by every node. Each call is one `EVALSHA`, however many limits it's checked against."""
+
+    def __init__(self, client: redis.Redis, algorithm: str = GCRA):
+        super().__init__(algorithm)
+        self.redis = client
+        self._script = client.register_script(_SCRIPT) # EVALSHA, falling back to EVAL the first time
+
+    async def hit(self, checks: List[Check]) -> float:
+        if not checks: return 0
+        args = [self.algorithm, uuid.uuid4().hex]
+        for _, limit in checks: args += [limit.count, limit.period, limit.burst]
+        return float(await self._script(keys=[f'{key}:{self.algorithm}' for key, _ in checks], args=args))
+
+# KEYS: one per limit. ARGV: count, period, burst, and how many calls to lease, for each key.
+# Returns, per key, how many were leased (possibly fewer than asked, or none) and, if none, how
+# long until one would be available.
+_LEASE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local out = {}
+
+for i, key in ipairs(KEYS) do
+    local count = tonumber(ARGV[i * 4 - 3])
+    local period = tonumber(ARGV[i * 4 - 2])
+    local burst = tonumber(ARGV[i * 4 - 1])
+    local want = tonumber(ARGV[i * 4])
+
+    local interval = period / count
+    local tat = tonumber(redis.call('GET', key)) or now
+    if tat < now then tat = now end
+
+    local available = math.floor((interval * burst - (tat - now)) / interval + 0.000001)
+    local granted = math.max(0, math.min(want, available))
+    if granted > 0 then
+        local new_tat = tat + interval * granted
+        redis.call('SET', key, tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000) + 1)
+        out[i * 2 - 1] = granted
+        out[i * 2] = '0'
+    else
+        out[i * 2 - 1] = 0
+        out[i * 2] = tostring(tat - now + interval - interval * burst)
+    end
+end
+return out
+"""
+
+class _Lease:
+    def __init__(self):
+        self.tokens = 0
+        self.empty_until = 0.0 # Redis said there's nothing left until then, so don't ask again before
+        self.requested: Optional[asyncio.Future] = None # a top up is on its way
+        self.lock = asyncio.Lock() # held by whoever is waiting on a top up to spend from it
+
+class HybridLimiter(RedisLimiter):
+    """
+    Counts locally, from slices of the budget leased from Redis.
+
+    Each node leases up to `slice` of a limit's count at a time (at least one call, and at most
+    its burst), and lets calls through from its lease without going to Redis. When a lease is half
+    used, it's topped up in the background, and every top up due in the same loop tick goes out
+    as one script call. A call only waits on Redis when its node has nothing left to spend.
+
+    A smaller `slice` is more accurate (less budget sits unused on idle nodes) but goes to Redis
+    more often. A node never spends more than it leased, and leased calls that aren't used within
+    `lease_ttl` seconds are given up, so the error is towards letting fewer calls through.
+
+    The exception is when Redis can't be reached: calls are then limited in memory on each node
+    instead, until it's back, so every node gets the whole limit to itself.
+    """
+
+    def __init__(self, client: redis.Redis, algorithm: str = GCRA, slice: float = 0.1, lease_ttl: float = 5, max_keys: int = 100_000):
+        if algorithm_of(algorithm) != GCRA: raise ValueError("Hybrid rate limiting leases from a token bucket, so it only supports the 'gcra' algorithm.")
+        super().__init__(client, algorithm)
+        self.slice = slice
+        self.lease_ttl = lease_ttl
+        self.fallback = LocalLimiter(algorithm, max_keys)
+        self.degraded = False
+
+        self._leases: ExpiringStore[_Lease] = ExpiringStore(max_keys)
+        self._lease_script = client.register_script(_LEASE_SCRIPT)
+        self._pending: Dict[str, Tuple[Limit, _Lease]] = {} # sent on the next flush
+        self._flush: Optional[asyncio.Task] = None
+        self._recovering: Optional[asyncio.Task] = None # see `_degrade`
+
+    def _size(self, limit: Limit) -> int:
+        # A slice of the rate, so small bursts don't mean a trip to Redis for every call, but never
+        # more than the bucket can hold.
+        return min(limit.burst, max(1, int(limit.count * self.slice)))
+
+    async def hit(self, checks: List[Check]) -> float:
+        if self.degraded: return await self.fallback.hit(checks)
+
+        now = time.monotonic()
+        leases = []
+        for key, limit in checks:
+            lease = self._leases.get(key, now)
+            if lease is None:
+                lease = _Lease()
+                self._leases.set(key, lease, now + self.lease_ttl, now)
+            leases.append(lease)
+
+        if any(lease.tokens < 1 for lease in leases):
+            # Something has to come from Redis first. One caller per lease waits on it at a time
+            # (locked in key order, so two calls checked against the same keys can't deadlock),
+            # and whatever arrives is checked again before spending: others may have spent it.
+            async with contextlib.AsyncExitStack() as stack:
+                for _, lease in sorted(zip((key for key, _ in checks), leases), key=lambda pair: pair[0]):
+                    await stack.enter_async_context(lease.lock)
+                try:
+                    retry_after = await self._refill(checks, leases)
+                except Exception:
+                    return await self._degrade(checks)
+                if retry_after: return retry_after
+                self._spend(checks, leases)
+            return 0
+
+        self._spend(checks, leases)
+        return 0
+
+    async def _refill(self, checks: List[Check], leases: List[_Lease]) -> float:
+        # Returns 0 once every lease has a call to spend, or how long until one of them would.
+        while True:
+            now = time.monotonic()
+            short = [(key, limit, lease) for (key, limit), lease in zip(checks, leases) if lease.tokens < 1]
+            if not short: return 0
+
+            retry_after = max(lease.empty_until - now for _, _, lease in short)
+            if retry_after > 0: return retry_after
+
+            await asyncio.gather(*(self._request(key, limit, lease) for key, limit, lease in short)) # all in one round trip
+
+    def _spend(self, checks: List[Check], leases: List[_Lease]):
+        for (key, limit), lease in zip(checks, leases):
+            lease.tokens -= 1
+            if lease.tokens < self._size(limit) / 2: self._request(key, limit, lease) # in the background
+
+    def _request(self, key: str, limit: Limit, lease: _Lease) -> asyncio.Future:
+        if lease.requested is None:
+            lease.requested = asyncio.get_running_loop().create_future()
+            lease.requested.add_done_callback(lambda f: f.cancelled() or f.exception()) # nobody may be waiting on a background top up
+            self._pending[key] = (limit, lease)
+            if self._flush is None: self._flush = asyncio.create_task(self._send())
+        return lease.requested
+
+    async def _send(self):
+        await asyncio.sleep(0) # let everything due in this tick queue up
+        pending, self._pending, self._flush = self._pending, {}, None
+
+        args = []
+        for limit, lease in pending.values(): args += [limit.count, limit.period, limit.burst, self._size(limit) - max(lease.tokens, 0)]
+        try:
+            out = await self._lease_script(keys=[f'{key}:{self.algorithm}' for key in pending], args=args)
+            error = None
+        except Exception as e:
+            error = e
+
+        now = time.monotonic()
+        for n, (key, (_, lease)) in enumerate(pending.items()):
+            requested, lease.requested = lease.requested, None
+            if error is not None:
+                requested.set_exception(error)
+                continue
+
+            granted, retry_after = int(out[n * 2]), float(out[n * 2 + 1])
+            lease.tokens += granted
+            if granted: self._leases.set(key, lease, now + self.lease_ttl, now)
+            else: lease.empty_until = now + retry_after
+            requested.set_result(None)
+
+    async def _degrade(self, checks: List[Check]) -> float:
+        if not self.degraded:
+            import traceback
+            traceback.print_exc()
+            self.degraded = True
+            self._recovering = asyncio.create_task(self._recover())
+        return await self.fallback.hit(checks)
+
+    async def _recover(self):
+        while self.degraded:
+            await asyncio.sleep(1)
+            try:
+                await self.redis.ping()
+                self.degraded = False
+            except Exception: ... # still down
+        self._recovering = None
+
+    async def close(self):
+        recovering, self._recovering = self._recovering, None
+        if recovering:
+            recovering.cancel()
+            await asyncio.gather(recovering, return_exceptions=True)
+
+def retry_seconds(retry_after: float) -> int:
+    return max(1, math.ceil(retry_after))
@@ -0,0 +1,136 @@
+import asyncio
+import msgpack
+import typing
+from typing import Optional, Dict, Any, Set
+
+from . import compression
+from .transports import Transport
+from .transports.outbound import OutboundScheduler, RESPONSE
+
+class Credits:
+    """How many more stream chunks the client has room for."""
+
+    def __init__(self, window: int):
+        self.available = window
+        self.on_grant: Optional[typing.Callable[[int], None]] = None # e.g. `SyncStream.allow`, so the producer can run ahead by as much
+        self._event = asyncio.Event()
+
+    def grant(self, n: int):
+        self.available += n
+        self._event.set()
+        if self.on_grant: self.on_grant(n)
+
+    async def acquire(self):
+        while self.available <= 0:
+            self._event.clear()
+            await self._event.wait()
+        self.available -= 1
+
+class Session:
+    """
+    Per-connection state for `Ephaptic.handle_transport`.
+
+    Every `rpc` frame runs as its own task, so a slow call or a long stream no longer blocks
+    the rest of the connection. Tasks are created from the receive loop, so each one gets its
+    own copy of the context and the ctx vars set while dispatching never leak between calls.
+
+    At most `max_inflight` calls run at once; the rest wait for a slot in their own task, so the
+    receive loop never blocks and `cancel`/`credit` frames always get through. Up to `max_queued`
+    calls can be waiting, after which the connection is `backlogged` and new calls are refused.
+    """
+
+    def __init__(self, transport: Transport, max_inflight: int = 64, max_queued: int = 1024, **outbound):
+        self.transport = transport
+        self.uid = None
+        self.flow = False
+        self.calls: Dict[Any, asyncio.Task] = {} # Map[call_id, Task]
+        self.tasks: Set[asyncio.Task] = set()
+        self.credits: Dict[Any, Credits] = {} # Map[call_id, Credits], for flow-controlled streams
+
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._capacity = max_inflight + max_queued
+        self.active = 0 # calls running or waiting for a slot
+        self._ordered_tail: Optional[asyncio.Task] = None
+
+        self._task: Optional[asyncio.Task] = None
+        self.outbound = OutboundScheduler(transport, on_disconnect=self._kick, **outbound)
+        transport.outbound = self.outbound
+
+    def start(self, multi: bool = False, codec: Optional[compression.Codec] = None, compress_threshold: Optional[int] = None):
+        self.outbound.multi = multi # client can decode several messages per frame
+        self.outbound.codec = codec
+        self.outbound.compress_threshold = compress_threshold
+        self.outbound.start()
+        self._task = asyncio.current_task() # the receive loop, see `_kick`
+
+    def _kick(self):
+        # The scheduler gave up on a slow consumer; stop reading from it too, which closes the session.
+        if self._task and self._task is not asyncio.current_task(): self._task.cancel()
+
+    async def send(self, message: dict, lane: int = RESPONSE):
+        await self.send_encoded(msgpack.dumps(message), lane)
+
+    async def send_encoded(self, payload: bytes, lane: int = RESPONSE):
+        await self.outbound.send(self.outbound.encode(payload), lane)
+
+    @property
+    def backlogged(self) -> bool:
+        return self.active >= self._capacity
+
+    async def spawn(self, call_id, func: typing.Callable[..., typing.Coroutine], *args, ordered: bool = False, gated: bool = True) -> asyncio.Task:
+        # `gated` tasks take an in-flight slot before running. Bookkeeping (e.g. a batch's reply) doesn't.
+        if gated: self.active += 1
+        after = self._ordered_tail if ordered else None
+        task = asyncio.create_task(self._run(func, args, after, gated))
+        if ordered: self._ordered_tail = task
+
+        self.tasks.add(task)
+        if call_id is not None: self.calls[call_id] = task
+        task.add_done_callback(lambda t: self._forget(call_id, t))
+        return task
+
+    async def _run(self, func: typing.Callable[..., typing.Coroutine], args: tuple, after: Optional[asyncio.Task], gated: bool):
+        acquired = False
+        try:
+            if after and not after.done():
+                # `ordered` calls run one at a time, in the order they arrived.
+                await asyncio.wait([after])
+            if gated:
+                await self._slots.acquire()
+                acquired = True
+            await func(*args)
+        except Transport.ConnectionClosed:
+            ...
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        finally:
+            if acquired: self._slots.release()
+            if gated: self.active -= 1
+
+    def _forget(self, call_id, task: asyncio.Task):
+        self.tasks.discard(task)
+        if self.calls.get(call_id) is task: del self.calls[call_id]
+        if self._ordered_tail is task: self._ordered_tail = None
+
+    def open_credits(self, call_id, window: int) -> Credits:
+        credits = self.credits[call_id] = Credits(window)
+        return credits
+
+    def close_credits(self, call_id):
+        self.credits.pop(call_id, None)
+
+    def grant(self, call_id, n: int):
+        credits = self.credits.get(call_id)
+        if credits and isinstance(n, int) and n > 0: credits.grant(n)
+
+    def cancel(self, call_id):
+        task = self.calls.get(call_id)
+        if task: task.cancel()
+
+    async def close(self):
+        tasks = list(self.tasks)
+        for task in tasks: task.cancel()
+        if tasks: await asyncio.gather(*tasks, return_exceptions=True)
+        await self.outbound.close()
+        self.transport.outbound = None
@@ -0,0 +1,100 @@
+import collections
+import heapq
+import time
+import typing
+from typing import Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+V = TypeVar('V')
+
+class ExpiringStore(Generic[V]):
+    """
+    A bounded in-memory map whose entries expire.
+
+    Expiry is a timing wheel with one-second slots: each entry is filed under the second it
+    expires in, and every `get`/`set` reaps at most `sweep` keys from the slots that are fully
+    in the past. So there's never a full scan in the request path, and memory held by expired
+    keys is given back at roughly the rate entries are written. On top of that, at most
+    `max_size` entries are kept, evicting the least recently used one.
+
+    Times are `time.monotonic()` seconds, unless you pass your own `now`.
+    """
+
+    def __init__(self, max_size: int = 100_000, sweep: int = 16):
+        self.max_size = max_size
+        self.sweep = sweep
+        self._data: collections.OrderedDict[Hashable, Tuple[V, float]] = collections.OrderedDict() # (value, expires_at), least recently used first
+        self._slots: Dict[int, List[Hashable]] = {} # Map[second, keys expiring in it]
+        self._due: List[int] = [] # heap of the seconds in `_slots`
+
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable):
+        return self.get(key) is not None
+
+    def get(self, key: Hashable, now: Optional[float] = None) -> Optional[V]:
+        if now is None: now = time.monotonic()
+        self._reap(now)
+
+        entry = self._data.get(key)
+        if entry is None: return None
+        if entry[1] <= now:
+            del self._data[key]
+            self.expired += 1
+            return None
+
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: Hashable, value: V, expires_at: float, now: Optional[float] = None):
+        if now is None: now = time.monotonic()
+        self._reap(now)
+
+        previous = self._data.get(key)
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+
+        second = int(expires_at)
+        if previous is None or int(previous[1]) != second:
+            # The old slot (if any) keeps a stale reference, which `_reap` skips over.
+            slot = self._slots.get(second)
+            if slot is None:
+                slot = self._slots[second] = []
+                heapq.heappush(self._due, second)
+            slot.append(key)
+
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        self._data.clear()
+        self._slots.clear()
+        self._due.clear()
+
+    def _reap(self, now: float):
+        budget = self.sweep
+        current = int(now)
+        while budget and self._due and self._due[0] < current:
+            second = self._due[0]
+            slot = self._slots[second]
+            while slot and budget:
+                key = slot.pop()
+                budget -= 1
+                entry = self._data.get(key)
+                if entry is not None and entry[1] <= now: # it may have been set again since, with a later expiry
+                    del self._data[key]
+                    self.expired += 1
+            if not slot:
+                heapq.heappop(self._due)
+                del self._slots[second]
+
+    def stats(self) -> Dict[str, typing.Any]:
+        return {'size': len(self._data), 'slots': len(self._slots), 'expired': self.expired, 'evicted': self.evicted}
@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    from .executors import ThreadPool
+
+_DONE = object()
+
+class _Raised:
+    def __init__(self, error: BaseException): self.error = error
+
+class SyncStream:
+    """
+    Drive a sync generator from the event loop.
+
+    The generator runs on one worker thread for its whole life, rather than hopping to the
+    executor (and copying the context) once per item. The worker comes from `pool` (see
+    `executors.STREAMS`), so `start()` raises `ExecutorOverloaded` when it's saturated, or from
+    the loop's default executor without one. Either way, there's a bound on the threads.
+
+    That thread fills a bounded buffer, and only wakes the loop when the consumer is actually
+    parked waiting on an empty buffer, so a fast generator hands over items in batches instead
+    of one `call_soon_threadsafe` per item. With `budget`, it also stops after that many items
+    until `allow()` gives it more, so it never runs ahead of the client's stream credits.
+
+    `aclose()` stops the thread after the item it's producing, and the generator is closed on
+    its own thread, so its `finally:` blocks run where it was running.
+    """
+
+    def __init__(self, gen: typing.Generator, buffer: int = 64, name: str = 'ephaptic-stream', pool: typing.Optional['ThreadPool'] = None, budget: typing.Optional[int] = None):
+        self._gen = gen
+        self._maxsize = max(1, buffer)
+        self._name = name
+        self._pool = pool
+        self._budget = budget # items the generator may still produce; `None` is as many as fit in the buffer
+        self._context = contextvars.copy_context() # once, so the generator sees the creator's ctx vars
+
+        self._items: collections.deque = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._stopped = False
+        self._finished = False
+
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._waiter: typing.Optional[asyncio.Future] = None
+        self._wakeup_pending = False
+        self._future: typing.Optional[typing.Union[concurrent.futures.Future, asyncio.Future]] = None # the worker, once started
+
+    def __aiter__(self):
+        return self
+
+    async def start(self):
+        if self._future is not None: return
+        self._loop = asyncio.get_running_loop()
+        if self._pool:
+            self._future = await self._pool.start(self._context.run, self._produce)
+        else:
+            self._future = self._loop.run_in_executor(None, self._context.run, self._produce)
+
+    def allow(self, n: int):
+        with self._cond:
+            if self._budget is not None: self._budget += n
+            self._cond.notify()
+
+    def _produce(self):
+        thread = threading.current_thread()
+        pool_name, thread.name = thread.name, self._name # for the duration, so it's recognisable in a thread dump
+        try:
+            while True:
+                with self._cond:
+                    while (len(self._items) >= self._maxsize or self._budget == 0) and not self._stopped:
+                        self._cond.wait()
+                    if self._stopped: return
+                    if self._budget is not None: self._budget -= 1
+
+                try:
+                    item = next(self._gen)
+                except StopIteration:
+                    item = _DONE
+                except BaseException as e:
+                    item = _Raised(e)
+
+                with self._cond:
+                    self._items.append(item)
+                    self._wake()
+
+                if item is _DONE or isinstance(item, _Raised): return
+        finally:
+            self._gen.close()
+            thread.name = pool_name
+
+    def _wake(self):
+        # Called with the lock held. At most one wakeup is in flight, and only if someone is waiting.
+        if self._waiter is not None and not self._wakeup_pending:
+            self._wakeup_pending = True
+            try:
+                self._loop.call_soon_threadsafe(self._resolve_waiter)
+            except RuntimeError: ... # loop is closed, nobody is left to wake
+
+    def _resolve_waiter(self):
+        with self._cond:
+            waiter, self._waiter = self._waiter, None
+            self._wakeup_pending = False
+        if waiter is not None and not waiter.done(): waiter.set_result(None)
+
+    async def __anext__(self):
+        if self._finished: raise StopAsyncIteration
+        if self._future is None: await self.start()
+
+        while True:
+            with self._cond:
+                if self._items:
+                    item = self._items.popleft()
+                    self._cond.notify()
+                    break
+                self._waiter = self._loop.create_future()
+                waiter = self._waiter
+            await waiter
+
+        if item is _DONE:
+            self._finished = True
+            raise StopAsyncIteration
+        if isinstance(item, _Raised):
+            self._finished = True
+            raise item.error
+        return item
+
+    async def aclose(self):
+        self._finished = True
+        if self._future is None:
+            self._gen.close()
+            return
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
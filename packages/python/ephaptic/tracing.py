@@ -0,0 +1,125 @@
+import contextlib
+import time
+import typing
+from typing import Any, Dict, List, Optional
+
+# Phases of a call, in the order they happen. `decode` is the frame the call arrived in.
+DECODE, VALIDATE, HANDLER, STREAM, RETURN_VALIDATION, SEND = 'decode', 'validate', 'handler', 'stream', 'return_validation', 'send'
+
+class Span:
+    """
+    One call (`rpc` or `http`), or one phase of it (`parent` is then the call's span).
+
+    `trace` is the trace context the client sent in its `rpc` frame, if any (e.g. W3C
+    `{'traceparent': ..., 'tracestate': ...}`). Times are `time.time_ns()`. Hooks can keep
+    whatever they need between `on_start` and `on_end` in `state`.
+    """
+
+    __slots__ = ('name', 'call_id', 'function', 'user', 'trace', 'parent', 'start_ns', 'end_ns', 'error', 'attributes', 'state')
+
+    def __init__(self, name: str, call_id=None, function: Optional[str] = None, user=None, trace: Optional[Dict[str, str]] = None, parent: Optional['Span'] = None, start_ns: Optional[int] = None):
+        self.name = name
+        self.call_id = call_id
+        self.function = function
+        self.user = user
+        self.trace = trace
+        self.parent = parent
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[BaseException] = None
+        self.attributes: Dict[str, Any] = {}
+        self.state: Dict[Any, Any] = {}
+
+    @property
+    def duration(self) -> Optional[float]:
+        return (self.end_ns - self.start_ns) / 1e9 if self.end_ns is not None else None
+
+    def __repr__(self):
+        return f'<Span {self.name} {self.function}#{self.call_id} {self.duration}s>'
+
+class Hook:
+    """Subclass and `add_hook` it. Both are called on the event loop, and shouldn't block."""
+
+    def on_start(self, span: Span): ...
+    def on_end(self, span: Span): ...
+
+hooks: List[Hook] = []
+
+def add_hook(hook: Hook) -> Hook:
+    hooks.append(hook)
+    return hook
+
+def remove_hook(hook: Hook):
+    if hook in hooks: hooks.remove(hook)
+
+def _call_hooks(method: str, span: Span):
+    for hook in hooks:
+        try:
+            getattr(hook, method)(span)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+def start(name: str, **kwargs) -> Optional[Span]:
+    """A new span, or `None` if there are no hooks (which every other function here takes as "don't bother")."""
+    if not hooks: return None
+    span = Span(name, **kwargs)
+    _call_hooks('on_start', span)
+    return span
+
+def end(span: Optional[Span], error: Optional[BaseException] = None, end_ns: Optional[int] = None, **attributes):
+    if span is None: return
+    span.end_ns = end_ns or time.time_ns()
+    if error is not None: span.error = error
+    span.attributes.update(attributes)
+    _call_hooks('on_end', span)
+
+def record(parent: Optional[Span], name: str, start_ns: int, end_ns: int):
+    """A phase that already happened (e.g. decoding the frame, before we knew which call it was)."""
+    if parent is None: return
+    span = Span(name, parent.call_id, parent.function, parent.user, parent=parent, start_ns=start_ns)
+    _call_hooks('on_start', span)
+    end(span, end_ns=end_ns)
+
+class _Phase:
+    __slots__ = ('parent', 'name', 'span')
+
+    def __init__(self, parent: Span, name: str):
+        self.parent = parent
+        self.name = name
+
+    def __enter__(self) -> Span:
+        parent = self.parent
+        self.span = Span(self.name, parent.call_id, parent.function, parent.user, parent=parent)
+        _call_hooks('on_start', self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        end(self.span, exc)
+
+_NOOP = contextlib.nullcontext()
+
+def phase(parent: Optional[Span], name: str) -> typing.ContextManager[Optional[Span]]:
+    # Without a parent (i.e. no hooks when the call started) this is a shared no-op.
+    if parent is None: return _NOOP
+    return _Phase(parent, name)
+
+class Recorder(Hook):
+    """Keeps every finished span, e.g. for tests: `recorder = tracing.add_hook(tracing.Recorder())`."""
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def on_end(self, span: Span):
+        self.spans.append(span)
+
+    def find(self, name: Optional[str] = None, function: Optional[str] = None, call_id=None) -> List[Span]:
+        return [
+            span for span in self.spans
+            if (name is None or span.name == name)
+            and (function is None or span.function == function)
+            and (call_id is None or span.call_id == call_id)
+        ]
+
+    def clear(self):
+        self.spans.clear()
@@ -2,9 +2,13 @@ from typing import Optional
 
 class Transport:
     remote_addr: Optional[str] = None # usually, IP address (for most common transport types, like websocket, tcp/udp, etc.)
+    outbound: Optional['OutboundScheduler'] = None # set by `Ephaptic.handle_transport` for the lifetime of the connection
 
     class ConnectionClosed(Exception):
         pass
 
     async def send(self, data: bytes): raise NotImplementedError()
-    async def receive(self) -> bytes: raise NotImplementedError()
\ No newline at end of file
+    async def receive(self) -> bytes: raise NotImplementedError()
+    async def close(self, code: int = 1000): ... # optional: transports that can hang up on the peer should
+
+from .outbound import OutboundScheduler
@@ -0,0 +1,151 @@
+import asyncio
+import collections
+from typing import Deque, Optional, Tuple
+
+from . import Transport
+
+class Link:
+    """
+    One direction of a `pipe`: frames sent into it come out the other end `latency` seconds
+    later, no faster than `bandwidth` bytes per second (if set).
+
+    At most `buffer` bytes can be in the link at once (sent, but not yet received by the other
+    end), like a socket's send and receive buffers together. Once it's full, `put` waits for the
+    reader to catch up, which is what lets a slow reader push back on the writer.
+    """
+
+    def __init__(self, latency: float = 0.0, bandwidth: Optional[float] = None, buffer: int = 64 * 1024):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.buffer = buffer
+
+        self._frames: Deque[Tuple[float, bytes]] = collections.deque() # (arrives_at, data)
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._wire_free_at = 0.0 # when the last frame finishes going out, at `bandwidth`
+        self.buffered = 0
+        self.closed = False
+        self.close_code: Optional[int] = None
+
+        self.frames = 0 # frames delivered
+        self.bytes = 0
+
+    async def put(self, data: bytes):
+        # A frame bigger than the whole buffer still goes through, on its own.
+        while self.buffered and self.buffered + len(data) > self.buffer and not self.closed:
+            self._writable.clear()
+            await self._writable.wait()
+        if self.closed: raise Transport.ConnectionClosed
+
+        now = asyncio.get_running_loop().time()
+        sent_at = now
+        if self.bandwidth:
+            sent_at = max(now, self._wire_free_at) + len(data) / self.bandwidth
+            self._wire_free_at = sent_at
+
+        self._frames.append((sent_at + self.latency, data))
+        self.buffered += len(data)
+        self._readable.set()
+
+    async def get(self) -> bytes:
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._frames:
+                arrives_at, data = self._frames[0]
+                delay = arrives_at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                self._frames.popleft()
+                self.buffered -= len(data)
+                self.frames += 1
+                self.bytes += len(data)
+                self._writable.set()
+                return data
+
+            # Whatever was already sent is still delivered after a close, like a socket.
+            if self.closed: raise Transport.ConnectionClosed
+            self._readable.clear()
+            await self._readable.wait()
+
+    def close(self, code: int = 1000):
+        if self.closed: return
+        self.closed = True
+        self.close_code = code
+        self._readable.set()
+        self._writable.set()
+
+class MemoryTransport(Transport):
+    """
+    One end of a `pipe`. Sends go into `outgoing`, receives come from `incoming` (the other
+    end's `outgoing`).
+
+    `pause()` stops this end from reading (`receive` waits until `resume()`), so the other end's
+    sends back up once `buffer` is full, like a client that stopped reading its socket.
+    """
+
+    def __init__(self, outgoing: Link, incoming: Link, remote_addr: str = 'memory'):
+        self.outgoing = outgoing
+        self.incoming = incoming
+        self.remote_addr = remote_addr
+        self.closed = False
+        self.peer: Optional['MemoryTransport'] = None # the other end
+        self.server: Optional[asyncio.Task] = None # see `connect`
+        self._reading = asyncio.Event()
+        self._reading.set()
+
+    async def send(self, data: bytes):
+        await self.outgoing.put(data)
+
+    async def receive(self) -> bytes:
+        await self._reading.wait()
+        if self.closed: raise Transport.ConnectionClosed
+        return await self.incoming.get()
+
+    async def close(self, code: int = 1000):
+        # The other end still gets what we already sent; what it sent us is thrown away.
+        self.closed = True
+        self.outgoing.close(code)
+        self.incoming.close(code)
+        self.incoming._frames.clear()
+        self.incoming.buffered = 0
+        self._reading.set()
+
+    @property
+    def close_code(self) -> Optional[int]:
+        return self.outgoing.close_code
+
+    def pause(self): self._reading.clear()
+    def resume(self): self._reading.set()
+
+def pipe(latency: float = 0.0, bandwidth: Optional[float] = None, buffer: int = 64 * 1024) -> Tuple[MemoryTransport, MemoryTransport]:
+    """
+    Two connected transports, `(client, server)`. `latency` is one way, in seconds; `bandwidth`
+    is in bytes per second; `buffer` is in bytes. Both directions get the same settings.
+    """
+    up = Link(latency, bandwidth, buffer)
+    down = Link(latency, bandwidth, buffer)
+    client, server = MemoryTransport(up, down), MemoryTransport(down, up)
+    client.peer, server.peer = server, client
+    return client, server
+
+async def connect(ephaptic, auth=None, window: Optional[int] = None, latency: float = 0.0, bandwidth: Optional[float] = None, buffer: int = 64 * 1024):
+    """
+    A client connected straight to `ephaptic.handle_transport`, in this process, through a `pipe`:
+
+        client = await memory.connect(ephaptic, auth='user123', latency=0.05)
+        await client.add(1, 2)
+
+    The server side runs as a task, `client.transport.server`, until either end closes, on
+    `client.transport.peer`.
+    """
+    from ..client.client import EphapticClient
+
+    client_end, server_end = pipe(latency, bandwidth, buffer)
+    client_end.server = asyncio.create_task(ephaptic.handle_transport(server_end))
+
+    client = EphapticClient(auth=auth, window=window, transport=client_end)
+    await client.connect()
+    return client
@@ -0,0 +1,225 @@
+import asyncio
+import collections
+import time
+import typing
+import weakref
+from typing import Callable, Deque, Dict, List, Optional
+
+from . import Transport
+from .. import compression, metrics
+
+# Lanes, highest priority first. Everything belonging to one stream (header, chunks, done)
+# goes through CHUNK, so a stream's frames can't overtake each other.
+RESPONSE, CHUNK, EVENT = 0, 1, 2
+LANES = (RESPONSE, CHUNK, EVENT)
+LANE_NAMES = ('response', 'chunk', 'event')
+
+# What `post` does when the event lane is full, i.e. the client isn't reading as fast as we broadcast.
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+class OutboundScheduler:
+    """
+    The single writer for a transport.
+
+    Everything sent to a connection (RPC responses, stream chunks, events) is queued here and
+    written by one task. Responses always go out before queued chunks, and chunks before events,
+    so a flood of broadcasts can't delay an RPC result.
+
+    If the client said it can decode several msgpack messages per frame (`multi` in `init`),
+    whatever is queued by the time the writer runs (i.e. everything queued in the same loop
+    tick) is concatenated into one frame, up to `max_frame_bytes`.
+
+    Messages of at least `compress_threshold` bytes are compressed with the `codec` negotiated
+    in `init`, if any (see `encode`).
+
+    Broadcast fan-out only ever `post`s (it never waits on a connection). When the event lane is
+    full, `policy` decides between dropping the oldest queued event, dropping the new one, or
+    disconnecting the client. Drops, disconnects, and messages that sat in the queue for longer
+    than `delay_threshold` seconds are counted, here and in the shared `counters` if given.
+    """
+
+    hang_up_timeout = 1.0 # for the close handshake of a disconnected slow consumer, see `close`
+
+    def __init__(
+        self,
+        transport: Transport,
+        multi: bool = False,
+        max_queue: int = 256,
+        max_events: int = 1024,
+        max_frame_bytes: int = 64 * 1024,
+        policy: str = DROP_OLDEST,
+        delay_threshold: float = 1.0,
+        counters: Optional[typing.Counter[str]] = None,
+        on_disconnect: Optional[Callable[[], None]] = None,
+    ):
+        if policy not in POLICIES: raise ValueError(f"Unknown slow consumer policy: {policy!r}. Expected one of {POLICIES}.")
+
+        self.transport = transport
+        self.multi = multi
+        self.max_frame_bytes = max_frame_bytes
+        self._limits = (max_queue, max_queue, max_events)
+
+        self.policy = policy
+        self.delay_threshold = delay_threshold
+        self.counters = counters if counters is not None else collections.Counter()
+        self.on_disconnect = on_disconnect
+
+        self.codec: Optional[compression.Codec] = None
+        self.compress_threshold: Optional[int] = None
+
+        self._lanes: typing.Tuple[Deque[typing.Tuple[bytes, float]], ...] = tuple(collections.deque() for _ in LANES) # (payload, queued_at)
+        self._space = tuple(asyncio.Event() for _ in LANES)
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._hanging_up: Optional[asyncio.Task] = None # see `_disconnect`
+        self.closed = False
+
+        self.messages = 0 # messages written
+        self.frames = 0 # frames written, so `messages / frames` is the coalescing ratio
+        self.bytes = 0
+        self.dropped = 0
+        self.delayed = 0
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write())
+        _open.add(self)
+
+    async def close(self):
+        self.closed = True
+        _open.discard(self)
+        for space in self._space: space.set() # wake up blocked senders so they see `closed`
+        if self._writer:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+        if self._hanging_up:
+            # A stalled socket may never finish the close handshake, so it only gets so long.
+            await asyncio.wait([self._hanging_up], timeout=self.hang_up_timeout)
+            self._hanging_up.cancel()
+            await asyncio.gather(self._hanging_up, return_exceptions=True)
+
+    @property
+    def depth(self) -> int:
+        return sum(len(lane) for lane in self._lanes)
+
+    @property
+    def coalescing_ratio(self) -> float:
+        return self.messages / self.frames if self.frames else 1.0
+
+    def stats(self) -> Dict[str, typing.Any]:
+        return {
+            'depth': {name: len(lane) for name, lane in zip(LANE_NAMES, self._lanes)},
+            'messages': self.messages,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'coalescing_ratio': self.coalescing_ratio,
+            'dropped': self.dropped,
+            'delayed': self.delayed,
+        }
+
+    def encode(self, payload: bytes, cache: Optional[Dict[str, bytes]] = None) -> bytes:
+        """Compress an encoded message for this connection, if it's worth it (see `compression.compress`)."""
+        return compression.compress(payload, self.codec, self.compress_threshold, cache)
+
+    async def send(self, payload: bytes, lane: int = RESPONSE):
+        """Queue a message, waiting for room if the lane is full."""
+        queue = self._lanes[lane]
+        while len(queue) >= self._limits[lane] and not self.closed:
+            self._space[lane].clear()
+            await self._space[lane].wait()
+        self._push(payload, lane)
+
+    def post(self, payload: bytes, lane: int = EVENT) -> bool:
+        """Queue a message without waiting. Returns whether it was queued (see `policy`)."""
+        if self.closed: return False
+
+        queue = self._lanes[lane]
+        if len(queue) >= self._limits[lane]:
+            if self.policy == DROP_NEWEST:
+                self._count('dropped')
+                return False
+            elif self.policy == DROP_OLDEST:
+                queue.popleft()
+                self._count('dropped')
+            else:
+                self._disconnect()
+                return False
+
+        self._push(payload, lane)
+        return True
+
+    def _push(self, payload: bytes, lane: int):
+        if self.closed: raise Transport.ConnectionClosed()
+        self._lanes[lane].append((payload, time.monotonic()))
+        self._wakeup.set()
+
+    def _count(self, counter: str, n: int = 1):
+        setattr(self, counter, getattr(self, counter) + n)
+        self.counters[counter] += n
+
+    def _disconnect(self):
+        self.counters['disconnected'] += 1
+        self._count('dropped', self.depth + 1)
+        self.closed = True
+        for queue in self._lanes: queue.clear()
+        for space in self._space: space.set()
+        if self._writer: self._writer.cancel() # most likely stuck in `send` on the stalled socket
+
+        self._hanging_up = asyncio.create_task(self._hang_up())
+        if self.on_disconnect: self.on_disconnect()
+
+    async def _hang_up(self):
+        try:
+            await self.transport.close(1008) # policy violation
+        except Transport.ConnectionClosed: ...
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+    def _take(self) -> List[bytes]:
+        batch, size, late = [], 0, time.monotonic() - self.delay_threshold
+        for lane, queue in enumerate(self._lanes):
+            while queue:
+                if batch and (not self.multi or size + len(queue[0][0]) > self.max_frame_bytes):
+                    return batch
+                payload, queued_at = queue.popleft()
+                if queued_at < late: self._count('delayed')
+                self._space[lane].set()
+                batch.append(payload)
+                size += len(payload)
+        return batch
+
+    async def _write(self):
+        try:
+            while True:
+                if not self.depth:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+
+                batch = self._take()
+                frame = batch[0] if len(batch) == 1 else b''.join(batch)
+                await self.transport.send(frame)
+
+                self.messages += len(batch)
+                self.frames += 1
+                self.bytes += len(frame)
+                metrics.bytes_sent.inc(n=len(frame))
+                metrics.outbound_messages.inc(n=len(batch))
+                metrics.outbound_frames.inc()
+        except Transport.ConnectionClosed:
+            ...
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        finally:
+            self.closed = True
+            for space in self._space: space.set()
+
+_open: 'weakref.WeakSet[OutboundScheduler]' = weakref.WeakSet() # started and not closed yet, for the metrics
+
+metrics.registry.gauge(
+    'ephaptic_outbound_queue_depth', 'Messages waiting to be written, over every connection, by lane.', ('lane',),
+    collect=lambda: {(name,): sum(len(scheduler._lanes[lane]) for scheduler in list(_open)) for lane, name in zip(LANES, LANE_NAMES)},
+)
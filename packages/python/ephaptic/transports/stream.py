@@ -0,0 +1,127 @@
+import asyncio
+import os
+import stat
+import struct
+import typing
+from typing import Dict, Optional, Sequence, Tuple, Union
+from urllib.parse import urlsplit
+
+from . import Transport
+
+SCHEMES = ('tcp', 'unix')
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+_header = struct.Struct('>I') # each frame is its length, as 4 bytes big endian, then the frame
+
+def parse_url(url: str) -> Tuple[str, Union[Tuple[str, int], str]]:
+    """`tcp://host:port` is `('tcp', (host, port))`, and `unix:///path/to.sock` is `('unix', path)`."""
+    parts = urlsplit(url)
+    match parts.scheme:
+        case 'tcp':
+            if not parts.hostname or parts.port is None: raise ValueError(f"Expected tcp://host:port, got {url!r}.")
+            return 'tcp', (parts.hostname, parts.port)
+        case 'unix':
+            path = parts.netloc + parts.path # `unix://relative.sock` too
+            if not path: raise ValueError(f"Expected unix:///path/to.sock, got {url!r}.")
+            return 'unix', path
+        case _:
+            raise ValueError(f"Unsupported URL scheme: {parts.scheme!r}. Expected one of {SCHEMES}.")
+
+class StreamTransport(Transport):
+    """
+    Length-prefixed msgpack frames over an asyncio stream (TCP or a Unix socket), for clients
+    that don't need to go through HTTP, e.g. backend workers on the same host or network.
+
+    There's no TLS or close code on the wire: bind to localhost, a Unix socket, or a private
+    network. A frame over `max_frame_bytes` is a protocol error and closes the connection.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_frame_bytes: int = MAX_FRAME_BYTES):
+        self.reader = reader
+        self.writer = writer
+        self.max_frame_bytes = max_frame_bytes
+
+        peer = writer.get_extra_info('peername')
+        self.remote_addr = peer[0] if isinstance(peer, tuple) else 'unix'
+
+    async def send(self, data: bytes):
+        if self.writer.is_closing(): raise Transport.ConnectionClosed
+        try:
+            self.writer.write(_header.pack(len(data)) + data) # one write, so concurrent sends can't interleave
+            await self.writer.drain()
+        except ConnectionError:
+            raise Transport.ConnectionClosed from None
+
+    async def receive(self) -> bytes:
+        try:
+            (length,) = _header.unpack(await self.reader.readexactly(_header.size))
+            if length > self.max_frame_bytes:
+                await self.close()
+                raise Transport.ConnectionClosed
+            return await self.reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise Transport.ConnectionClosed from None
+
+    async def close(self, code: int = 1000):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError): ...
+
+async def open_connection(url: str, **kwargs) -> StreamTransport:
+    """A client connection to a `serve`d URL."""
+    scheme, address = parse_url(url)
+    if scheme == 'tcp':
+        reader, writer = await asyncio.open_connection(*address)
+    else:
+        reader, writer = await asyncio.open_unix_connection(address)
+    return StreamTransport(reader, writer, **kwargs)
+
+async def serve(ephaptic, url: str, connections: Optional[Dict[StreamTransport, asyncio.Task]] = None, **kwargs) -> asyncio.AbstractServer:
+    """
+    Accept connections on `url` (`tcp://host:port` or `unix:///path/to.sock`), handing each one
+    to `ephaptic.handle_transport`. `from_app(listen=...)` starts these with the app.
+
+    Open connections (and the tasks handling them) are kept in `connections`, if given, so they
+    can be closed on shutdown.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        transport = StreamTransport(reader, writer, **kwargs)
+        if connections is not None: connections[transport] = asyncio.current_task()
+        try:
+            await ephaptic.handle_transport(transport)
+        finally:
+            if connections is not None: connections.pop(transport, None)
+            await transport.close()
+
+    scheme, address = parse_url(url)
+    if scheme == 'tcp':
+        return await asyncio.start_server(handle, *address)
+
+    # A socket file left over from a previous run would make the bind fail.
+    try:
+        if stat.S_ISSOCK(os.stat(address).st_mode): os.unlink(address)
+    except FileNotFoundError: ...
+    return await asyncio.start_unix_server(handle, address)
+
+class Listeners:
+    """The `serve`rs for `from_app(listen=...)`, started and stopped with the app."""
+
+    def __init__(self, ephaptic, urls: Sequence[str]):
+        for url in urls: parse_url(url) # fail at startup, not on the first connection
+        self.ephaptic = ephaptic
+        self.urls = tuple(urls)
+        self.servers: typing.List[asyncio.AbstractServer] = []
+        self.connections: Dict[StreamTransport, asyncio.Task] = {}
+
+    async def start(self):
+        for url in self.urls:
+            self.servers.append(await serve(self.ephaptic, url, self.connections))
+
+    async def stop(self):
+        servers, self.servers = self.servers, []
+        for server in servers: server.close()
+        connections = dict(self.connections)
+        for transport in connections: await transport.close()
+        await asyncio.gather(*connections.values(), return_exceptions=True) # `handle_transport` cleans up after each
+        for server in servers: await server.wait_closed()
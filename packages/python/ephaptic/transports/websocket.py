@@ -9,4 +9,7 @@ class WebSocketTransport(Transport):
         await self.ws.send(data)
 
     async def receive(self) -> bytes:
-        return await self.ws.receive()
\ No newline at end of file
+        return await self.ws.receive()
+
+    async def close(self, code: int = 1000):
+        await self.ws.close(code)
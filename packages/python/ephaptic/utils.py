@@ -1,10 +1,38 @@
 import re
+from typing import Dict, Optional, Union
+
+class Limit(tuple):
+    """
+    `(count, period)`, plus how many calls may go through at once (`burst`), `count` by default.
+    With GCRA, at most `count + burst - 1` calls get through in any `period`, so a smaller `burst`
+    (`'100/m burst 10'`) keeps that closer to `count`.
+    """
+
+    def __new__(cls, count: int, period: int, burst: Optional[int] = None):
+        limit = super().__new__(cls, (count, period))
+        limit.burst = burst or count
+        return limit
+
+    @property
+    def count(self) -> int: return self[0]
+
+    @property
+    def period(self) -> int: return self[1]
+
+    def __repr__(self):
+        return f'Limit({self.count}/{self.period}s, burst={self.burst})'
+
+def parse_limit(limit: str) -> Limit:
+    burst = None
+    if ' burst ' in limit:
+        limit, burst = limit.split(' burst ')
+        burst = int(burst)
+        if burst < 1: raise ValueError(f"Invalid rate limit burst: {burst}")
 
-def parse_limit(limit: str) -> tuple[int, int]:
     count, period = limit.replace(' per ', '/').split('/')
     count = int(count)
 
-    match = re.fullmatch(r'(\d+)?\s*([smhd])', period.lower())
+    match = re.fullmatch(r'(\d+)?\s*([smhd])', period.strip().lower())
     if not match:
         raise ValueError(f"Invalid rate limit period: {period}")
 
@@ -18,4 +46,14 @@ def parse_limit(limit: str) -> tuple[int, int]:
         'd': 86400,
     }[unit]
 
-    return count, multiplier * s
\ No newline at end of file
+    return Limit(count, multiplier * s, burst)
+
+SCOPES = ('user', 'ip', 'function')
+
+def parse_limits(limit: Union[str, Dict[str, str]]) -> Union[Limit, Dict[str, Limit]]:
+    """A single limit (per user, or per IP when logged out), or one per scope, e.g. `{'user': '10/s', 'function': '1000/s'}`."""
+    if isinstance(limit, str): return parse_limit(limit)
+
+    for scope in limit:
+        if scope not in SCOPES: raise ValueError(f"Invalid rate limit scope: {scope!r}. Expected one of {SCOPES}.")
+    return {scope: parse_limit(value) for scope, value in limit.items()}
@@ -0,0 +1,25 @@
+# Functions for the process pool tests: they have to be importable by the worker processes.
+import os
+import typing
+
+import pydantic
+from ephaptic import active_user
+
+class Point(pydantic.BaseModel):
+    x: int
+    y: int
+
+def mirror(point: Point) -> Point:
+    assert isinstance(point, Point) # rebuilt from msgpack in the worker
+    return Point(x=point.y, y=point.x)
+
+def whoami() -> typing.Tuple[typing.Optional[str], int]:
+    return active_user(), os.getpid()
+
+def wrong() -> int:
+    return 'not an int'
+
+def count(n: int) -> typing.Iterator[Point]:
+    for i in range(n):
+        if i == 3 and n == 4: raise ValueError('boom')
+        yield {'x': i, 'y': i * i}
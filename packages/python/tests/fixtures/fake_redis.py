@@ -0,0 +1,55 @@
+import collections
+
+class FakeRedis:
+    """Just enough of `redis.asyncio.Redis` (sorted sets, pipelines, publish) to test against without a server."""
+
+    def __init__(self):
+        self.zsets = collections.defaultdict(dict)
+        self.strings = {}
+        self.published = []
+
+    async def zadd(self, key, mapping): self.zsets[key].update(mapping)
+    async def zrem(self, key, member): self.zsets[key].pop(member, None)
+    async def expire(self, key, seconds): ...
+    async def publish(self, channel, message): self.published.append((channel, message))
+    async def ping(self): return True
+    def register_script(self, script): return None # no Lua here, tests swap in their own
+
+    async def get(self, key): return self.strings.get(key)
+    async def delete(self, key): self.strings.pop(key, None)
+
+    async def set(self, key, value, nx=False, px=None):
+        if nx and key in self.strings: return None
+        self.strings[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    async def eval(self, script, numkeys, key, token):
+        # Only used to release locks: delete the key if it still holds our token.
+        if self.strings.get(key) == token.encode(): del self.strings[key]
+
+    async def zremrangebyscore(self, key, low, high):
+        low, high = float(low), float(high)
+        for member, score in list(self.zsets[key].items()):
+            if low <= score <= high: del self.zsets[key][member]
+
+    async def zrangebyscore(self, key, low, high):
+        low, high = float(low), float(high)
+        return [member.encode() for member, score in sorted(self.zsets[key].items(), key=lambda i: i[1]) if low <= score <= high]
+
+    def pipeline(self, transaction=True): return _Pipeline(self)
+
+class _Pipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    async def __aenter__(self): return self
+    async def __aexit__(self, *exc): ...
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs): self.commands.append(getattr(self.client, name)(*args, **kwargs))
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await command for command in commands]
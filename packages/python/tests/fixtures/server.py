@@ -71,6 +71,34 @@ def sync_generator() -> typing.Generator[MyTestObject, None, None]:
         time.sleep(1)
         yield MyTestObject(text=message, num=i)
 
+cancelled = set()
+
+@ephaptic.expose
+async def endless() -> typing.AsyncGenerator[int, None]:
+    cancelled.discard('endless')
+    try:
+        n = 0
+        while True:
+            yield n
+            n += 1
+            await asyncio.sleep(0.05)
+    finally:
+        cancelled.add('endless')
+
+@ephaptic.expose
+async def sleepy() -> str:
+    cancelled.discard('sleepy')
+    try:
+        await asyncio.sleep(30)
+        return 'woke up'
+    except asyncio.CancelledError:
+        cancelled.add('sleepy')
+        raise
+
+@ephaptic.expose
+async def was_cancelled(name: str) -> bool:
+    return name in cancelled
+
 
 router = Router(ephaptic)
 
@@ -0,0 +1,21 @@
+import asyncio
+import msgpack
+from ephaptic.transports import Transport
+
+class QueueTransport(Transport):
+    def __init__(self):
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.outbox: asyncio.Queue = asyncio.Queue()
+        self.remote_addr = '127.0.0.1'
+        self.stalled = False # simulate a client that stopped reading
+        self.close_code = None
+
+    async def send(self, data: bytes):
+        while self.stalled: await asyncio.sleep(3600)
+        self.outbox.put_nowait(data)
+
+    async def close(self, code: int = 1000): self.close_code = code
+    async def receive(self) -> bytes: return await self.inbox.get()
+
+    def push(self, message: dict): self.inbox.put_nowait(msgpack.dumps(message))
+    async def pull(self, timeout: float = 5) -> dict: return msgpack.loads(await asyncio.wait_for(self.outbox.get(), timeout))
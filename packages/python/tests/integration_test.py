@@ -17,6 +17,14 @@ async def test_rpc_echo():
     assert result == "Hello, Ephaptic!"
 
 
+@pytest.mark.asyncio
+async def test_rpc_large_payload_compressed():
+    client = await connect(SERVER_URL, auth="user123")
+    message = "Hello, Ephaptic! " * 10_000
+    result = await client.echo(message=message)
+    assert result == message
+
+
 @pytest.mark.asyncio
 async def test_rpc_add():
     client = await connect(SERVER_URL, auth="user123")
@@ -30,6 +38,24 @@ async def test_rpc_get_user_id():
     result = await client.get_user_id()
     assert result == "user123"
 
+@pytest.mark.asyncio
+async def test_rpc_batch():
+    client = await connect(SERVER_URL, auth="user123")
+
+    async with client.batch() as batch:
+        added = batch.add(a=1, b=2)
+        echoed = batch.echo(message="batched")
+        missing = batch.does_not_exist()
+
+    assert added.result() == 3
+    assert echoed.result() == "batched"
+    assert missing.exception() is not None
+
+    async with client.batch(mode='stream') as batch:
+        results = [batch.add(a=n, b=n) for n in range(5)]
+
+    assert [r.result() for r in results] == [0, 2, 4, 6, 8]
+
 @pytest.mark.asyncio
 async def test_pydantic_objects():
     client = await connect(SERVER_URL, auth="user123")
@@ -90,6 +116,41 @@ async def test_rpc_stream_functions():
         assert item.startswith('Message ')
     
 
+@pytest.mark.asyncio
+async def test_rpc_stream_close_cancels_server_generator():
+    client = await connect(SERVER_URL)
+
+    async with await client.endless() as stream:
+        async for item in stream:
+            if item == 2: break
+
+    await asyncio.sleep(0.2)
+    assert await client.was_cancelled('endless') == True
+
+@pytest.mark.asyncio
+async def test_rpc_stream_with_window():
+    client = await connect(SERVER_URL, window=4)
+
+    received = []
+    async with await client.options(window=2).endless() as stream:
+        async for item in stream:
+            received.append(item)
+            if len(received) == 10: break
+
+    assert received == list(range(10))
+
+@pytest.mark.asyncio
+async def test_rpc_task_cancel_cancels_server_call():
+    client = await connect(SERVER_URL)
+
+    task = asyncio.create_task(client.sleepy())
+    await asyncio.sleep(0.2)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError): await task
+
+    await asyncio.sleep(0.2)
+    assert await client.was_cancelled('sleepy') == True
+
 @pytest.mark.asyncio
 async def test_router_rpc_access():
     client = await connect(SERVER_URL, auth="user123")
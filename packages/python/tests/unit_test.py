@@ -2,6 +2,9 @@ import pytest
 from ephaptic.ephaptic import Ephaptic, EphapticTarget, expose as global_expose
 from ephaptic.decorators import META_KEY
 import pydantic
+import asyncio
+import typing
+import time
 from fastapi import FastAPI
 
 def test_global_expose_picked_up():
@@ -81,4 +84,1594 @@ def test_to_method():
 
     target_mixed = eph.to("user5", ["user6", "user7"])
     assert isinstance(target_mixed, EphapticTarget)
-    assert target_mixed.user_ids == ["user5", "user6", "user7"]
\ No newline at end of file
+    assert target_mixed.user_ids == ["user5", "user6", "user7"]
+
+async def test_call_plan_compiled_once():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+
+    class Point(pydantic.BaseModel):
+        x: int
+        y: int
+
+    @eph.expose
+    async def flip(p: Point) -> Point:
+        return Point(x=p.y, y=p.x)
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    for i in range(3):
+        transport.push({'type': 'rpc', 'id': i, 'name': 'flip', 'args': [{'x': 1, 'y': i}]})
+        assert await transport.pull() == {'id': i, 'result': {'x': i, 'y': 1}}
+
+    plan = eph._plan('flip')
+    assert plan is eph._plans['flip']
+    assert plan.kind == 'async' and not plan.is_stream
+
+    transport.push({'type': 'rpc', 'id': 9, 'name': 'flip', 'args': [{'x': 'nope'}]})
+    assert (await transport.pull())['error']['code'] == 'VALIDATION_ERROR'
+    assert eph._plan('flip') is plan
+
+    @eph.expose(name='flip')
+    def flip_again(p: Point) -> int: return p.x
+
+    assert eph._plan('flip') is not plan
+    assert eph._plan('flip').kind == 'sync'
+
+    server.cancel()
+
+def test_call_plan_stream_chunk_adapter():
+    from ephaptic.plan import CallPlan
+
+    def numbers() -> typing.Generator[int, None, None]:
+        yield '1'
+
+    plan = CallPlan('numbers', numbers)
+    assert plan.is_stream and plan.kind == 'sync_gen'
+    assert plan.return_adapter is None
+    assert plan.dump_chunk('1') == 1
+
+async def test_rpc_calls_run_concurrently():
+    from fixtures.transport import QueueTransport
+    from ephaptic.ctx import _active_transport_ctx
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    log = []
+
+    @eph.expose
+    async def slow() -> str:
+        await asyncio.sleep(0.2)
+        return 'slow'
+
+    @eph.expose
+    async def fast() -> str:
+        return 'fast'
+
+    @eph.expose(ordered=True)
+    async def step(n: int) -> int:
+        log.append(('start', n))
+        await asyncio.sleep(0.05 * (3 - n))
+        log.append(('end', n))
+        assert _active_transport_ctx.get() is transport
+        return n
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'slow', 'args': []})
+    transport.push({'type': 'rpc', 'id': 2, 'name': 'fast', 'args': []})
+    assert (await transport.pull())['id'] == 2
+    assert (await transport.pull())['id'] == 1
+
+    for n in range(3):
+        transport.push({'type': 'rpc', 'id': 10 + n, 'name': 'step', 'args': [n]})
+    assert [(await transport.pull())['result'] for _ in range(3)] == [0, 1, 2]
+    assert log == [('start', 0), ('end', 0), ('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+
+    server.cancel()
+
+async def test_rpc_inflight_limit():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, max_inflight=1)
+    release = asyncio.Event()
+    started = []
+
+    @eph.expose
+    async def wait() -> str:
+        started.append(1)
+        await release.wait()
+        return 'done'
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'wait', 'args': []})
+    transport.push({'type': 'rpc', 'id': 2, 'name': 'wait', 'args': []})
+    await asyncio.sleep(0.05)
+
+    assert len(started) == 1
+    release.set()
+    assert {(await transport.pull())['id'] for _ in range(2)} == {1, 2}
+
+    server.cancel()
+
+async def test_control_frames_get_through_at_max_inflight():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, max_inflight=1, max_queued=1)
+
+    @eph.expose
+    async def forever() -> str:
+        await asyncio.Event().wait()
+
+    @eph.expose
+    async def quick() -> str:
+        return 'quick'
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'forever', 'args': []})
+    transport.push({'type': 'rpc', 'id': 2, 'name': 'quick', 'args': []}) # waits for the slot
+    transport.push({'type': 'rpc', 'id': 3, 'name': 'quick', 'args': []}) # nowhere to wait
+    error = await transport.pull()
+    assert error['id'] == 3 and error['error']['code'] == 'OVERLOADED'
+
+    transport.push({'type': 'cancel', 'id': 1}) # still read, even though every slot is taken
+    assert await transport.pull() == {'id': 2, 'result': 'quick'}
+
+    server.cancel()
+
+async def test_cancel_frame_closes_generators():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    closed = {}
+
+    @eph.expose
+    async def ticks() -> typing.AsyncGenerator[int, None]:
+        try:
+            n = 0
+            while True:
+                yield n
+                n += 1
+                await asyncio.sleep(0.01)
+        finally:
+            closed['async'] = True
+
+    @eph.expose
+    def sync_ticks() -> typing.Generator[int, None, None]:
+        try:
+            n = 0
+            while True:
+                yield n
+                n += 1
+                time.sleep(0.01)
+        finally:
+            closed['sync'] = True
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    for call_id, name in ((1, 'ticks'), (2, 'sync_ticks')):
+        transport.push({'type': 'rpc', 'id': call_id, 'name': name, 'args': []})
+        assert (await transport.pull())['stream'] is True
+        assert (await transport.pull())['chunk'] == 0
+        transport.push({'type': 'cancel', 'id': call_id})
+
+        for _ in range(100):
+            if len(closed) == call_id: break
+            await asyncio.sleep(0.01)
+
+    assert closed == {'async': True, 'sync': True}
+
+    # cancelled calls free their slot and don't keep the connection busy
+    await asyncio.sleep(0.05)
+    while not transport.outbox.empty(): transport.outbox.get_nowait()
+    transport.push({'type': 'rpc', 'id': 3, 'name': 'ticks', 'args': []})
+    assert (await transport.pull())['id'] == 3
+
+    server.cancel()
+
+async def test_disconnect_cancels_inflight_calls():
+    from fixtures.transport import QueueTransport
+    from ephaptic.transports import Transport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    cancelled = asyncio.Event()
+
+    @eph.expose
+    async def forever():
+        try: await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    class ClosingTransport(QueueTransport):
+        async def receive(self):
+            data = await super().receive()
+            if data == b'close': raise Transport.ConnectionClosed()
+            return data
+
+    transport = ClosingTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'forever', 'args': []})
+    await asyncio.sleep(0.05)
+    transport.inbox.put_nowait(b'close')
+
+    await asyncio.wait_for(server, 1)
+    assert cancelled.is_set()
+
+async def test_stream_credits_pause_generator():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    produced = []
+
+    @eph.expose(window=3)
+    async def numbers() -> typing.AsyncGenerator[int, None]:
+        for n in range(10):
+            produced.append(n)
+            yield n
+
+    async def drain():
+        await asyncio.sleep(0.05)
+        out = []
+        while not transport.outbox.empty(): out.append(await transport.pull())
+        return out
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init', 'flow': True})
+
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'numbers', 'args': [], 'window': 2})
+    assert await drain() == [{'id': 1, 'stream': True, 'window': 2}, {'id': 1, 'chunk': 0}, {'id': 1, 'chunk': 1}]
+    assert produced == [0, 1] # paused before asking for the next item
+
+    transport.push({'type': 'credit', 'id': 1, 'n': 2})
+    assert [m['chunk'] for m in await drain()] == [2, 3]
+
+    transport.push({'type': 'cancel', 'id': 1})
+    transport.push({'type': 'rpc', 'id': 2, 'name': 'numbers', 'args': []}) # falls back to @expose(window=3)
+    messages = await drain()
+    assert messages[0]['window'] == 3 and len(messages) == 4
+
+    server.cancel()
+
+async def test_stream_window_by_default():
+    from ephaptic.transports import memory
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    produced = []
+
+    @eph.expose
+    async def numbers(n: int) -> typing.AsyncGenerator[int, None]:
+        for i in range(n):
+            produced.append(i)
+            yield i
+
+    # A client that isn't reading only ever has a window's worth buffered, without asking for it.
+    client = await memory.connect(eph)
+    stream = await client.numbers(1000)
+    await asyncio.sleep(0.05)
+    assert stream._window == 64 and stream._queue.qsize() <= 64 and len(produced) <= 65
+    assert [i async for i in stream] == list(range(1000))
+
+    # Turned off explicitly, it's as fast as the generator goes.
+    produced.clear()
+    stream = await client.options(window=0).numbers(1000)
+    await asyncio.sleep(0.05)
+    assert stream._window is None and len(produced) == 1000
+    await stream.aclose()
+    await client.close()
+
+async def test_stream_credits_at_max_inflight():
+    from ephaptic.transports import memory
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, max_inflight=1)
+
+    @eph.expose
+    async def numbers(n: int) -> typing.AsyncGenerator[int, None]:
+        for i in range(n): yield i
+
+    @eph.expose
+    async def quick() -> str:
+        return 'quick'
+
+    client = await memory.connect(eph)
+    stream = await client.options(window=2).numbers(6) # holds the only slot, and soon runs out of credit
+    other = asyncio.create_task(client.quick()) # waits for that slot, without holding up the credits
+    async def consume(): return [i async for i in stream]
+    assert await asyncio.wait_for(consume(), 1) == [0, 1, 2, 3, 4, 5]
+    assert await asyncio.wait_for(other, 1) == 'quick'
+    await client.close()
+
+async def test_sync_stream_pinned_thread():
+    import threading
+    from ephaptic.streams import SyncStream
+    from ephaptic.ctx import _active_user_ctx
+
+    threads, produced, closed_on = set(), [], []
+
+    def gen():
+        try:
+            for n in range(1000):
+                threads.add(threading.get_ident())
+                produced.append(n)
+                yield (n, _active_user_ctx.get())
+        finally:
+            closed_on.append(threading.get_ident())
+
+    token = _active_user_ctx.set('user42')
+    stream = SyncStream(gen(), buffer=8)
+    _active_user_ctx.reset(token)
+
+    assert [await anext(stream) for _ in range(3)] == [(0, 'user42'), (1, 'user42'), (2, 'user42')]
+    await asyncio.sleep(0.05)
+    assert len(produced) <= 3 + 8 + 1 # bounded by the buffer
+
+    await stream.aclose()
+    await asyncio.sleep(0.05)
+    assert len(threads) == 1 and closed_on == list(threads)
+    assert threading.get_ident() not in threads
+
+    def broken():
+        yield 1
+        raise ValueError('boom')
+
+    stream = SyncStream(broken())
+    assert await anext(stream) == 1
+    with pytest.raises(ValueError): await anext(stream)
+
+async def test_sync_streams_are_bounded():
+    import threading
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, executors={'streams': {'max_workers': 2, 'max_queue': 0}})
+    produced = []
+
+    @eph.expose
+    def numbers(n: int) -> typing.Generator[int, None, None]:
+        for i in range(n):
+            produced.append(i)
+            yield i
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init', 'flow': True})
+
+    # Never ahead of the credits: two chunks sent, two produced, however big the buffer.
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'numbers', 'args': [100], 'window': 2})
+    assert [(await transport.pull()).get('chunk') for _ in range(3)] == [None, 0, 1]
+    await asyncio.sleep(0.05)
+    assert produced == [0, 1]
+    transport.push({'type': 'credit', 'id': 1, 'n': 1})
+    assert (await transport.pull())['chunk'] == 2
+    await asyncio.sleep(0.05)
+    assert produced == [0, 1, 2]
+
+    # Each open stream holds a worker, and there are only two.
+    threads = threading.active_count()
+    transport.push({'type': 'rpc', 'id': 2, 'name': 'numbers', 'args': [100], 'window': 1})
+    await transport.pull(); await transport.pull()
+    transport.push({'type': 'rpc', 'id': 3, 'name': 'numbers', 'args': [100], 'window': 1})
+    error = await transport.pull()
+    assert error['id'] == 3 and error['error']['code'] == 'OVERLOADED' and error['error']['data'] == {'executor': 'streams'}
+    assert threading.active_count() <= threads + 1
+
+    transport.push({'type': 'cancel', 'id': 1})
+    await asyncio.sleep(0.05) # its worker is given back...
+    transport.push({'type': 'rpc', 'id': 4, 'name': 'numbers', 'args': [1], 'window': 1})
+    assert (await transport.pull()) == {'id': 4, 'stream': True, 'window': 1} # ...and taken by the next one
+
+    server.cancel()
+    eph.executor('streams').shutdown()
+
+async def test_router_sync_streams_are_bounded():
+    import httpx
+    import threading
+    from ephaptic.ext.fastapi import Router
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, executors={'streams': {'max_workers': 1, 'max_queue': 0}})
+    router = Router(eph)
+    release = threading.Event()
+
+    @router.get('/numbers')
+    def numbers() -> typing.Generator[int, None, None]:
+        yield 1
+        release.wait(5)
+        yield 2
+
+    app.include_router(router)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        first = asyncio.create_task(client.get('/numbers'))
+        await asyncio.sleep(0.1)
+        assert (await client.get('/numbers')).status_code == 503
+        release.set()
+        assert (await first).status_code == 200
+    eph.executor('streams').shutdown()
+
+async def test_outbound_scheduler_priority_and_coalescing():
+    import msgpack
+    from fixtures.transport import QueueTransport
+    from ephaptic.transports.outbound import OutboundScheduler, RESPONSE, CHUNK, EVENT
+
+    transport = QueueTransport()
+    scheduler = OutboundScheduler(transport, multi=True, max_queue=4, max_events=4, policy='drop_newest')
+
+    for n in range(3): assert scheduler.post(msgpack.dumps({'event': n}), EVENT)
+    await scheduler.send(msgpack.dumps({'chunk': 0}), CHUNK)
+    await scheduler.send(msgpack.dumps({'result': 0}), RESPONSE)
+    assert scheduler.depth == 5
+
+    scheduler.start()
+    frame = await asyncio.wait_for(transport.outbox.get(), 1)
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(frame)
+    assert list(unpacker) == [{'result': 0}, {'chunk': 0}, {'event': 0}, {'event': 1}, {'event': 2}]
+    assert scheduler.stats()['coalescing_ratio'] == 5.0
+
+    for n in range(4): scheduler.post(b'\xc0', EVENT)
+    assert not scheduler.post(b'\xc0', EVENT) # lane full, dropped
+
+    await scheduler.close()
+    with pytest.raises(Exception): await scheduler.send(b'\xc0')
+
+async def test_outbound_scheduler_slow_consumer_policies():
+    import collections
+    from fixtures.transport import QueueTransport
+    from ephaptic.transports.outbound import OutboundScheduler, EVENT
+
+    counters = collections.Counter()
+
+    oldest = OutboundScheduler(QueueTransport(), max_events=2, counters=counters)
+    for n in range(4): assert oldest.post(bytes([n]), EVENT)
+    assert [payload for payload, _ in oldest._lanes[EVENT]] == [b'\x02', b'\x03']
+
+    newest = OutboundScheduler(QueueTransport(), max_events=2, policy='drop_newest', counters=counters)
+    assert [newest.post(bytes([n]), EVENT) for n in range(4)] == [True, True, False, False]
+    assert [payload for payload, _ in newest._lanes[EVENT]] == [b'\x00', b'\x01']
+
+    assert oldest.dropped == newest.dropped == 2
+    assert counters['dropped'] == 4
+
+    # Messages that waited longer than `delay_threshold` are counted when they're finally written.
+    late = OutboundScheduler(QueueTransport(), delay_threshold=0, counters=counters)
+    late.post(b'\xc0', EVENT)
+    late.start()
+    await asyncio.sleep(0.01)
+    assert late.stats()['delayed'] == counters['delayed'] == 1
+    await late.close()
+
+    with pytest.raises(ValueError): OutboundScheduler(QueueTransport(), policy='ignore')
+
+async def test_slow_consumer_disconnect():
+    from fixtures.transport import QueueTransport
+    from ephaptic.ephaptic import manager
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, slow_consumer_policy='disconnect', event_queue_size=2)
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    await asyncio.sleep(0.01)
+
+    before = manager.counters['disconnected']
+    transport.stalled = True
+    outbound = transport.outbound
+    assert outbound.post(b'\xc0')
+    await asyncio.sleep(0.01) # the writer takes it and gets stuck in `send`
+    assert outbound.post(b'\xc0') and outbound.post(b'\xc0')
+    assert not outbound.post(b'\xc0')
+
+    await asyncio.wait_for(server, 1) # the session is closed, not left hanging on the dead socket
+    assert transport.close_code == 1008 and outbound._hanging_up.done()
+    assert manager.counters['disconnected'] == before + 1
+
+async def test_slow_consumer_hang_up_is_bounded(monkeypatch):
+    from fixtures.transport import QueueTransport
+    from ephaptic.transports.outbound import OutboundScheduler
+
+    class Unresponsive(QueueTransport):
+        async def close(self, code: int = 1000): await asyncio.sleep(3600) # never finishes the close handshake
+
+    monkeypatch.setattr(OutboundScheduler, 'hang_up_timeout', 0.05)
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, slow_consumer_policy='disconnect', event_queue_size=1)
+
+    transport = Unresponsive()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    await asyncio.sleep(0.01)
+
+    transport.stalled = True
+    outbound = transport.outbound
+    outbound.post(b'\xc0')
+    await asyncio.sleep(0.01)
+    while outbound.post(b'\xc0'): ...
+
+    await asyncio.wait_for(server, 1)
+    assert outbound._hanging_up.cancelled() # given up on, not left running
+
+async def test_outbound_scheduler_without_multi_sends_one_message_per_frame():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+
+    @eph.expose
+    async def one() -> int: return 1
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    for i in range(5): transport.push({'type': 'rpc', 'id': i, 'name': 'one', 'args': []})
+
+    assert sorted([(await transport.pull())['id'] for _ in range(5)]) == list(range(5)) # `pull` decodes exactly one message per frame
+    server.cancel()
+
+async def test_batch_frame():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+
+    @eph.expose
+    async def square(n: int) -> int:
+        await asyncio.sleep(0.01 * (3 - n))
+        return n * n
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    calls = [{'type': 'rpc', 'id': n, 'name': 'square', 'args': [n]} for n in range(3)]
+    calls.append({'type': 'rpc', 'id': 3, 'name': 'square', 'args': ['x']})
+
+    transport.push({'type': 'batch', 'calls': calls})
+    reply = await transport.pull()
+    assert reply['type'] == 'batch'
+    responses = {r['id']: r for r in reply['responses']}
+    assert [responses[n]['result'] for n in range(3)] == [0, 1, 4]
+    assert responses[3]['error']['code'] == 'VALIDATION_ERROR'
+
+    transport.push({'type': 'batch', 'mode': 'stream', 'calls': calls[:3]})
+    assert [(await transport.pull())['id'] for _ in range(3)] == [2, 1, 0] # in completion order
+
+    server.cancel()
+
+async def test_compression_negotiated_above_threshold():
+    import msgpack
+    from ephaptic import compression
+    from fixtures.transport import QueueTransport
+
+    assert compression.negotiate(['lz4']) is None
+    assert compression.negotiate(['zlib']).name == 'zlib'
+    assert compression.available()[-1] == 'zlib'
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, compression_threshold=256)
+
+    @eph.expose
+    async def text(n: int) -> str: return 'ephaptic ' * n
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init', 'compression': ['zlib']})
+
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'text', 'args': [1]})
+    small = await asyncio.wait_for(transport.outbox.get(), 1)
+    assert msgpack.loads(small) == {'id': 1, 'result': 'ephaptic '}
+
+    transport.push({'type': 'rpc', 'id': 2, 'name': 'text', 'args': [1000]})
+    large = await asyncio.wait_for(transport.outbox.get(), 1)
+    assert isinstance(msgpack.loads(large), msgpack.ExtType)
+    assert len(large) < 9000 / 10
+    assert msgpack.loads(large, ext_hook=compression.ext_hook) == {'id': 2, 'result': 'ephaptic ' * 1000}
+
+    server.cancel()
+
+def test_compression_cache_compresses_once():
+    from ephaptic import compression
+
+    codec = compression.negotiate(['zlib'])
+    calls = []
+    counting = compression.Codec('zlib', codec.code, lambda data: calls.append(1) or codec.compress(data), codec.decompress)
+
+    payload, cache = b'\xa4' + b'abcd' * 1000, {}
+    first = compression.compress(payload, counting, 100, cache)
+    assert compression.compress(payload, counting, 100, cache) is first
+    assert len(calls) == 1
+    assert compression.compress(payload, None, 100, cache) is payload
+
+async def test_presence_routes_events_to_nodes():
+    from fixtures.fake_redis import FakeRedis
+    from ephaptic import envelope
+    from ephaptic.ephaptic import ConnectionManager, CHANNEL_NAME
+    from ephaptic.presence import Presence
+
+    client = FakeRedis()
+    here, there = ConnectionManager(), Presence(client, node_id='there')
+    here.redis, here.presence = client, Presence(client, node_id='here')
+
+    await here.add('alice', object())
+    await there.join('bob')
+    await there.join('carol')
+    assert await here.presence.locate(['alice', 'bob', 'carol', 'dave']) == {
+        'ephaptic:node:here': ['alice'],
+        'ephaptic:node:there': ['bob', 'carol'],
+    }
+
+    await there.leave('carol')
+    client.zsets[Presence.key('bob')]['there'] = 0 # lease ran out
+    await here.broadcast(['alice', 'bob', 'carol'], 'ping', [], {})
+    assert [(channel, envelope.unpack(message)[0]) for channel, message in client.published] == [('ephaptic:node:here', ['alice'])]
+
+    # If the registry can't be read, fall back to asking every node.
+    async def broken(user_ids): raise ConnectionError()
+    here.presence.locate = broken
+    client.published.clear()
+    await here.broadcast(['bob'], 'ping', [], {})
+    assert [channel for channel, _ in client.published] == [CHANNEL_NAME]
+
+async def test_prepared_event_envelope():
+    import msgpack
+    from fixtures.transport import QueueTransport
+    from ephaptic import envelope
+    from ephaptic.ephaptic import manager
+
+    class Ping(pydantic.BaseModel):
+        n: int
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    prepared = eph.prepare(Ping(n=1))
+
+    # Nodes only decode the routing header; the client frame inside is exactly what clients get.
+    targets, frame = envelope.unpack(envelope.pack(['alice', 'bob'], prepared.frame))
+    assert targets == ['alice', 'bob'] and frame == prepared.frame
+    assert msgpack.loads(frame) == {'type': 'event', 'name': 'Ping', 'payload': {'args': [], 'kwargs': {'n': 1}}}
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    await asyncio.sleep(0.01)
+    await manager.add('alice', transport)
+
+    for group in (['alice'], ['bob', 'alice']): await eph.to(group).emit(prepared)
+    for _ in range(2): assert await transport.pull() == msgpack.loads(prepared.frame) # no `target_users` leaking out
+
+    await manager.remove('alice', transport)
+    server.cancel()
+
+async def test_emit_from_a_handler():
+    import contextvars
+    from fixtures.transport import QueueTransport
+
+    class Progress(pydantic.BaseModel):
+        n: int
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    later = []
+
+    @eph.expose
+    async def work() -> str:
+        await eph.emit(Progress(n=1))
+        later.append(contextvars.copy_context())
+        return 'done'
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+    transport.push({'type': 'rpc', 'id': 1, 'name': 'work', 'args': []})
+
+    # The event was emitted first, so it gets there first, even though responses go out ahead of broadcasts.
+    assert (await transport.pull())['type'] == 'event'
+    assert (await transport.pull()) == {'id': 1, 'result': 'done'}
+
+    server.cancel()
+    await asyncio.gather(server, return_exceptions=True)
+    await later[0].run(asyncio.create_task, eph.emit(Progress(n=2))) # e.g. from a task the handler left behind
+    assert transport.outbox.empty()
+
+async def test_emit_from_a_stream():
+    import msgpack
+    from ephaptic.transports import memory
+
+    class Progress(pydantic.BaseModel):
+        n: int
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+
+    @eph.expose
+    async def work() -> typing.AsyncGenerator[int, None]:
+        for n in range(3): yield n
+        await eph.emit(Progress(n=3))
+        yield 4
+
+    client, server_end = memory.pipe(buffer=1) # room for one frame at a time, so the rest queue up
+    server = asyncio.create_task(eph.handle_transport(server_end))
+    await client.send(msgpack.dumps({'type': 'init'}))
+    client.pause()
+    await client.send(msgpack.dumps({'type': 'rpc', 'id': 1, 'name': 'work', 'args': []}))
+    await asyncio.sleep(0.05)
+    client.resume()
+
+    frames = [msgpack.loads(await client.receive()) for _ in range(7)]
+    assert [frame.get('chunk', frame.get('type')) for frame in frames[1:6]] == [0, 1, 2, 'event', 4] # not ahead of the queued chunks
+    server.cancel()
+
+def test_parse_limit_burst():
+    from ephaptic.utils import parse_limit, parse_limits
+
+    limit = parse_limit('100/m burst 20')
+    assert limit == (100, 60) and limit.burst == 20
+    assert parse_limit('5 per 10s').burst == 5 # all of it at once, by default
+
+    limits = parse_limits({'user': '10/s', 'function': '1000/s burst 50'})
+    assert limits['user'] == (10, 1) and limits['function'].burst == 50
+    with pytest.raises(ValueError): parse_limits({'team': '1/s'})
+    with pytest.raises(ValueError): parse_limit('1/fortnight')
+
+async def test_gcra_limiter(monkeypatch):
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+
+    limiter = ratelimit.LocalLimiter('token_bucket')
+    checks = [('k', parse_limit('10/s burst 3'))]
+    assert [await limiter.hit(checks) for _ in range(4)] == [0, 0, 0, pytest.approx(0.1)]
+
+    now[0] += 0.1 # one call's worth refills, no window boundary to burst across
+    assert await limiter.hit(checks) == 0
+    assert await limiter.hit(checks) > 0
+
+async def test_gcra_limiter_over_a_full_window(monkeypatch):
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+
+    async def admitted(limit: str) -> int:
+        # A client calling as fast as it can (every 10ms) for one whole period.
+        limiter, checks, n = ratelimit.LocalLimiter(), [('k', parse_limit(limit))], 0
+        start = now[0] = now[0] + 3600
+        for i in range(6000):
+            now[0] = start + i / 100
+            n += await limiter.hit(checks) == 0
+        return n
+
+    assert await admitted('100/m') == 199 # count + burst - 1: a full burst, then the steady rate
+    assert await admitted('100/m burst 10') == 109
+    assert await admitted('100/m burst 1') == 100
+
+async def test_sliding_window_limiter(monkeypatch):
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+
+    limiter = ratelimit.LocalLimiter('sliding_window')
+    checks = [('k', parse_limit('2/m'))]
+    assert await limiter.hit(checks) == 0
+    now[0] += 30
+    assert await limiter.hit(checks) == 0
+    assert await limiter.hit(checks) == pytest.approx(30)
+    now[0] += 30
+    assert await limiter.hit(checks) == 0 # the first call has left the window
+
+async def test_limits_are_checked_together():
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limits
+
+    limits = parse_limits({'user': '1/m', 'function': '2/m burst 2'})
+    limiter = ratelimit.LocalLimiter()
+
+    assert await limiter.hit(ratelimit.checks_for('f', limits, uid='alice')) == 0
+    assert await limiter.hit(ratelimit.checks_for('f', limits, uid='alice')) > 0 # refused by `user`...
+    assert await limiter.hit(ratelimit.checks_for('f', limits, uid='bob')) == 0 # ...so it didn't count towards `function`
+    assert await limiter.hit(ratelimit.checks_for('f', limits, uid='carol')) > 0
+
+def test_expiring_store():
+    from ephaptic.store import ExpiringStore
+
+    store = ExpiringStore(max_size=3)
+    store.set('a', 1, expires_at=10.5, now=0)
+    store.set('b', 2, expires_at=20.5, now=0)
+    assert store.get('a', now=5) == 1
+    assert store.get('a', now=10.5) is None
+
+    # Expired keys are reaped by later operations on other keys, without a full scan.
+    store.set('b', 2, expires_at=30.5, now=0) # extended, so its old slot is stale
+    store.set('c', 3, expires_at=100, now=0)
+    store.get('c', now=25)
+    assert len(store) == 2 and store.get('b', now=25) == 2
+
+    # Least recently used goes first once it's full: `c` was last read before `b`.
+    store.set('d', 4, expires_at=100, now=26)
+    store.set('e', 5, expires_at=100, now=26)
+    assert store.get('c', now=26) is None and store.get('b', now=26) == 2
+    assert store.stats()['evicted'] == 1
+
+def test_local_limiter_is_bounded():
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    limiter = ratelimit.LocalLimiter(max_keys=100)
+    for n in range(1000): asyncio.run(limiter.hit([(f'ip:{n}', parse_limit('1/h'))]))
+    assert len(limiter._state) == 100
+
+@pytest.fixture
+async def real_redis():
+    # The Lua scripts only run against a real server, e.g. `REDIS_URL=redis://localhost:6379/15`.
+    import os
+    import uuid
+    import redis.asyncio as redis
+
+    client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/15'))
+    try:
+        await client.ping()
+    except Exception:
+        await client.aclose()
+        pytest.skip('needs a Redis server (set REDIS_URL)')
+
+    prefix = f'test:{uuid.uuid4().hex}'
+    yield client, prefix
+    async for key in client.scan_iter(f'{prefix}:*'): await client.delete(key)
+    await client.aclose()
+
+async def test_redis_limiter_script(real_redis):
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    client, prefix = real_redis
+    gcra = ratelimit.RedisLimiter(client)
+    alice, everyone = (f'{prefix}:u:alice', parse_limit('2/m')), (f'{prefix}:all', parse_limit('1/m'))
+
+    assert await gcra.hit([alice, everyone]) == 0
+    assert 0 < await gcra.hit([alice, everyone]) <= 60 # refused by `everyone`...
+    assert await gcra.hit([alice]) == 0 # ...without using up alice's
+    assert 0 < await gcra.hit([alice]) <= 30
+
+    window = ratelimit.RedisLimiter(client, 'sliding_window')
+    checks = [(f'{prefix}:login', parse_limit('3/m'))]
+    assert [await window.hit(checks) for _ in range(3)] == [0, 0, 0]
+    assert 59 < await window.hit(checks) <= 60
+
+async def test_hybrid_limiter_lease_script(real_redis):
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    client, prefix = real_redis
+    nodes = [ratelimit.HybridLimiter(client, slice=0.5) for _ in range(2)]
+    checks = [(f'{prefix}:k', parse_limit('20/m'))] # leases of 10
+
+    # Two nodes sharing one budget let 20 calls through between them, and then refuse.
+    results = [await nodes[n % 2].hit(checks) for n in range(30)]
+    await asyncio.sleep(0.05) # any background top ups
+    results += [await node.hit(checks) for node in nodes]
+    assert results.count(0) == 20
+    assert all(0 < result <= 3 for result in results if result) # one call every 3s
+    assert not any(node.degraded for node in nodes)
+
+async def test_hybrid_limiter_leases_from_redis():
+    from fixtures.fake_redis import FakeRedis
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    budget = {'k:gcra': 50} # what's left in Redis, refilling disabled
+    calls = []
+
+    async def lease_script(keys, args):
+        calls.append(keys)
+        out = []
+        for n, key in enumerate(keys):
+            granted = min(args[n * 4 + 3], budget[key])
+            budget[key] -= granted
+            out += [granted, '0' if granted else '30']
+        return out
+
+    limiter = ratelimit.HybridLimiter(FakeRedis(), slice=0.1)
+    limiter._lease_script = lease_script
+    checks = [('k', parse_limit('100/m'))] # leases of 10
+
+    # Sized from the rate, but never more than the bucket holds.
+    assert limiter._size(parse_limit('50/m burst 2')) == 2 and limiter._size(parse_limit('5/m')) == 1
+
+    # Concurrent misses share one round trip, and most calls never wait on Redis at all.
+    results = await asyncio.gather(*(limiter.hit(checks) for _ in range(10)))
+    assert results == [0] * 10 and len(calls) == 2 # the first lease, and a top up once half of it was spent
+
+    for _ in range(40): assert await limiter.hit(checks) == 0
+    await asyncio.sleep(0)
+    assert len(calls) <= 6 and budget['k:gcra'] == 0
+
+    # The node runs out when Redis does, and stops asking until Redis said it'd have more.
+    while not await limiter.hit(checks): ...
+    asked = len(calls)
+    assert await limiter.hit(checks) == pytest.approx(30, abs=1)
+    assert len(calls) == asked
+
+async def test_hybrid_limiter_concurrent_callers_share_the_lease():
+    from fixtures.fake_redis import FakeRedis
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    budget = {'k:gcra': 3}
+
+    async def lease_script(keys, args):
+        await asyncio.sleep(0.01)
+        granted = min(args[3], budget['k:gcra'])
+        budget['k:gcra'] -= granted
+        return [granted, '0' if granted else '30']
+
+    limiter = ratelimit.HybridLimiter(FakeRedis(), slice=0.5)
+    limiter._lease_script = lease_script
+    checks = [('k', parse_limit('100/m burst 100'))] # leases of 50, of which Redis only has 3
+
+    results = await asyncio.gather(*(limiter.hit(checks) for _ in range(200)))
+    assert results.count(0) == 3
+    assert all(result == pytest.approx(30, abs=1) for result in results if result)
+    assert limiter._leases.get('k', time.monotonic()).tokens == 0
+
+async def test_hybrid_limiter_falls_back_when_redis_is_down():
+    from fixtures.fake_redis import FakeRedis
+    from ephaptic import ratelimit
+    from ephaptic.utils import parse_limit
+
+    async def unreachable(keys, args): raise ConnectionError()
+
+    limiter = ratelimit.HybridLimiter(FakeRedis())
+    limiter._lease_script = unreachable
+    checks = [('k', parse_limit('2/m burst 2'))]
+
+    assert [await limiter.hit(checks) for _ in range(3)][:2] == [0, 0]
+    assert limiter.degraded and await limiter.hit(checks) > 0 # still limited, in memory
+
+    recovering = limiter._recovering # checking on Redis in the background, until it's stopped
+    assert not recovering.done()
+    await limiter.close()
+    assert recovering.cancelled() and limiter._recovering is None
+
+    with pytest.raises(ValueError): ratelimit.HybridLimiter(FakeRedis(), 'sliding_window')
+
+async def test_response_cache():
+    import msgpack
+    from fixtures.transport import QueueTransport
+    from ephaptic.ctx import active_user
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    runs = []
+
+    class Query(pydantic.BaseModel):
+        q: str
+
+    @eph.expose(cache=60)
+    async def search(query: Query, limit: int = 10) -> list[str]:
+        runs.append(query.q)
+        return [query.q] * limit
+
+    @eph.expose(cache={'ttl': 60, 'per_user': True})
+    async def me() -> str:
+        runs.append('me')
+        return str(active_user())
+
+    # Nothing to store for a stream, so it's refused rather than silently never cached.
+    with pytest.raises(TypeError):
+        @eph.expose(cache=60)
+        async def numbers() -> typing.AsyncGenerator[int, None]: yield 1
+    with pytest.raises(TypeError):
+        @eph.expose(cache=60)
+        def more_numbers() -> typing.Generator[int, None, None]: yield 1
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    async def call(name, *args, **kwargs):
+        transport.push({'type': 'rpc', 'id': 1, 'name': name, 'args': list(args), 'kwargs': kwargs})
+        return await transport.pull()
+
+    for _ in range(3): assert await call('search', {'q': 'a'}, 2) == {'id': 1, 'result': ['a', 'a']}
+    assert await call('search', {'q': 'a'}, limit=2) == {'id': 1, 'result': ['a', 'a']} # same validated arguments
+    assert (await call('search', {'q': 'b'}))['result'] == ['b'] * 10
+    assert runs == ['a', 'b']
+    assert eph.cache_stats()['search'] == {'hits': 3, 'misses': 2, 'size': 2}
+
+    eph.invalidate('search', {'q': 'a'}, 2)
+    await call('search', {'q': 'a'}, 2)
+    await call('search', {'q': 'b'})
+    assert runs == ['a', 'b', 'a']
+
+    eph.invalidate(search)
+    await call('search', {'q': 'b'})
+    assert runs == ['a', 'b', 'a', 'b']
+
+    # Per user: each user gets their own entry.
+    @eph.identity_loader
+    def load(auth): return auth
+
+    for uid in ('alice', 'bob', 'alice'):
+        other = QueueTransport()
+        asyncio.create_task(eph.handle_transport(other))
+        other.push({'type': 'init', 'auth': uid})
+        other.push({'type': 'rpc', 'id': 1, 'name': 'me', 'args': []})
+        assert (await other.pull())['result'] == uid
+    assert runs.count('me') == 2
+
+    server.cancel()
+
+async def test_coalesced_calls_share_one_execution():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    runs = []
+
+    @eph.expose(coalesce=True)
+    async def popular(n: int) -> int:
+        runs.append(n)
+        await asyncio.sleep(0.05)
+        return n * 2
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    for i in range(5): transport.push({'type': 'rpc', 'id': i, 'name': 'popular', 'args': [1]})
+    transport.push({'type': 'rpc', 'id': 5, 'name': 'popular', 'args': ['2']})
+    await asyncio.sleep(0.01)
+    transport.push({'type': 'cancel', 'id': 0}) # the first caller leaving doesn't cancel it for the others
+
+    responses = {r['id']: r['result'] for r in [await transport.pull() for _ in range(5)]}
+    assert responses == {1: 2, 2: 2, 3: 2, 4: 2, 5: 4}
+    assert runs == [1, 2]
+    assert eph.coalesce_stats()['popular'] == {'executions': 2, 'shared': 4, 'in_flight': 0}
+
+    server.cancel()
+
+async def test_coalesced_calls_dont_share_the_user():
+    from ephaptic import active_user
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+
+    @eph.identity_loader
+    def load(auth): return auth
+
+    @eph.expose(coalesce=True)
+    async def shared() -> typing.Optional[str]:
+        await asyncio.sleep(0.05)
+        return active_user()
+
+    @eph.expose(coalesce={'per_user': True})
+    async def mine() -> typing.Optional[str]:
+        await asyncio.sleep(0.05)
+        return active_user()
+
+    alice, bob = QueueTransport(), QueueTransport()
+    servers = [asyncio.create_task(eph.handle_transport(t)) for t in (alice, bob)]
+    alice.push({'type': 'init', 'auth': 'alice'})
+    bob.push({'type': 'init', 'auth': 'bob'})
+
+    for name in ('shared', 'mine'):
+        alice.push({'type': 'rpc', 'id': 1, 'name': name, 'args': []})
+        await asyncio.sleep(0.01) # alice's call is the one that runs
+        bob.push({'type': 'rpc', 'id': 1, 'name': name, 'args': []})
+        results = [(await alice.pull())['result'], (await bob.pull())['result']]
+        assert results == ([None, None] if name == 'shared' else ['alice', 'bob'])
+
+    for server in servers: server.cancel()
+
+async def test_coalesced_calls_across_nodes():
+    from fixtures.fake_redis import FakeRedis
+    from ephaptic.coalesce import Coalescer
+
+    client = FakeRedis()
+    runs = []
+
+    async def work(n):
+        runs.append(n)
+        await asyncio.sleep(0.05)
+        return n * 2
+
+    here, there = Coalescer('f', distributed=True), Coalescer('f', distributed=True)
+    assert await asyncio.gather(
+        here.run(here.key({'n': 1}), work, 1, client=client),
+        there.run(there.key({'n': 1}), work, 1, client=client),
+    ) == [2, 2]
+    assert runs == [1] and not [key for key in client.strings if not key.endswith(':result')] # lock released
+
+async def test_identity_cache():
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, identity_cache={'ttl': 60, 'negative_ttl': 60})
+    loads = []
+
+    @eph.identity_loader
+    async def load(auth):
+        loads.append(auth)
+        await asyncio.sleep(0.01)
+        return {'good': 'alice', 'also-good': 'alice'}.get(auth)
+
+    @eph.expose
+    async def whoami() -> typing.Optional[str]:
+        from ephaptic.ctx import active_user
+        return active_user()
+
+    async def connect(auth):
+        transport = QueueTransport()
+        asyncio.create_task(eph.handle_transport(transport))
+        transport.push({'type': 'init', 'auth': auth})
+        transport.push({'type': 'rpc', 'id': 1, 'name': 'whoami', 'args': []})
+        return (await transport.pull())['result']
+
+    # A reconnect storm: one load per token, including the bad one.
+    assert await asyncio.gather(*(connect('good') for _ in range(5))) == ['alice'] * 5
+    assert await asyncio.gather(*(connect('bad') for _ in range(3))) == [None] * 3
+    assert loads == ['good', 'bad']
+
+    await eph.identity_cache.revoke('good')
+    assert await connect('good') == 'alice'
+    assert await connect('also-good') == 'alice'
+    assert loads == ['good', 'bad', 'good', 'also-good']
+
+    await eph.identity_cache.revoke_user('alice')
+    await connect('good')
+    await connect('also-good')
+    assert loads[4:] == ['good', 'also-good']
+    assert eph.identity_cache.stats()['misses'] == 6
+
+async def test_identity_cache_over_http():
+    import httpx
+    from ephaptic.ctx import active_user
+    from ephaptic.identity import bearer_token
+
+    async def who(app, **kwargs):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            return (await client.get('/api/who', **kwargs)).json()['user']
+
+    def build(**cache):
+        app = FastAPI()
+        eph = Ephaptic.from_app(app, http_paths=['/api'], identity_cache={'ttl': 60, **cache})
+        loads = []
+
+        @eph.http_identity_loader
+        def load(request):
+            loads.append(request)
+            if request.cookies.get('session'): return request.cookies['session']
+            return {'abc': 'alice'}.get(bearer_token(request))
+
+        @app.get('/api/who')
+        def whoami(): return {'user': active_user()}
+        return eph, app, loads
+
+    # Without `http_token`, we can't tell what a request authenticates with, so nothing is cached.
+    eph, app, loads = build()
+    assert await who(app, headers={'Cookie': 'session=alice'}) == 'alice'
+    assert await who(app, headers={'Cookie': 'session=bob'}) == 'bob'
+    assert await who(app) is None and len(loads) == 3
+
+    eph, app, loads = build(http_token=bearer_token)
+    for _ in range(2): assert await who(app, headers={'Authorization': 'Bearer abc'}) == 'alice'
+    assert len(loads) == 1
+    assert await who(app, headers={'Cookie': 'session=bob'}) == 'bob' # no token, so never cached
+    assert await who(app, headers={'Cookie': 'session=carol'}) == 'carol'
+
+    await eph.identity_cache.revoke('abc') # the bare token, as the client knows it
+    await who(app, headers={'Authorization': 'Bearer abc'})
+    assert len(loads) == 4
+
+async def test_ctx_middleware_skips_other_paths():
+    import httpx
+    from fastapi.responses import StreamingResponse
+    from ephaptic.ctx import active_user, is_http
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, http_paths=['/api'])
+    loads = []
+
+    @eph.http_identity_loader
+    def load(request):
+        loads.append(request.url.path)
+        return 'alice'
+
+    @app.get('/api/who')
+    @app.get('/other/who')
+    def who(): return {'user': active_user(), 'http': is_http()}
+
+    @app.get('/api/stream')
+    def stream():
+        user = active_user()
+        return StreamingResponse(f'{user}:{n}\n' for n in range(3))
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        assert (await client.get('/api/who')).json() == {'user': 'alice', 'http': True}
+        assert (await client.get('/other/who')).json() == {'user': None, 'http': False}
+        assert (await client.get('/api/stream')).text == 'alice:0\nalice:1\nalice:2\n'
+    assert loads == ['/api/who', '/api/stream']
+
+async def test_router_user_rate_limit():
+    import httpx
+    from ephaptic.ext.fastapi import Router
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+    router = Router(eph)
+
+    @eph.http_identity_loader
+    def load(request): return request.headers.get('Authorization')
+
+    @router.get('/ping', limit={'user': '1/m'})
+    async def ping() -> str: return 'pong'
+
+    app.include_router(router)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        assert (await client.get('/ping', headers={'Authorization': 'alice'})).status_code == 200
+        refused = await client.get('/ping', headers={'Authorization': 'alice'})
+        assert refused.status_code == 429 and int(refused.headers['X-Retry-After']) > 0
+        assert (await client.get('/ping', headers={'Authorization': 'bob'})).status_code == 200 # per user, not per IP
+
+async def test_executor_pool_is_bounded():
+    import threading
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, executors={'slow': {'max_workers': 1, 'max_queue': 1, 'queue_timeout': 0.5}})
+    release = threading.Event()
+
+    @eph.expose(executor='slow')
+    def blocking(n: int) -> int:
+        release.wait(5)
+        return n
+
+    @eph.expose
+    def quick() -> str:
+        return threading.current_thread().name
+
+    with pytest.raises(TypeError):
+        @eph.expose(executor='slow')
+        async def not_sync(): ...
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    for i in range(3): transport.push({'type': 'rpc', 'id': i, 'name': 'blocking', 'args': [i]})
+    await asyncio.sleep(0.05)
+    assert eph.executor_stats()['slow'] == {'workers': 1, 'running': 1, 'queued': 1, 'completed': 0, 'rejected': 1}
+
+    # The third didn't fit in the queue, and the default pool isn't held up by the saturated one.
+    error = await transport.pull()
+    assert error['id'] == 2 and error['error']['code'] == 'OVERLOADED' and error['error']['data'] == {'executor': 'slow'}
+    transport.push({'type': 'rpc', 'id': 3, 'name': 'quick', 'args': []})
+    assert not (await transport.pull())['result'].startswith('ephaptic-slow')
+
+    release.set()
+    assert sorted([(await transport.pull())['result'] for _ in range(2)]) == [0, 1]
+    assert eph.executor_stats()['slow']['completed'] == 2
+
+    server.cancel()
+
+async def test_executor_queue_wait_is_bounded():
+    from ephaptic.executors import ThreadPool, ExecutorOverloaded
+
+    pool = ThreadPool('tiny', max_workers=1, max_queue=4, queue_timeout=0.05)
+    slow = asyncio.create_task(pool.run(time.sleep, 0.3))
+    await asyncio.sleep(0.01)
+
+    with pytest.raises(ExecutorOverloaded):
+        await pool.run(time.sleep, 0)
+    await slow
+    await pool.run(time.sleep, 0)
+    assert pool.stats() == {'workers': 1, 'running': 0, 'queued': 0, 'completed': 2, 'rejected': 1}
+
+async def test_executors_stop_with_the_app():
+    import threading
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, executors={'work': 2})
+
+    async with app.router.lifespan_context(app):
+        await eph.executor('work').run(time.sleep, 0)
+        assert any(thread.name.startswith('ephaptic-work') for thread in threading.enumerate())
+
+    for _ in range(50):
+        if not any(thread.name.startswith('ephaptic-work') for thread in threading.enumerate()): break
+        await asyncio.sleep(0.02)
+    else:
+        pytest.fail("the pool's threads outlived the app")
+
+    assert await eph.executor('work').run(lambda: 'again') == 'again' # and it starts again if used after that
+    eph.shutdown_executors()
+
+async def test_process_executor():
+    import os
+    from fixtures import cpu
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, executors={'process': {'max_workers': 1, 'preload': ['fixtures.cpu']}})
+    for func in (cpu.mirror, cpu.whoami, cpu.wrong, cpu.count):
+        eph.expose(executor='process')(func)
+
+    @eph.identity_loader
+    def load(auth): return auth
+
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init', 'auth': 'alice'})
+
+    async def call(name, *args):
+        transport.push({'type': 'rpc', 'id': 1, 'name': name, 'args': list(args)})
+        return await transport.pull()
+
+    assert (await call('mirror', {'x': 1, 'y': 2}))['result'] == {'x': 2, 'y': 1}
+    assert (await call('mirror', {'x': 'one', 'y': 2}))['error']['code'] == 'VALIDATION_ERROR' # checked before it's sent over
+    assert (await call('wrong'))['error']['code'] == 'RETURN_VALIDATION_ERROR'
+
+    user, pid = (await call('whoami'))['result']
+    assert user == 'alice' and pid != os.getpid()
+
+    transport.push({'type': 'rpc', 'id': 2, 'name': 'count', 'args': [3]})
+    frames = [await transport.pull() for _ in range(5)]
+    assert [frame.get('chunk') for frame in frames[1:4]] == [{'x': 0, 'y': 0}, {'x': 1, 'y': 1}, {'x': 2, 'y': 4}]
+    assert frames[4] == {'id': 2, 'done': True}
+
+    transport.push({'type': 'rpc', 'id': 3, 'name': 'count', 'args': [4]})
+    frames = [await transport.pull() for _ in range(5)]
+    assert 'boom' in frames[4]['error']['message']
+
+    for _ in range(50): # the error can get here before the worker's call is counted as done
+        if eph.executor_stats()['process']['completed'] == 5: break
+        await asyncio.sleep(0.01)
+    assert eph.executor_stats()['process']['completed'] == 5 # the invalid call never got there
+    server.cancel()
+    eph.executor('process').shutdown()
+
+async def test_process_executor_stops_with_the_app():
+    from fixtures import cpu
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, executors={'process': {'max_workers': 1, 'preload': ['fixtures.cpu']}})
+    pool = eph.executor('process')
+
+    async with app.router.lifespan_context(app):
+        await pool.run(cpu.whoami)
+        assert pool._manager is not None # started with the workers, not by the first stream
+        chunks = await pool.stream(cpu.count, n=1000) # left mid-stream, its worker stuck on a full queue
+        assert (await asyncio.to_thread(next, chunks)) == {'x': 0, 'y': 0}
+        processes = [*pool._executor._processes.values(), pool._manager.result()._process]
+
+    for _ in range(100):
+        if not any(process.is_alive() for process in processes): break
+        await asyncio.sleep(0.05)
+    else:
+        pytest.fail("the worker processes outlived the app")
+
+async def test_metrics():
+    import httpx
+    from ephaptic import metrics
+    from ephaptic.ext.fastapi import Router
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, metrics_path='/metrics')
+    router = Router(eph)
+
+    @eph.expose
+    async def measured(n: int) -> int:
+        await asyncio.sleep(0.01)
+        return n
+
+    @eph.expose
+    async def measured_stream() -> typing.AsyncGenerator[int, None]:
+        for n in range(3): yield n
+
+    @router.get('/measured_http')
+    async def measured_http() -> int: return 1
+
+    app.include_router(router)
+
+    sent = metrics.bytes_sent.get()
+    messages, frames = metrics.outbound_messages.get(), metrics.outbound_frames.get()
+    transport = QueueTransport()
+    server = asyncio.create_task(eph.handle_transport(transport))
+    transport.push({'type': 'init'})
+
+    for call_id, args in enumerate(([1], ['nope'], [2])):
+        transport.push({'type': 'rpc', 'id': call_id, 'name': 'measured', 'args': args})
+        await transport.pull()
+    transport.push({'type': 'rpc', 'id': 3, 'name': 'missing', 'args': []})
+    transport.push({'type': 'rpc', 'id': 4, 'name': 'measured_stream', 'args': []})
+    for _ in range(6): await transport.pull()
+    await asyncio.sleep(0.01)
+
+    assert metrics.rpc_calls.get('measured', 'ok') == 2
+    assert metrics.rpc_calls.get('measured', 'validation_error') == 1
+    assert metrics.rpc_calls.get('<unknown>', 'not_found') == 1
+    assert metrics.rpc_duration.count('measured') == 3
+    assert metrics.rpc_inflight.get('measured') == 0
+    assert metrics.stream_chunks.get('measured_stream') == 3
+    assert metrics.streams_active.get('measured_stream') == 0
+    assert metrics.bytes_sent.get() > sent
+    assert metrics.outbound_messages.get() - messages == metrics.outbound_frames.get() - frames == 9 # no `multi`, so one per frame
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+        assert (await client.get('/measured_http')).json() == 1
+        response = await client.get('/metrics')
+
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    text = response.text
+    assert 'ephaptic_rpc_calls_total{function="measured",outcome="ok"} 2' in text
+    assert 'ephaptic_http_requests_total{function="measured_http",outcome="ok"} 1' in text
+    assert 'ephaptic_rpc_duration_seconds_bucket{function="measured",le="+Inf"} 3' in text
+    assert '# TYPE ephaptic_connections gauge' in text and 'ephaptic_users' in text
+    assert 'ephaptic_outbound_queue_depth{lane="event"} 0' in text and 'ephaptic_outbound_frames_total' in text
+
+    server.cancel()
+
+async def test_tracing_hooks():
+    from ephaptic import tracing
+    from fixtures.transport import QueueTransport
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app)
+
+    @eph.expose
+    async def traced(n: int) -> int:
+        await asyncio.sleep(0.01)
+        return n
+
+    @eph.expose
+    def traced_stream() -> typing.Generator[int, None, None]:
+        yield 1
+        raise ValueError('boom')
+
+    recorder = tracing.add_hook(tracing.Recorder())
+    try:
+        transport = QueueTransport()
+        server = asyncio.create_task(eph.handle_transport(transport))
+        transport.push({'type': 'init'})
+
+        transport.push({'type': 'rpc', 'id': 1, 'name': 'traced', 'args': [1], 'trace': {'traceparent': '00-abc-def-01'}})
+        await transport.pull()
+        transport.push({'type': 'rpc', 'id': 2, 'name': 'traced', 'args': ['nope']})
+        await transport.pull()
+        transport.push({'type': 'rpc', 'id': 3, 'name': 'traced_stream', 'args': []})
+        for _ in range(3): await transport.pull()
+        await asyncio.sleep(0.01)
+    finally:
+        tracing.remove_hook(recorder)
+
+    [call] = recorder.find('rpc', call_id=1)
+    assert call.function == 'traced' and call.trace == {'traceparent': '00-abc-def-01'} and call.attributes['outcome'] == 'ok'
+    phases = [span for span in recorder.spans if span.parent is call]
+    assert [span.name for span in phases] == ['decode', 'validate', 'handler', 'return_validation', 'send']
+    assert all(call.start_ns <= span.start_ns <= span.end_ns <= call.end_ns for span in phases)
+    assert phases[2].duration >= 0.01
+
+    [validate] = recorder.find('validate', call_id=2)
+    assert isinstance(validate.error, pydantic.ValidationError) and validate.parent.attributes['outcome'] == 'validation_error'
+    [stream] = recorder.find('stream', call_id=3)
+    assert str(stream.error) == 'boom'
+
+    # No hooks, no spans.
+    recorder.clear()
+    transport.push({'type': 'rpc', 'id': 4, 'name': 'traced', 'args': [1]})
+    await transport.pull()
+    assert recorder.spans == []
+
+    server.cancel()
+
+async def test_memory_transport():
+    import msgpack
+    from ephaptic.transports import memory
+
+    app = FastAPI()
+    eph = Ephaptic.from_app(app, event_queue_size=2)
+
+    @eph.expose
+    async def add(a: int, b: int) -> int: return a + b
+
+    # One way latency, both ways.
+    client = await memory.connect(eph, latency=0.02)
+    start = time.perf_counter()
+    assert await client.add(1, 2) == 3
+    assert time.perf_counter() - start >= 0.04
+    server = client.transport.server
+    await client.close()
+    await asyncio.wait_for(server, 1) # the server side sees the close
+
+    # Frames are paced at `bandwidth`.
+    link = memory.Link(bandwidth=10_000)
+    start = time.perf_counter()
+    for _ in range(3): await link.put(b'x' * 500)
+    for _ in range(3): await link.get()
+    assert time.perf_counter() - start >= 0.15
+
+    # A client that stops reading fills the buffer, then the server's event lane.
+    client = await memory.connect(eph, buffer=150)
+    received = []
+    async def tick(n): received.append(n)
+    client.on('tick', tick)
+    await asyncio.sleep(0.01) # for the server to read `init`
+
+    server_end = client.transport.peer
+    event = lambda n: msgpack.dumps({'type': 'event', 'name': 'tick', 'payload': {'args': [n], 'padding': 'x' * 64}})
+    client.transport.pause()
+    for n in (1, 2):
+        server_end.outbound.post(event(n))
+        await asyncio.sleep(0.01) # 1 is in the buffer, 2 is stuck behind it
+    for n in (3, 4, 5): server_end.outbound.post(event(n))
+    assert server_end.outbound.dropped == 1 # the oldest, 3
+
+    client.transport.resume()
+    await asyncio.sleep(0.05)
+    assert received == [1, 2, 4, 5]
+
+    server = client.transport.server
+    await client.close()
+    await asyncio.wait_for(server, 1)
+
+async def test_stream_transport(tmp_path):
+    from ephaptic.client import connect
+    from ephaptic.transports import stream
+
+    app = FastAPI()
+    socket_path = tmp_path / 'ephaptic.sock'
+    eph = Ephaptic.from_app(app, listen=f'unix://{socket_path}')
+
+    @eph.expose
+    async def add(a: int, b: int) -> int: return a + b
+
+    @eph.expose
+    async def numbers(n: int) -> typing.AsyncGenerator[int, None]:
+        for i in range(n): yield i
+
+    async with app.router.lifespan_context(app): # the listener starts and stops with the app
+        client = await connect(f'unix://{socket_path}')
+        assert await client.add(1, 2) == 3
+        assert [i async for i in await client.numbers(3)] == [0, 1, 2]
+        assert eph.listeners.connections
+    assert not eph.listeners.servers and not eph.listeners.connections
+
+    server = await stream.serve(eph, 'tcp://127.0.0.1:0')
+    host, port = server.sockets[0].getsockname()[:2]
+    client = await connect(f'tcp://{host}:{port}')
+    assert await client.add(2, 3) == 5
+    await client.close()
+    server.close()
+
+    with pytest.raises(ValueError): Ephaptic.from_app(FastAPI(), listen='udp://127.0.0.1:9000')
+    with pytest.raises(ValueError): stream.parse_url('tcp://127.0.0.1')